@@ -0,0 +1,8 @@
+from django.db.backends.sqlite3.base import *
+from django.db.backends.sqlite3.base import DatabaseWrapper as BaseDatabaseWrapper
+
+from blogengine.pool import PooledDatabaseWrapper
+
+
+class DatabaseWrapper(PooledDatabaseWrapper, BaseDatabaseWrapper):
+	pass
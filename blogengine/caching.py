@@ -0,0 +1,170 @@
+import hashlib
+import threading
+import time
+
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, parse_http_date_safe, quote_etag
+
+from .routers import pin_primary
+from .sites import current_site_id
+
+
+def version_key(name, site_id=None):
+	# Each site has its own counters, so one blog's changes leave the
+	# others' caches alone
+	return 'blogengine:version:%s:%s' % (site_id or current_site_id(), name)
+
+
+def changed_key(name, site_id=None):
+	return 'blogengine:changed:%s:%s' % (site_id or current_site_id(), name)
+
+
+def initial_version():
+	# Counters that are evicted restart from the clock, beyond any value
+	# they reached before, so keys built from old values are never reused
+	return int(time.time() * 1000)
+
+
+def get_version(name):
+	"""Return the current version counter for a group of cached content.
+
+	Bumping the counter orphans every key built from the old value, so a
+	group can be invalidated without knowing which keys exist.
+	"""
+	key = version_key(name)
+	version = cache.get(key)
+	if version is None:
+		version = initial_version()
+		cache.add(key, version, None)
+		version = cache.get(key, version)
+	return version
+
+
+def bump_version(name, site_id=None):
+	"""Invalidate a group on one site, by default the current one.
+
+	While a request is being served the bump is made again once it has
+	finished (see repeat_bumps()).
+	"""
+	bumped = getattr(_bumped, 'groups', None)
+	if bumped is not None:
+		bumped.add((name, site_id or current_site_id()))
+	key = version_key(name, site_id)
+	cache.set(changed_key(name, site_id), time.time(), None)
+	pin_primary()
+	try:
+		return cache.incr(key)
+	except ValueError:
+		# Not in the cache yet (or evicted); a reader may have started the
+		# counter this same millisecond, so go one past it
+		version = initial_version() + 1
+		cache.set(key, version, None)
+		return version
+
+
+_bumped = threading.local()
+
+def track_bumps():
+	"""Remember the groups bumped from now on, as a request starts."""
+	_bumped.groups = set()
+
+
+def repeat_bumps():
+	"""Bump the groups bumped since track_bumps() again, and stop tracking.
+
+	Bumps happen as rows are saved, before the transaction commits. A page
+	rendered in between reads the new version with the old rows, so the
+	versions are moved on again once the request, and with it the
+	transaction, has finished.
+	"""
+	groups = getattr(_bumped, 'groups', None)
+	_bumped.groups = None
+	for name, site_id in groups or ():
+		bump_version(name, site_id)
+
+
+def get_versions(names):
+	"""Like get_version() for several groups, in one cache round trip."""
+	keys = dict((version_key(name), name) for name in names)
+	found = cache.get_many(keys.keys())
+	versions = dict((keys[key], version) for key, version in found.items())
+	for name in names:
+		if name not in versions:
+			versions[name] = get_version(name)
+	return versions
+
+
+def last_changed(names):
+	"""Return when any of the groups was last bumped, as a Unix timestamp.
+
+	A group with no recorded time (never bumped, or evicted) counts as
+	changed now, so the answer is never earlier than the truth.
+	"""
+	keys = [changed_key(name) for name in names]
+	found = cache.get_many(keys)
+	now = time.time()
+	for key in keys:
+		if key not in found:
+			cache.add(key, now, None)
+			found[key] = cache.get(key, now)
+	return max(found.values()) if found else now
+
+
+def add_cache_groups(request, *groups):
+	"""Record that the page being rendered depends on these groups.
+
+	The versions are read now, before the view queries anything, so a
+	change that lands mid-render leaves the stored page already stale.
+	Only responses whose views call this are stored by the page cache.
+	"""
+	if not hasattr(request, '_cache_versions'):
+		request._cache_versions = {}
+	request._cache_versions.update(get_versions(groups))
+
+
+def make_etag(content):
+	return quote_etag(hashlib.sha1(content).hexdigest())
+
+
+def not_modified(request, etag=None, last_modified=None):
+	"""Return True if the request's validators match the given ones.
+
+	`last_modified` is a formatted HTTP date, as stored in a response's
+	Last-Modified header. If-None-Match takes precedence when both are
+	sent, as in RFC 7232.
+	"""
+	if request.method not in ('GET', 'HEAD'):
+		return False
+	if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+	if if_none_match and etag:
+		etags = parse_etags(if_none_match)
+		return '*' in etags or etag.strip('"') in etags
+	if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+	if if_modified_since and last_modified:
+		since = parse_http_date_safe(if_modified_since)
+		modified = parse_http_date_safe(last_modified)
+		return since is not None and modified is not None and modified <= since
+	return False
+
+
+def cached_response(request, cached):
+	"""Build a 200 or 304 from a dict stored by `freeze_response`."""
+	if not_modified(request, cached['etag'], cached['last_modified']):
+		response = HttpResponseNotModified()
+	else:
+		response = HttpResponse(cached['content'], content_type=cached['content_type'])
+	response['ETag'] = cached['etag']
+	if cached['last_modified']:
+		response['Last-Modified'] = cached['last_modified']
+	return response
+
+
+def freeze_response(response):
+	# Keep a validator the view computed, so hits and misses agree
+	return {
+		'content': response.content,
+		'content_type': response['Content-Type'],
+		'etag': response.get('ETag') or make_etag(response.content),
+		'last_modified': response.get('Last-Modified'),
+	}
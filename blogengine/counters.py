@@ -0,0 +1,123 @@
+"""
+Maintenance of the denormalised post_count / latest_pub_date columns on
+Category and Tag, and of the MonthArchive table. Increments are single
+UPDATEs using F() expressions, so concurrent saves never lose a count.
+"""
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Q
+from django.utils import timezone
+
+from .models import Category, MonthArchive, Post, Tag
+
+
+# How each archive model is reached from Post
+POST_LOOKUPS = {Category: 'category', Tag: 'tags'}
+
+
+def add_posts(model, pks, count=1, pub_date=None):
+	"""Record `count` posts joining each archive in `pks`."""
+	pks = [pk for pk in pks if pk is not None]
+	if not pks:
+		return
+	model.objects.filter(pk__in=pks).update(post_count=F('post_count') + count)
+	if pub_date is None:
+		refresh_latest(model, pks)
+	else:
+		model.objects.filter(pk__in=pks).filter(
+			Q(latest_pub_date__isnull=True) | Q(latest_pub_date__lt=pub_date)
+		).update(latest_pub_date=pub_date)
+
+
+def remove_posts(model, pks, count=1):
+	"""Record `count` posts leaving each archive in `pks`."""
+	pks = [pk for pk in pks if pk is not None]
+	if not pks:
+		return
+	archives = model.objects.filter(pk__in=pks)
+	# Posts loaded from fixtures were never counted, so stop at zero
+	archives.filter(post_count__gt=0, post_count__lt=count).update(post_count=0)
+	archives.filter(post_count__gte=count).update(post_count=F('post_count') - count)
+	refresh_latest(model, pks)
+
+
+def refresh_latest(model, pks):
+	lookup = POST_LOOKUPS[model]
+	for pk in pks:
+		latest = Post.objects.filter(**{lookup: pk}).aggregate(latest=Max('pub_date'))['latest']
+		model.objects.filter(pk=pk).update(latest_pub_date=latest)
+
+
+def actual_counts(model):
+	"""Yield (archive, actual post count, actual latest pub_date)."""
+	archives = model.objects.annotate(
+		actual_count=Count('post'), actual_latest=Max('post__pub_date'))
+	for archive in archives:
+		yield archive, archive.actual_count, archive.actual_latest
+
+
+def inconsistencies(model):
+	return [(archive, count, latest) for archive, count, latest in actual_counts(model)
+		if (archive.post_count, archive.latest_pub_date) != (count, latest)]
+
+
+def recount(model):
+	"""Fix every row that disagrees with the posts; returns how many did."""
+	wrong = inconsistencies(model)
+	for archive, count, latest in wrong:
+		model.objects.filter(pk=archive.pk).update(post_count=count, latest_pub_date=latest)
+	return len(wrong)
+
+
+def utc_month(pub_date):
+	if timezone.is_aware(pub_date):
+		pub_date = pub_date.astimezone(timezone.utc)
+	return pub_date.year, pub_date.month
+
+
+def adjust_month(site_id, pub_date, count):
+	"""Add `count` (which may be negative) to a site's month archive."""
+	year, month = utc_month(pub_date)
+	months = MonthArchive.objects.filter(site=site_id, year=year, month=month)
+	if count < 0:
+		# Posts loaded from fixtures were never counted, so stop at zero
+		months.filter(post_count__gt=0, post_count__lt=-count).update(post_count=0)
+		months.filter(post_count__gte=-count).update(post_count=F('post_count') + count)
+		return
+	if months.update(post_count=F('post_count') + count):
+		return
+	try:
+		with transaction.atomic():
+			MonthArchive.objects.create(site_id=site_id, year=year, month=month, post_count=count)
+	except IntegrityError:
+		# Created by a concurrent save since the UPDATE above
+		months.update(post_count=F('post_count') + count)
+
+
+def month_inconsistencies():
+	"""Return (site_id, year, month, stored count, actual count) for every
+	MonthArchive row, missing or present, that disagrees with the posts.
+	"""
+	actual = defaultdict(int)
+	for site_id, pub_date in Post.objects.values_list('site_id', 'pub_date').iterator():
+		actual[(site_id, ) + utc_month(pub_date)] += 1
+	wrong = []
+	for archive in MonthArchive.objects.all():
+		key = (archive.site_id, archive.year, archive.month)
+		count = actual.pop(key, 0)
+		if archive.post_count != count:
+			wrong.append(key + (archive.post_count, count))
+	wrong.extend(key + (None, count) for key, count in actual.items())
+	return wrong
+
+
+def recount_months():
+	"""Rebuild MonthArchive from the posts; returns how many rows changed."""
+	wrong = month_inconsistencies()
+	for site_id, year, month, stored, count in wrong:
+		if stored is None:
+			MonthArchive.objects.create(site_id=site_id, year=year, month=month, post_count=count)
+		else:
+			MonthArchive.objects.filter(site=site_id, year=year, month=month).update(post_count=count)
+	return len(wrong)
@@ -0,0 +1,129 @@
+"""
+Single-pass URL resolution for the blog.
+
+Django tries a URLconf's patterns one regex at a time, so a request near
+the end of the list (or one that matches nothing and falls through to
+the flat pages) pays for every pattern before it. CompiledURLResolver
+resolves the same patterns to the same views in one step:
+
+ * paths that only one fixed pattern can match, like 'search/', are
+   looked up in a dict;
+ * otherwise the path's first segment picks the patterns that can match
+   it (those starting with that literal segment, plus those starting
+   with a group), which are tried as one combined regex.
+
+The combined regex is an alternation of the patterns in their original
+order, each wrapped in a group named after its position, so the first
+pattern that matches wins exactly as with Django's resolver. URLconfs
+it can't compile this way (includes, unnamed groups, backreferences,
+unanchored patterns) are resolved by Django as usual.
+"""
+import re
+
+from django.core.urlresolvers import RegexURLPattern, RegexURLResolver, Resolver404, ResolverMatch
+
+
+SPECIAL = set('.^$*+?{}[]\\|()')
+GROUP_NAME = re.compile(r'\(\?P<(\w+)>')
+
+
+def literal_prefix(pattern):
+	"""The literal text a '^'-anchored regex starts with, and the rest."""
+	i = 1
+	while i < len(pattern) and pattern[i] not in SPECIAL:
+		i += 1
+	# A quantifier applies to the character before it
+	if i < len(pattern) and pattern[i] in '*+?{':
+		i -= 1
+	return pattern[1:i], pattern[i:]
+
+
+def compilable(pattern):
+	if not isinstance(pattern, RegexURLPattern):
+		return False
+	text, regex = pattern.regex.pattern, pattern.regex
+	return (text.startswith('^') and '(?P=' not in text
+		and regex.groups == len(regex.groupindex))
+
+
+class CompiledURLResolver(RegexURLResolver):
+	"""A drop-in RegexURLResolver for a URLconf of plain patterns::
+
+		CompiledURLResolver(r'', 'blogengine.urls'),
+	"""
+
+	def __init__(self, *args, **kwargs):
+		super(CompiledURLResolver, self).__init__(*args, **kwargs)
+		self._table = None
+
+	def build_table(self):
+		patterns = self.url_patterns
+		if not all(compilable(pattern) for pattern in patterns):
+			return False
+		segments, anywhere = {}, []
+		for index, pattern in enumerate(patterns):
+			literal, rest = literal_prefix(pattern.regex.pattern)
+			if '/' in literal:
+				segments.setdefault(literal.split('/', 1)[0], []).append(index)
+			elif rest == '$':
+				segments.setdefault(literal, []).append(index)
+			else:
+				anywhere.append(index)
+
+		# A fixed path is only a shortcut if no earlier pattern matches it
+		static = {}
+		for index, pattern in enumerate(patterns):
+			literal, rest = literal_prefix(pattern.regex.pattern)
+			if rest == '$' and not any(other.regex.search(literal) for other in patterns[:index]):
+				static.setdefault(literal, index)
+
+		combined = {}
+		for segment, indexes in segments.items():
+			combined[segment] = self.combine(sorted(indexes + anywhere))
+		combined[None] = self.combine(anywhere)
+		return static, combined
+
+	def combine(self, indexes):
+		if not indexes:
+			return None
+		alternatives = ['(?P<_%d>%s)' % (index,
+			GROUP_NAME.sub(r'(?P<_%d_\1>' % index, self.url_patterns[index].regex.pattern))
+			for index in indexes]
+		return re.compile('|'.join(alternatives), re.UNICODE)
+
+	@property
+	def table(self):
+		if self._table is None:
+			try:
+				self._table = self.build_table()
+			except (re.error, AssertionError):
+				# Python's re allows only 100 named groups
+				self._table = False
+		return self._table
+
+	def resolve(self, path):
+		table = self.table
+		if not table:
+			return super(CompiledURLResolver, self).resolve(path)
+		static, combined = table
+		match = self.regex.search(path)
+		if not match:
+			raise Resolver404({'path': path})
+		new_path = path[match.end():]
+
+		kwargs = dict(match.groupdict(), **self.default_kwargs)
+		index = static.get(new_path)
+		if index is None:
+			regex = combined.get(new_path.split('/', 1)[0], combined[None])
+			found = regex.match(new_path) if regex is not None else None
+			if found is None:
+				raise Resolver404({'tried': [[pattern] for pattern in self.url_patterns],
+					'path': new_path})
+			index = int(found.lastgroup[1:])
+			prefix = '_%d_' % index
+			kwargs.update((name[len(prefix):], value) for name, value in found.groupdict().items()
+				if name.startswith(prefix))
+		pattern = self.url_patterns[index]
+		kwargs.update(pattern.default_args)
+		return ResolverMatch(pattern.callback, (), kwargs, pattern.name,
+			self.app_name, [self.namespace])
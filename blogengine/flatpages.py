@@ -0,0 +1,43 @@
+"""
+The URLs of each site's flat pages, kept in memory.
+
+Flat pages are served by the catch-all at the end of mysite/urls.py, so
+every path nothing else matched, bot probes included, would otherwise
+cost a query just to find there is no such page. With the full set of a
+site's URLs at hand, misses are answered from memory and only real pages
+are read from the database.
+
+A set is reloaded when the 'flatpages' cache group changes (signals.py
+bumps it whenever a flat page or its sites change), and at the latest
+after BLOG_FLATPAGE_INDEX_TIMEOUT seconds.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+
+from .caching import get_version
+from .sites import current_site_id
+
+
+class FlatPageIndex(object):
+	def __init__(self):
+		# site id -> (version, expiry time, urls)
+		self.entries = {}
+
+	def urls(self):
+		"""The URLs of the current site's flat pages."""
+		site_id = current_site_id()
+		version = get_version('flatpages')
+		entry = self.entries.get(site_id)
+		if entry is None or entry[0] != version or entry[1] < time.time():
+			urls = frozenset(FlatPage.objects.filter(sites=site_id).values_list('url', flat=True))
+			entry = (version, time.time() + getattr(settings, 'BLOG_FLATPAGE_INDEX_TIMEOUT', 300), urls)
+			self.entries[site_id] = entry
+		return entry[2]
+
+	def clear(self):
+		self.entries = {}
+
+
+flatpage_index = FlatPageIndex()
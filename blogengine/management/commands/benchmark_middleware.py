@@ -0,0 +1,38 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.client import Client
+from django.test.utils import override_settings
+
+
+class Command(BaseCommand):
+	args = '[path ...]'
+	help = ('Time anonymous GETs to public pages with and without the session '
+		'middleware fast path (see SessionStackMiddleware).')
+
+	option_list = BaseCommand.option_list + (
+		make_option('--requests', dest='requests', type='int', default=2000,
+			help='Requests made to each path in each mode.'),
+	)
+
+	def handle(self, *paths, **options):
+		paths = paths or ('/', '/feeds/posts/', '/no-such-page/')
+		count = options['requests']
+		# Page cache hits never reach the session middleware
+		middleware = [path for path in settings.MIDDLEWARE_CLASSES
+			if path != 'blogengine.middleware.AnonymousPageCacheMiddleware']
+		for path in paths:
+			timings = {}
+			for fast in (False, True):
+				with override_settings(BLOG_PUBLIC_FAST_PATH=fast, MIDDLEWARE_CLASSES=middleware):
+					client = Client()
+					# The first request loads the middleware and warms up
+					status = client.get(path).status_code
+					started = time.time()
+					for _ in range(count):
+						client.get(path)
+					timings[fast] = (time.time() - started) * 1e6 / count
+			self.stdout.write('%-20s %d  full %7.1fus  fast path %7.1fus  saved %6.1fus per request' % (
+				path, status, timings[False], timings[True], timings[False] - timings[True]))
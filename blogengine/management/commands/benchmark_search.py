@@ -0,0 +1,89 @@
+import random
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.utils import timezone
+
+from blogengine.models import Post
+from blogengine.search import SegmentSearchBackend, get_backend
+
+
+WORDS = ('django python search index query posting ranking vector sqlite postgres '
+	'template cache feed archive category tag markdown deploy server database '
+	'performance latency thread process memory disk network request response').split()
+
+# Common words match most posts; the rare 'termN' words match a handful
+QUERIES = ('python', 'django cache', 'postgres index ranking', 'term123', 'term7 python')
+
+
+class Rollback(Exception):
+	pass
+
+
+class Command(NoArgsCommand):
+	help = ('Measure search latency against a large, generated set of posts. '
+		'The posts are inserted in a transaction that is rolled back afterwards.')
+
+	option_list = NoArgsCommand.option_list + (
+		make_option('--posts', dest='posts', type='int', default=100000,
+			help='Number of posts to generate.'),
+		make_option('--repeat', dest='repeat', type='int', default=20,
+			help='Times each query is run.'),
+		make_option('--segments', action='store_true', dest='segments', default=False,
+			help='Measure the segment file index instead of the configured backend.'),
+	)
+
+	def handle_noargs(self, **options):
+		path = None
+		if options['segments']:
+			path = tempfile.mkdtemp()
+			backend = SegmentSearchBackend(path)
+		else:
+			backend = get_backend()
+		try:
+			with transaction.atomic():
+				self.generate(backend, options['posts'])
+				self.measure(backend, options['repeat'])
+				raise Rollback
+		except Rollback:
+			pass
+		finally:
+			if path:
+				shutil.rmtree(path)
+
+	def generate(self, backend, count):
+		rng = random.Random(0)
+		author = User.objects.get_or_create(username='benchmark')[0]
+		site = Site.objects.get_current()
+		now = timezone.now()
+		started = time.time()
+		for offset in range(0, count, 1000):
+			posts = []
+			for i in range(offset, min(offset + 1000, count)):
+				posts.append(Post(title=' '.join(rng.sample(WORDS, 4)),
+					text=' '.join([rng.choice(WORDS) for _ in range(200)]
+						+ ['term%d' % rng.randint(0, 50000) for _ in range(10)]),
+					slug='benchmark-%d' % i, pub_date=now, author=author, site=site))
+			Post.objects.bulk_create(posts)
+		backend.rebuild()
+		self.stdout.write('Indexed %d posts with %s in %.1fs.' % (
+			count, backend.__class__.__name__, time.time() - started))
+
+	def measure(self, backend, repeat):
+		for query in QUERIES:
+			timings = []
+			for _ in range(repeat):
+				started = time.time()
+				results = backend.search(query)
+				total = results.count()
+				list(results[:5])
+				timings.append((time.time() - started) * 1000)
+			timings.sort()
+			self.stdout.write('%-24s %7d hits  median %7.1fms  max %7.1fms' % (
+				query, total, timings[len(timings) // 2], timings[-1]))
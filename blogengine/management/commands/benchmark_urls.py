@@ -0,0 +1,70 @@
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.core.urlresolvers import RegexURLResolver, Resolver404
+
+from blogengine.dispatch import CompiledURLResolver
+
+
+def mixed_paths(count):
+	"""Blog URLs roughly as a crawler sees them, misses included."""
+	rng = random.Random(0)
+	kinds = [
+		lambda: '/',
+		lambda: '/%d/%d/post-%d/' % (rng.randint(2010, 2014), rng.randint(1, 12), rng.randint(0, 5000)),
+		lambda: '/%d/%d/' % (rng.randint(2010, 2014), rng.randint(1, 12)),
+		lambda: '/%d/' % rng.randint(2010, 2014),
+		lambda: '/category/category-%d/' % rng.randint(0, 50),
+		lambda: '/tag/tag-%d/' % rng.randint(0, 500),
+		lambda: rng.choice(['/feeds/posts/', '/feeds/posts/atom/']),
+		lambda: '/feeds/%s/slug-%d/' % (rng.choice(['category', 'tag']), rng.randint(0, 50)),
+		lambda: '/search/',
+		lambda: rng.choice(['/about/', '/contact/', '/wp-login.php/', '/.env', '/admin.php']),
+	]
+	return [rng.choice(kinds)() for _ in range(count)]
+
+
+def resolve_all(resolver, paths):
+	results = []
+	for path in paths:
+		try:
+			match = resolver.resolve(path)
+		except Resolver404:
+			results.append(None)
+		else:
+			results.append((match.func, match.args, match.kwargs))
+	return results
+
+
+class Command(NoArgsCommand):
+	help = ("Compare the time Django's resolver and CompiledURLResolver take to "
+		"resolve a mix of blog URLs, and check they agree on every one.")
+
+	option_list = NoArgsCommand.option_list + (
+		make_option('--paths', dest='paths', type='int', default=10000,
+			help='Number of paths to resolve.'),
+		make_option('--repeat', dest='repeat', type='int', default=5,
+			help='Times the paths are resolved; the best run is reported.'),
+	)
+
+	def handle_noargs(self, **options):
+		paths = mixed_paths(options['paths'])
+		stock = RegexURLResolver(r'^/', 'blogengine.urls')
+		compiled = CompiledURLResolver(r'^/', 'blogengine.urls')
+		if resolve_all(stock, paths) != resolve_all(compiled, paths):
+			raise CommandError('The resolvers disagree.')
+
+		timings = {}
+		for name, resolver in (('stock', stock), ('compiled', compiled)):
+			best = None
+			for _ in range(options['repeat']):
+				started = time.time()
+				resolve_all(resolver, paths)
+				elapsed = time.time() - started
+				best = elapsed if best is None else min(best, elapsed)
+			timings[name] = best
+			self.stdout.write('%-9s %7.1fms  %5.2fus per path' % (
+				name, best * 1000, best * 1e6 / len(paths)))
+		self.stdout.write('Speedup: %.1fx' % (timings['stock'] / timings['compiled']))
@@ -0,0 +1,34 @@
+import time
+from optparse import make_option
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import NoArgsCommand
+from django.utils import timezone
+
+
+class Command(NoArgsCommand):
+	help = ('Delete expired sessions a batch at a time, so the table is never '
+		'locked for long. Unlike clearsessions, this is safe on a busy site.')
+
+	option_list = NoArgsCommand.option_list + (
+		make_option('--batch-size', dest='batch_size', type='int', default=1000,
+			help='Rows deleted per statement.'),
+		make_option('--pause', dest='pause', type='float', default=0.0,
+			help='Seconds to wait between batches.'),
+	)
+
+	def handle_noargs(self, **options):
+		now = timezone.now()
+		expired = Session.objects.filter(expire_date__lt=now).order_by()
+		deleted = 0
+		while True:
+			# Each batch is its own short transaction, by primary key
+			keys = list(expired.values_list('pk', flat=True)[:options['batch_size']])
+			if not keys:
+				break
+			Session.objects.filter(pk__in=keys).delete()
+			deleted += len(keys)
+			if options['pause']:
+				time.sleep(options['pause'])
+		if int(options['verbosity']):
+			self.stdout.write('Deleted %d expired session(s).' % deleted)
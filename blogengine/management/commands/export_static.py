@@ -0,0 +1,234 @@
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import tempfile
+from collections import defaultdict
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import connections
+from django.test.client import Client
+
+from blogengine.models import Category, MonthArchive, Post, RelatedPost, Tag
+from blogengine.views import PostListView
+
+
+MANIFEST_NAME = '.export-manifest.json'
+
+
+def fingerprint(*parts):
+	return hashlib.sha1(repr(parts)).hexdigest()
+
+
+def output_path(output_dir, url, content_type):
+	"""Map a URL to the file a static server would look for.
+
+	Paginated pages (?page=N) are written under page/N/ in their archive's
+	directory; the web server needs a matching rewrite for the query.
+	"""
+	path, _, query = url.partition('?')
+	parts = [part for part in path.split('/') if part]
+	if query.startswith('page='):
+		parts += ['page', query[len('page='):]]
+	name = 'index.html' if content_type.startswith('text/html') else 'index.xml'
+	return os.path.join(output_dir, *(parts + [name]))
+
+
+def write_atomic(path, content):
+	directory = os.path.dirname(path)
+	if not os.path.isdir(directory):
+		try:
+			os.makedirs(directory)
+		except OSError:
+			# Another worker created it first
+			if not os.path.isdir(directory):
+				raise
+	fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.export-')
+	try:
+		with os.fdopen(fd, 'wb') as temp:
+			temp.write(content)
+		os.chmod(temp_path, 0644)
+		os.rename(temp_path, path)
+	except Exception:
+		os.unlink(temp_path)
+		raise
+
+
+def close_connections():
+	# Connections must not be shared across a fork
+	for connection in connections.all():
+		connection.close()
+
+
+_client = None
+
+def render_page(job):
+	"""Render one URL through the real URLconf and write it to disk."""
+	global _client
+	output_dir, host, url = job
+	if _client is None:
+		_client = Client(HTTP_HOST=host)
+	response = _client.get(url)
+	if response.status_code != 200:
+		return url, response.status_code, None
+	path = output_path(output_dir, url, response['Content-Type'])
+	write_atomic(path, response.content)
+	return url, response.status_code, path
+
+
+class Command(NoArgsCommand):
+	help = ('Render every post, archive, feed and flat page to static files. '
+		'With --incremental, only pages whose rows changed since the last '
+		'export are rendered again.')
+
+	option_list = NoArgsCommand.option_list + (
+		make_option('--output', dest='output', default='static_site',
+			help='Directory to write the site into.'),
+		make_option('--processes', dest='processes', type='int',
+			default=multiprocessing.cpu_count(),
+			help='Number of worker processes used to render pages.'),
+		make_option('--incremental', action='store_true', dest='incremental', default=False,
+			help='Skip pages whose underlying rows are unchanged.'),
+	)
+
+	def handle_noargs(self, **options):
+		if getattr(settings, 'BLOG_KEYSET_PAGINATION', False):
+			# Listings would link to ?after= cursors, which aren't exported
+			raise CommandError('The static export needs numbered pages; '
+				'set BLOG_KEYSET_PAGINATION = False.')
+		output_dir = os.path.abspath(options['output'])
+		verbosity = int(options['verbosity'])
+		manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+
+		pages = self.collect_pages()
+		previous = {}
+		if options['incremental'] and os.path.exists(manifest_path):
+			with open(manifest_path) as manifest:
+				previous = json.load(manifest)
+
+		urls = [url for url, digest in sorted(pages.items()) if previous.get(url) != digest]
+		host = Site.objects.get_current().domain
+		jobs = [(output_dir, host, url) for url in urls]
+
+		if options['processes'] > 1 and len(jobs) > 1:
+			close_connections()
+			pool = multiprocessing.Pool(options['processes'], initializer=close_connections)
+			try:
+				results = pool.map(render_page, jobs, chunksize=16)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results = map(render_page, jobs)
+
+		failed = [(url, status) for url, status, path in results if status != 200]
+		for url, status in failed:
+			self.stderr.write('%s returned %d, not exported.' % (url, status))
+			pages.pop(url)
+
+		# Pages that no longer exist are removed along with their files
+		for url in set(previous) - set(pages):
+			for content_type in ('text/html', 'application/xml'):
+				path = output_path(output_dir, url, content_type)
+				if os.path.exists(path):
+					os.unlink(path)
+
+		write_atomic(manifest_path, json.dumps(pages, indent=1, sort_keys=True))
+
+		if verbosity:
+			self.stdout.write('Exported %d of %d page(s) to %s.' % (
+				len(urls) - len(failed), len(pages) + len(failed), output_dir))
+
+	def collect_pages(self):
+		"""Return {url: fingerprint} for every page of the site.
+
+		A fingerprint covers the rows that page displays, so it changes
+		exactly when the page needs rendering again.
+		"""
+		categories = dict((row[0], row[1:]) for row in
+			Category.objects.values_list('id', 'name', 'slug', 'description'))
+		tags = dict((row[0], row[1:]) for row in
+			Tag.objects.values_list('id', 'name', 'slug', 'description'))
+		tags_by_post = defaultdict(list)
+		for post_id, tag_id in Post.tags.through.objects.values_list('post_id', 'tag_id'):
+			tags_by_post[post_id].append(tag_id)
+		related_by_post = defaultdict(list)
+		for row in RelatedPost.objects.values_list('post_id', 'related__title',
+				'related__slug', 'related__pub_date'):
+			related_by_post[row[0]].append(row[1:])
+
+		pages = {}
+		post_digests = []
+		category_digests = defaultdict(list)
+		tag_digests = defaultdict(list)
+		month_digests = defaultdict(list)
+		posts = Post.on_site.order_by('-pub_date', '-pk').values_list(
+			'id', 'title', 'slug', 'pub_date', 'text_hash', 'site_id', 'category_id')
+		for post_id, title, slug, pub_date, text_hash, site_id, category_id in posts:
+			digest = fingerprint(title, slug, pub_date.isoformat(), text_hash, site_id,
+				categories.get(category_id),
+				sorted(tags[tag_id] for tag_id in tags_by_post[post_id]))
+			# Listings don't show related posts, so only the post page's
+			# fingerprint covers them
+			pages[Post(slug=slug, pub_date=pub_date).get_absolute_url()] = fingerprint(
+				digest, related_by_post[post_id])
+			post_digests.append(digest)
+			month_digests[pub_date.year, pub_date.month].append(digest)
+			if category_id is not None:
+				category_digests[category_id].append(digest)
+			for tag_id in tags_by_post[post_id]:
+				tag_digests[tag_id].append(digest)
+
+		self.add_archive(pages, '/', '/feeds/posts/', post_digests)
+		for category_id, digests in category_digests.items():
+			slug = categories[category_id][1]
+			self.add_archive(pages, Category(slug=slug).get_absolute_url(),
+				'/feeds/category/%s/' % slug, digests, categories[category_id])
+		for tag_id, digests in tag_digests.items():
+			slug = tags[tag_id][1]
+			self.add_archive(pages, Tag(slug=slug).get_absolute_url(),
+				'/feeds/tag/%s/' % slug, digests, tags[tag_id])
+
+		months = MonthArchive.objects.summary()
+		for month in months:
+			self.add_archive(pages, month['url'], None,
+				month_digests[month['year'], month['month']])
+		for year in set(month['year'] for month in months):
+			pages['/%d/' % year] = fingerprint([(month['month'], month['post_count'])
+				for month in months if month['year'] == year])
+
+		flatpages = FlatPage.objects.filter(sites=settings.SITE_ID, registration_required=False)
+		for row in flatpages.values_list('url', 'title', 'content', 'template_name'):
+			pages[row[0]] = fingerprint(*row)
+
+		# Every HTML page shows the sidebar, feeds don't
+		sidebar = self.sidebar_digest(months)
+		for url, digest in pages.items():
+			if not url.startswith('/feeds/'):
+				pages[url] = fingerprint(digest, sidebar)
+		return pages
+
+	def sidebar_digest(self, months):
+		"""Fingerprint what the base layout's sidebar shows."""
+		recent = Post.on_site.order_by('-pub_date', '-pk').values_list('title', 'slug', 'pub_date')
+		return fingerprint(
+			[(category.name, category.slug, category.post_count)
+				for category in Category.on_site.counted('name')],
+			[(tag.name, tag.slug, tag.post_count) for tag in Tag.on_site.counted('name')],
+			[(title, slug, pub_date.isoformat()) for title, slug, pub_date in recent[:5]],
+			[(month['year'], month['month'], month['post_count']) for month in months])
+
+	def add_archive(self, pages, url, feed_url, digests, *extra):
+		"""Add a paginated post listing and its RSS and Atom feeds, if any."""
+		digest = fingerprint(digests, *extra)
+		pages[url] = digest
+		if feed_url is not None:
+			pages[feed_url] = pages[feed_url + 'atom/'] = digest
+		per_page = PostListView.paginate_by
+		for number in range(2, int(math.ceil(len(digests) / float(per_page))) + 1):
+			pages['%s?page=%d' % (url, number)] = digest
@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand
+
+from blogengine import related
+
+
+class Command(NoArgsCommand):
+	help = ('Recompute the related posts of every post. Saves keep them roughly '
+		'current; run this periodically to catch up with tag weight changes.')
+
+	def handle_noargs(self, **options):
+		rows = related.rebuild()
+		if int(options['verbosity']):
+			self.stdout.write('Stored %d related post links.' % rows)
@@ -0,0 +1,14 @@
+from django.core.management.base import NoArgsCommand
+
+from blogengine.search import get_backend
+
+
+class Command(NoArgsCommand):
+	help = ('Rebuild the full-text search index from the posts table, e.g. after '
+		'posts were imported with bulk_create or queryset updates.')
+
+	def handle_noargs(self, **options):
+		backend = get_backend()
+		backend.rebuild()
+		if int(options['verbosity']):
+			self.stdout.write('Rebuilt the search index with %s.' % backend.__class__.__name__)
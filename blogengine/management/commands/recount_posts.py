@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from blogengine import counters
+from blogengine.models import Category, Tag
+
+
+class Command(NoArgsCommand):
+	help = ('Recompute the post counters on categories and tags, and the month '
+		'archive table, from the posts themselves.')
+
+	option_list = NoArgsCommand.option_list + (
+		make_option('--check', action='store_true', dest='check', default=False,
+			help='Only report rows whose counters are wrong, and fail if there are any.'),
+	)
+
+	def handle_noargs(self, **options):
+		verbosity = int(options['verbosity'])
+
+		if options['check']:
+			wrong = 0
+			for model in (Category, Tag):
+				for archive, count, latest in counters.inconsistencies(model):
+					wrong += 1
+					self.stderr.write('%s %r: post_count=%d latest_pub_date=%s, expected %d and %s' % (
+						model._meta.verbose_name, archive.slug, archive.post_count,
+						archive.latest_pub_date, count, latest))
+			for site_id, year, month, stored, count in counters.month_inconsistencies():
+				wrong += 1
+				self.stderr.write('month %d/%d on site %d: post_count=%s, expected %d' % (
+					year, month, site_id, stored, count))
+			if wrong:
+				raise CommandError('%d counter row(s) are inconsistent.' % wrong)
+			if verbosity:
+				self.stdout.write('All post counters are consistent.')
+			return
+
+		for model in (Category, Tag):
+			fixed = counters.recount(model)
+			if verbosity:
+				self.stdout.write('Fixed %d %s.' % (fixed, model._meta.verbose_name_plural))
+		fixed = counters.recount_months()
+		if verbosity:
+			self.stdout.write('Fixed %d month archives.' % fixed)
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.contrib.flatpages.models import FlatPage
+from django.core.management.base import NoArgsCommand
+
+from blogengine.models import Post, RenderedFlatPage
+
+
+class Command(NoArgsCommand):
+	help = 'Backfill or re-render the stored Markdown HTML for posts and flat pages.'
+
+	option_list = NoArgsCommand.option_list + (
+		make_option('--force', action='store_true', dest='force', default=False,
+			help='Re-render every row, even if its source hash is current.'),
+	)
+
+	def handle_noargs(self, **options):
+		force = options['force']
+		verbosity = int(options['verbosity'])
+
+		posts = 0
+		for post in Post.objects.all().iterator():
+			if post.render_text(force=force):
+				# update() skips save() and its side effects; only the
+				# rendered columns change here.
+				Post.objects.filter(pk=post.pk).update(
+					text_html=post.text_html,
+					text_hash=post.text_hash)
+				posts += 1
+
+		pages = 0
+		for flatpage in FlatPage.objects.all().iterator():
+			if RenderedFlatPage.render_for(flatpage, force=force):
+				pages += 1
+
+		if verbosity:
+			self.stdout.write('Re-rendered %d post(s) and %d flat page(s).' % (posts, pages))
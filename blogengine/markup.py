@@ -0,0 +1,109 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import markdown
+
+from django.conf import settings
+from django.utils.encoding import force_unicode, smart_str
+from django.utils.safestring import mark_safe
+
+
+# Changing this list changes every source hash, so stored HTML is treated as
+# stale until `manage.py rerender_markdown` has been run.
+MARKDOWN_EXTENSIONS = ["nl2br", ]
+
+_local = threading.local()
+
+
+def source_hash(text):
+	digest = hashlib.sha1(smart_str(u','.join(MARKDOWN_EXTENSIONS)))
+	digest.update('\0')
+	digest.update(smart_str(force_unicode(text)))
+	return digest.hexdigest()
+
+
+def get_engine():
+	"""Return this thread's Markdown instance, building it on first use."""
+	engine = getattr(_local, 'engine', None)
+	if engine is None:
+		engine = markdown.Markdown(extensions=MARKDOWN_EXTENSIONS,
+					   safe_mode=True,
+					   enable_attribute=False)
+		_local.engine = engine
+	return engine
+
+
+def render_markdown(text):
+	engine = get_engine()
+	try:
+		return mark_safe(engine.convert(force_unicode(text)))
+	finally:
+		engine.reset()
+
+
+class MarkdownCache(object):
+	"""Thread-safe LRU of rendered HTML, bounded by entry count and bytes."""
+
+	def __init__(self, max_entries, max_bytes):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self._entries = OrderedDict()
+		self._bytes = 0
+		self._lock = threading.Lock()
+		self.hits = self.misses = self.evictions = 0
+
+	def get(self, key):
+		with self._lock:
+			html = self._entries.pop(key, None)
+			if html is None:
+				self.misses += 1
+				return None
+			self._entries[key] = html
+			self.hits += 1
+			return html
+
+	def set(self, key, html):
+		size = len(html)
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			old = self._entries.pop(key, None)
+			if old is not None:
+				self._bytes -= len(old)
+			self._entries[key] = html
+			self._bytes += size
+			while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+				_, evicted = self._entries.popitem(last=False)
+				self._bytes -= len(evicted)
+				self.evictions += 1
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._bytes = 0
+			self.hits = self.misses = self.evictions = 0
+
+	def stats(self):
+		with self._lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'entries': len(self._entries),
+				'bytes': self._bytes,
+			}
+
+
+markdown_cache = MarkdownCache(
+	getattr(settings, 'MARKDOWN_CACHE_ENTRIES', 1000),
+	getattr(settings, 'MARKDOWN_CACHE_BYTES', 8 * 1024 * 1024))
+
+
+def cached_markdown(text):
+	key = source_hash(text)
+	html = markdown_cache.get(key)
+	if html is None:
+		html = render_markdown(text)
+		markdown_cache.set(key, html)
+	return mark_safe(html)
@@ -0,0 +1,164 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.utils.encoding import iri_to_uri
+from django.utils.module_loading import import_by_path
+
+from . import routers, sites
+from .caching import cached_response, freeze_response, get_versions
+
+
+class SiteMiddleware(object):
+	"""Serve the site whose domain matches the request's host.
+
+	Sets request.site and makes it current for the site-scoped managers
+	and cache keys; unknown hosts get settings.SITE_ID. Sites are cached
+	in memory (see sites.py), so this costs no query. Put it before
+	AnonymousPageCacheMiddleware, whose keys depend on it.
+	"""
+
+	def process_request(self, request):
+		request.site = sites.site_for_host(request.get_host())
+		sites.activate(request.site)
+
+
+class AnonymousPageCacheMiddleware(object):
+	"""Serve whole blog and flat pages to anonymous visitors from the cache.
+
+	Pages are keyed by path and query string. Each entry records the
+	versions of the cache groups its view declared (see add_cache_groups),
+	and is only served while all of them are current, so a change purges
+	exactly the permalinks, archives and pages that showed it. Put this
+	right after SiteMiddleware so hits skip sessions, auth and the ORM.
+
+	The versions must be shared by every process serving the site, so a
+	local-memory cache is refused unless BLOG_SINGLE_PROCESS is set.
+	"""
+
+	def __init__(self):
+		if isinstance(cache, LocMemCache) and not getattr(settings, 'BLOG_SINGLE_PROCESS', False):
+			raise ImproperlyConfigured('AnonymousPageCacheMiddleware needs a cache shared '
+				'by all processes, such as memcached; the default cache is per process.')
+
+	def is_cacheable_request(self, request):
+		return (request.method in ('GET', 'HEAD')
+			and settings.SESSION_COOKIE_NAME not in request.COOKIES
+			and not request.path_info.startswith('/admin/'))
+
+	def cache_key(self, request):
+		path = hashlib.md5(iri_to_uri(request.get_full_path())).hexdigest()
+		return 'blogengine:page:%s:%s' % (sites.current_site_id(), path)
+
+	def process_request(self, request):
+		if not self.is_cacheable_request(request):
+			return None
+		cached = cache.get(self.cache_key(request))
+		if cached is None:
+			return None
+		versions = cached['versions']
+		if get_versions(versions.keys()) != versions:
+			return None
+		return cached_response(request, cached)
+
+	def process_response(self, request, response):
+		versions = getattr(request, '_cache_versions', None)
+		if (not versions or response.status_code != 200 or response.cookies
+				or response.streaming or not self.is_cacheable_request(request)):
+			return response
+		cached = freeze_response(response)
+		cached['versions'] = versions
+		cache.set(self.cache_key(request), cached,
+			getattr(settings, 'BLOG_PAGE_CACHE_TIMEOUT', None))
+		response['ETag'] = cached['etag']
+		return response
+
+
+class ReplicaMiddleware(object):
+	"""Read the public blog and flat pages from a replica (see routers.py)."""
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		# Class-based views and feeds report the module they're defined in
+		if (request.method in ('GET', 'HEAD')
+				and getattr(view_func, '__module__', None) == 'blogengine.views'):
+			routers.read_from_replica()
+
+	def process_exception(self, request, exception):
+		alias = routers.current_replica()
+		if alias is not None and isinstance(exception, DatabaseError):
+			routers.pool.eject(alias)
+
+	def process_response(self, request, response):
+		routers.read_from_primary()
+		return response
+
+
+class SessionStackMiddleware(object):
+	"""Run BLOG_SESSION_MIDDLEWARE, except for anonymous public reads.
+
+	Sessions, CSRF, auth and messages are only needed by the admin and by
+	visitors carrying a session or CSRF cookie. A GET or HEAD without
+	either, outside /admin/, skips them: no session is loaded or saved and
+	no cookie is set, and request.user is simply anonymous. Other cookies,
+	such as analytics ones, don't matter. Everything else goes
+	through the wrapped middleware exactly as if it were listed in
+	MIDDLEWARE_CLASSES in its place.
+	"""
+
+	def __init__(self):
+		self.middleware = [import_by_path(path)()
+			for path in getattr(settings, 'BLOG_SESSION_MIDDLEWARE', ())]
+
+	def is_public_read(self, request):
+		return (getattr(settings, 'BLOG_PUBLIC_FAST_PATH', True)
+			and request.method in ('GET', 'HEAD')
+			and settings.SESSION_COOKIE_NAME not in request.COOKIES
+			and settings.CSRF_COOKIE_NAME not in request.COOKIES
+			and not request.path_info.startswith('/admin/'))
+
+	def handlers(self, name, reverse=False):
+		handlers = [getattr(middleware, name) for middleware in self.middleware
+			if hasattr(middleware, name)]
+		return handlers[::-1] if reverse else handlers
+
+	def process_request(self, request):
+		request._public_read = self.is_public_read(request)
+		if request._public_read:
+			request.user = AnonymousUser()
+			return None
+		for handler in self.handlers('process_request'):
+			response = handler(request)
+			if response is not None:
+				return response
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		if getattr(request, '_public_read', False):
+			return None
+		for handler in self.handlers('process_view'):
+			response = handler(request, view_func, view_args, view_kwargs)
+			if response is not None:
+				return response
+
+	def process_template_response(self, request, response):
+		if not getattr(request, '_public_read', False):
+			for handler in self.handlers('process_template_response', reverse=True):
+				response = handler(request, response)
+		return response
+
+	def process_exception(self, request, exception):
+		if getattr(request, '_public_read', False):
+			return None
+		for handler in self.handlers('process_exception', reverse=True):
+			response = handler(request, exception)
+			if response is not None:
+				return response
+
+	def process_response(self, request, response):
+		if not getattr(request, '_public_read', False):
+			for handler in self.handlers('process_response', reverse=True):
+				response = handler(request, response)
+		return response
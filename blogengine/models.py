@@ -1,18 +1,72 @@
+import datetime
+
 from django.db import models
+from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
+from django.contrib.flatpages.models import FlatPage
 from django.contrib.sites.models import Site
+from django.utils import timezone
+from django.utils.safestring import mark_safe
 from django.utils.text import slugify
 
+from .markup import render_markdown, source_hash
+from .sites import current_site_id, is_multisite
+
+
+def counted_update_fields(archive):
+	"""Fields to write when saving a Category or Tag.
+
+	The post counters are maintained by UPDATEs in blogengine.counters, so
+	saving an existing row must not write back the copy held in memory.
+	"""
+	if archive._state.adding:
+		return None
+	return [field.name for field in archive._meta.fields
+		if not field.primary_key and field.name not in ('post_count', 'latest_pub_date')]
+
+
+class SiteArchiveManager(models.Manager):
+	"""Categories or tags with posts on the site being served.
+
+	With a single site this is every one of them, as before.
+	"""
+
+	def get_queryset(self):
+		queryset = super(SiteArchiveManager, self).get_queryset()
+		if not is_multisite():
+			return queryset
+		return queryset.filter(post__site=current_site_id()).distinct()
+
+	def counted(self, *ordering):
+		"""Like all(), but with post_count counting this site's posts only.
+
+		The stored counters cover every site, so they are only used as is
+		when there is a single site.
+		"""
+		queryset = self.get_queryset().order_by(*ordering)
+		if not is_multisite():
+			return queryset.filter(post_count__gt=0)
+		archives = list(queryset.annotate(site_post_count=models.Count('post')))
+		for archive in archives:
+			archive.post_count = archive.site_post_count
+		return archives
+
 
 class Category(models.Model):
 	name = models.CharField(max_length=200)
 	description = models.TextField()
 	slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+	post_count = models.PositiveIntegerField(default=0, editable=False)
+	latest_pub_date = models.DateTimeField(blank=True, null=True, editable=False)
+
+	objects = models.Manager()
+	on_site = SiteArchiveManager()
 
-	def save(self):
+	def save(self, *args, **kwargs):
 		if not self.slug:
 			self.slug = slugify(unicode(self.name))
-		super(Category, self).save()
+		kwargs.setdefault('update_fields', counted_update_fields(self))
+		super(Category, self).save(*args, **kwargs)
 
 	def get_absolute_url(self):
 		return '/category/%s' % (self.slug)
@@ -28,11 +82,17 @@ class Tag(models.Model):
 	name = models.CharField(max_length=200)
 	description = models.TextField()
 	slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+	post_count = models.PositiveIntegerField(default=0, editable=False)
+	latest_pub_date = models.DateTimeField(blank=True, null=True, editable=False)
 
-	def save(self):
+	objects = models.Manager()
+	on_site = SiteArchiveManager()
+
+	def save(self, *args, **kwargs):
 		if not self.slug:
 			self.slug = slugify(unicode(self.name))
-		super(Tag, self).save()
+		kwargs.setdefault('update_fields', counted_update_fields(self))
+		super(Tag, self).save(*args, **kwargs)
 
 	def get_absolute_url(self):
 		return '/tag/%s' % (self.slug)
@@ -41,15 +101,90 @@ class Tag(models.Model):
 		return self.name
 
 
+def month_range(year, month):
+	"""Return the [start, end) UTC datetimes bounding the given month.
+
+	Filtering on this range rather than pub_date__year/__month lets the
+	database use the pub_date index. Months follow get_absolute_url(),
+	which formats the stored UTC date.
+	"""
+	year, month = int(year), int(month)
+	start = datetime.datetime(year, month, 1, tzinfo=timezone.utc)
+	if month == 12:
+		end = datetime.datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+	else:
+		end = datetime.datetime(year, month + 1, 1, tzinfo=timezone.utc)
+	return start, end
+
+
+class PostQuerySet(QuerySet):
+	def published_in(self, year, month):
+		"""Posts of a (UTC) month, as a range the pub_date index can serve.
+
+		Raises ValueError for a month that doesn't exist.
+		"""
+		start, end = month_range(year, month)
+		return self.filter(pub_date__gte=start, pub_date__lt=end)
+
+
+class PostManager(models.Manager):
+	def get_queryset(self):
+		return PostQuerySet(self.model, using=self._db)
+
+	def for_listing(self):
+		"""Posts with everything the templates touch loaded up front."""
+		return self.get_queryset().select_related(
+			'author', 'site', 'category').prefetch_related('tags')
+
+	def published_in(self, year, month):
+		return self.get_queryset().published_in(year, month)
+
+
+class SitePostManager(PostManager):
+	"""Posts on the site being served (see sites.py)."""
+
+	def get_queryset(self):
+		return super(SitePostManager, self).get_queryset().filter(site=current_site_id())
+
+
 class Post(models.Model):
 	title = models.CharField(max_length=200)
-	pub_date = models.DateTimeField()
+	pub_date = models.DateTimeField(db_index=True)
 	text = models.TextField()
 	slug = models.SlugField(max_length=40, unique=True)
 	author = models.ForeignKey(User)
 	site = models.ForeignKey(Site)
 	category = models.ForeignKey(Category, blank=True, null=True)
 	tags = models.ManyToManyField(Tag)
+	text_html = models.TextField(blank=True, editable=False)
+	text_hash = models.CharField(max_length=40, blank=True, editable=False)
+	updated_at = models.DateTimeField(auto_now=True, default=timezone.now)
+
+	objects = PostManager()
+	on_site = SitePostManager()
+
+	def save(self, *args, **kwargs):
+		self.render_text()
+		super(Post, self).save(*args, **kwargs)
+
+	def render_text(self, force=False):
+		"""Refresh `text_html` if `text` (or the extension set) changed.
+
+		Returns True when the stored HTML was re-rendered.
+		"""
+		digest = source_hash(self.text)
+		if not force and digest == self.text_hash:
+			return False
+		self.text_html = render_markdown(self.text)
+		self.text_hash = digest
+		return True
+
+	def rendered_text(self):
+		# Rows saved before the extension set changed still render correctly
+		# until they are backfilled.
+		if self.text_hash != source_hash(self.text):
+			return render_markdown(self.text)
+		return mark_safe(self.text_html)
 
 	def get_absolute_url(self):
 		return "/{0}/{1}/{2}/".format(self.pub_date.year, self.pub_date.month, self.slug)
@@ -59,5 +194,91 @@ class Post(models.Model):
 
 	class Meta:
 		ordering = ["-pub_date"]
+		index_together = [["site", "pub_date"]]
+
+
+class MonthArchiveManager(models.Manager):
+	def summary(self, **filters):
+		"""Months with posts on the current site, newest first.
+
+		Each month is a dict with year, month, post_count, a `date` for
+		formatting and the archive `url`.
+		"""
+		months = self.get_queryset().filter(site=current_site_id(), post_count__gt=0, **filters)
+		months = months.values('year', 'month').annotate(total=models.Sum('post_count'))
+		return [{
+			'year': month['year'],
+			'month': month['month'],
+			'post_count': month['total'],
+			'date': datetime.date(month['year'], month['month'], 1),
+			'url': MonthArchive(year=month['year'], month=month['month']).get_absolute_url(),
+		} for month in months.order_by('-year', '-month')]
+
+
+class MonthArchive(models.Model):
+	"""Number of posts per site and (UTC) month, kept current by signals.
+
+	Archive navigation reads this small table instead of grouping posts.
+	"""
+	site = models.ForeignKey(Site)
+	year = models.PositiveIntegerField()
+	month = models.PositiveSmallIntegerField()
+	post_count = models.PositiveIntegerField(default=0)
+
+	objects = MonthArchiveManager()
+
+	def get_absolute_url(self):
+		return "/{0}/{1}/".format(self.year, self.month)
+
+	def __unicode__(self):
+		return u'%d/%d' % (self.year, self.month)
+
+	class Meta:
+		ordering = ["-year", "-month"]
+		unique_together = [["site", "year", "month"]]
+
+
+class RelatedPost(models.Model):
+	"""One of a post's precomputed nearest neighbours (see related.py)."""
+	post = models.ForeignKey(Post, related_name='related_links')
+	related = models.ForeignKey(Post, related_name='+')
+	score = models.FloatField()
+	rank = models.PositiveSmallIntegerField()
+
+	def __unicode__(self):
+		return u'%s -> %s' % (self.post_id, self.related_id)
+
+	class Meta:
+		ordering = ["post", "rank"]
+		unique_together = [["post", "rank"]]
+
+
+class RenderedFlatPage(models.Model):
+	"""Pre-rendered Markdown for a contrib FlatPage, kept in sync on save."""
+	flatpage = models.OneToOneField(FlatPage, related_name='rendered')
+	content_html = models.TextField(blank=True)
+	content_hash = models.CharField(max_length=40, blank=True)
+
+	@classmethod
+	def render_for(cls, flatpage, force=False):
+		"""Returns True when the stored HTML was re-rendered."""
+		digest = source_hash(flatpage.content)
+		rendered, created = cls.objects.get_or_create(flatpage=flatpage)
+		if not (force or created or rendered.content_hash != digest):
+			return False
+		rendered.content_html = render_markdown(flatpage.content)
+		rendered.content_hash = digest
+		rendered.save()
+		return True
+
+	def rendered_content(self):
+		if self.content_hash != source_hash(self.flatpage.content):
+			return render_markdown(self.flatpage.content)
+		return mark_safe(self.content_html)
+
+	def __unicode__(self):
+		return self.flatpage.url
 
 
+# Connect the cache and denormalisation receivers
+from . import signals
@@ -0,0 +1,83 @@
+import base64
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+	pass
+
+
+def encode_cursor(post):
+	raw = '%s|%d' % (post.pub_date.isoformat(), post.pk)
+	return base64.urlsafe_b64encode(raw).rstrip('=')
+
+
+def decode_cursor(token):
+	try:
+		token = str(token)
+		raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+		pub_date, pk = raw.rsplit('|', 1)
+		pub_date, pk = parse_datetime(pub_date), int(pk)
+	except (TypeError, ValueError, UnicodeError):
+		raise InvalidCursor(token)
+	if pub_date is None:
+		raise InvalidCursor(token)
+	return pub_date, pk
+
+
+class KeysetPage(object):
+	"""A page of posts positioned by (pub_date, id) rather than by offset.
+
+	Posts are ordered newest first, matching Post.Meta.ordering, with the
+	primary key as a tie breaker so the order is total.
+	"""
+
+	def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+		self.object_list = object_list
+		self.next_cursor = next_cursor
+		self.previous_cursor = previous_cursor
+
+	def has_next(self):
+		return self.next_cursor is not None
+
+	def has_previous(self):
+		return self.previous_cursor is not None
+
+	def has_other_pages(self):
+		return self.has_next() or self.has_previous()
+
+	def __iter__(self):
+		return iter(self.object_list)
+
+	def __len__(self):
+		return len(self.object_list)
+
+
+def keyset_page(queryset, page_size, after=None, before=None):
+	"""Fetch one page of `queryset` after (older than) or before (newer than)
+	the given cursor tokens. Never counts rows or uses OFFSET.
+	"""
+	if before is not None:
+		pub_date, pk = decode_cursor(before)
+		rows = list(queryset.filter(
+			Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, pk__gt=pk)
+		).order_by('pub_date', 'pk')[:page_size + 1])
+		more = len(rows) > page_size
+		rows = rows[:page_size]
+		rows.reverse()
+		return KeysetPage(rows,
+			next_cursor=encode_cursor(rows[-1]) if rows else before,
+			previous_cursor=encode_cursor(rows[0]) if more else None)
+
+	queryset = queryset.order_by('-pub_date', '-pk')
+	if after is not None:
+		pub_date, pk = decode_cursor(after)
+		queryset = queryset.filter(
+			Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk))
+	rows = list(queryset[:page_size + 1])
+	more = len(rows) > page_size
+	rows = rows[:page_size]
+	return KeysetPage(rows,
+		next_cursor=encode_cursor(rows[-1]) if more else None,
+		previous_cursor=encode_cursor(rows[0]) if (after is not None and rows) else None)
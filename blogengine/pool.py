@@ -0,0 +1,232 @@
+"""
+Pooled database connections.
+
+The backends in blogengine/backends wrap Django's own: opening a
+connection checks one out of a per-process pool, and closing it hands
+it back. With CONN_MAX_AGE = 0, Django closes connections at the end of
+every request, so each request reuses a connection instead of paying
+for a new TCP connection and authentication.
+
+A database's 'POOL' entry configures its pool:
+
+	MIN_SIZE      connections opened when the pool is first used (0)
+	MAX_SIZE      connections open at once; more callers wait (10)
+	TIMEOUT       seconds to wait for a free connection (10)
+	MAX_LIFETIME  seconds before a connection is replaced (3600)
+	CHECK_IDLE    connections idle for longer are tested before use (10)
+
+Pools are created lazily in each process, so gunicorn can fork after
+loading the app. Connections a worker inherits from its parent are left
+alone: closing them would end the parent's sessions too.
+
+pool_stats() reports, per database, how often callers had to wait and
+for how long, and how often the pool ran out.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.db.utils import OperationalError
+
+
+logger = logging.getLogger('blogengine.pool')
+
+
+class PoolExhausted(OperationalError):
+	pass
+
+
+class ConnectionPool(object):
+	def __init__(self, connect, check=None, min_size=0, max_size=10, timeout=10,
+			max_lifetime=3600, check_idle=10):
+		self.connect = connect
+		self.check = check
+		self.max_size = max_size
+		self.timeout = timeout
+		self.max_lifetime = max_lifetime
+		self.check_idle = check_idle
+		self.pid = os.getpid()
+		self.lock = threading.Condition()
+		# (connection, created, returned), the most recently returned last
+		self.idle = []
+		self.created = {}
+		self.size = 0
+		self.stats = dict(checkouts=0, created=0, discarded=0, waits=0,
+			wait_time=0.0, max_wait=0.0, exhausted=0)
+		for i in range(min_size):
+			self.size += 1
+			self.checkin(self.open())
+
+	def open(self):
+		try:
+			conn = self.connect()
+		except Exception:
+			with self.lock:
+				self.size -= 1
+				self.lock.notify()
+			raise
+		with self.lock:
+			self.created[id(conn)] = time.time()
+			self.stats['created'] += 1
+		return conn
+
+	def reserve(self, started):
+		"""Take an idle connection, or room for a new one (None)."""
+		with self.lock:
+			waited = False
+			while True:
+				if self.idle or self.size < self.max_size:
+					break
+				remaining = started + self.timeout - time.time()
+				if remaining <= 0:
+					self.stats['exhausted'] += 1
+					logger.warning('Database connection pool exhausted (%d in use).', self.size)
+					raise PoolExhausted('No database connection became free in %ss.' % self.timeout)
+				if not waited:
+					waited = True
+					self.stats['waits'] += 1
+				self.lock.wait(remaining)
+			if waited:
+				wait = time.time() - started
+				self.stats['wait_time'] += wait
+				self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+			self.stats['checkouts'] += 1
+			if self.idle:
+				return self.idle.pop()
+			self.size += 1
+			return None
+
+	def checkout(self):
+		started = time.time()
+		while True:
+			entry = self.reserve(started)
+			if entry is None:
+				return self.open()
+			conn, created, returned = entry
+			if self.usable(conn, created, returned):
+				return conn
+			self.discard(conn)
+
+	def usable(self, conn, created, returned):
+		now = time.time()
+		if now - created >= self.max_lifetime:
+			return False
+		if self.check is not None and now - returned >= self.check_idle:
+			return self.check(conn)
+		return True
+
+	def checkin(self, conn):
+		with self.lock:
+			created = self.created.get(id(conn), 0)
+			if time.time() - created < self.max_lifetime:
+				self.idle.append((conn, created, time.time()))
+				self.lock.notify()
+				return
+		self.discard(conn)
+
+	def discard(self, conn):
+		try:
+			conn.close()
+		except Exception:
+			pass
+		with self.lock:
+			self.created.pop(id(conn), None)
+			self.size -= 1
+			self.stats['discarded'] += 1
+			self.lock.notify()
+
+	def clear(self):
+		"""Close the idle connections."""
+		with self.lock:
+			idle, self.idle = self.idle, []
+		for conn, created, returned in idle:
+			self.discard(conn)
+
+
+_pools = {}
+_orphans = []
+_lock = threading.Lock()
+
+
+def get_pool(alias, factory):
+	"""This process's pool for `alias`, created with factory() if need be."""
+	pool = _pools.get(alias)
+	if pool is None or pool.pid != os.getpid():
+		with _lock:
+			pool = _pools.get(alias)
+			if pool is None or pool.pid != os.getpid():
+				if pool is not None:
+					# Inherited over fork(); keep its connections from
+					# being garbage collected, and so closed
+					_orphans.append(pool)
+				pool = _pools[alias] = factory()
+	return pool
+
+
+def pool_stats():
+	return dict((alias, dict(pool.stats, size=pool.size, idle=len(pool.idle)))
+		for alias, pool in _pools.items() if pool.pid == os.getpid())
+
+
+def check_connection(conn):
+	try:
+		conn.cursor().execute('SELECT 1')
+	except Exception:
+		return False
+	return True
+
+
+class PooledDatabaseWrapper(object):
+	"""Mixed into a backend's DatabaseWrapper (see blogengine/backends)."""
+
+	def get_pool(self, conn_params):
+		options = self.settings_dict.get('POOL', {})
+		connect = super(PooledDatabaseWrapper, self).get_new_connection
+		return get_pool(self.alias, lambda: ConnectionPool(lambda: connect(conn_params),
+			check=check_connection,
+			min_size=options.get('MIN_SIZE', 0),
+			max_size=options.get('MAX_SIZE', 10),
+			timeout=options.get('TIMEOUT', 10),
+			max_lifetime=options.get('MAX_LIFETIME', 3600),
+			check_idle=options.get('CHECK_IDLE', 10)))
+
+	def get_new_connection(self, conn_params):
+		return self.get_pool(conn_params).checkout()
+
+	def _close(self):
+		if self.connection is None:
+			return
+		pool = _pools.get(self.alias)
+		if pool is not None and pool.pid != os.getpid():
+			# Opened before a fork; not ours to close or reuse
+			_orphans.append(self.connection)
+			return
+		if pool is None:
+			self.connection.close()
+			return
+		conn = self.connection
+		if self.errors_occurred and not self.is_usable():
+			pool.discard(conn)
+			return
+		try:
+			# Don't hand on a transaction left open
+			conn.rollback()
+		except Exception:
+			pool.discard(conn)
+			return
+		pool.checkin(conn)
+
+
+def database_config(url, **pool):
+	"""A pooled DATABASES entry for a PostgreSQL or SQLite `url`.
+
+	The URL is parsed by dj-database-url; `pool` is the 'POOL' entry.
+	"""
+	import dj_database_url
+	config = dj_database_url.parse(url)
+	config['ENGINE'] = config['ENGINE'].replace('django.db.backends.', 'blogengine.backends.')
+	# Hand connections back to the pool at the end of every request
+	config['CONN_MAX_AGE'] = 0
+	config['POOL'] = pool
+	return config
@@ -0,0 +1,287 @@
+"""
+Precomputed "related posts".
+
+Two posts are scored by the weighted Jaccard similarity of their tags,
+each tag weighted by its inverse document frequency so rare tags count
+for more, plus CATEGORY_BOOST when they share a category. The top
+BLOG_RELATED_POSTS neighbours of every post are stored in RelatedPost,
+so the detail page reads them in one query.
+
+Scores are accumulated through the tag -> posts lists (a sparse product
+of the post/tag matrix with itself), so only posts sharing a tag are ever
+compared. Posts related by category alone all score the boost and are
+ranked by date, so only the newest few of each category are considered.
+
+`manage.py rebuild_related_posts` recomputes everything. Between runs,
+update() recomputes the changed posts and merges them into the lists of
+posts near them, loading only the posts involved. The receivers in signals.py queue posts
+changed during a request, and `flush()` updates them once it has
+finished; changes made outside a request are updated right away.
+"""
+import heapq
+import math
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+
+from . import sites
+from .caching import bump_version
+from .models import Post, RelatedPost
+
+
+CATEGORY_BOOST = 0.25
+
+
+def related_count():
+	return getattr(settings, 'BLOG_RELATED_POSTS', 5)
+
+
+class RelatedIndex(object):
+	"""Posts and their tags.
+
+	Every post is loaded, in two queries, unless `post_ids` is given; then
+	only what neighbours() needs for those posts is: the posts sharing a
+	tag with them and the newest posts of their categories. Posts in
+	`others` are loaded without their candidates, for merge().
+	"""
+
+	def __init__(self, post_ids=None, others=()):
+		self.sites, self.categories, self.recency = {}, {}, {}
+		self.category_posts = defaultdict(list)
+		self.tags = defaultdict(set)
+		self.tag_posts = defaultdict(list)
+		if post_ids is None:
+			posts = list(Post.objects.order_by('-pub_date', '-pk').values_list(
+				'id', 'site_id', 'category_id', 'pub_date'))
+			links = list(Post.tags.through.objects.values_list('post_id', 'tag_id'))
+			total, tag_counts = len(posts), None
+		else:
+			posts, links, tag_counts = self.load(post_ids, others)
+			total = Post.objects.count()
+			# Newest first, as the category lists must be
+			posts.sort(key=lambda row: (row[3], row[0]), reverse=True)
+		for post_id, site_id, category_id, pub_date in posts:
+			self.sites[post_id] = site_id
+			self.categories[post_id] = category_id
+			self.recency[post_id] = (pub_date, post_id)
+			if category_id is not None:
+				self.category_posts[category_id].append(post_id)
+		self.single_site = len(set(self.sites.values())) <= 1
+		for post_id, tag_id in links:
+			self.tags[post_id].add(tag_id)
+			self.tag_posts[tag_id].append(post_id)
+		if tag_counts is None:
+			tag_counts = dict((tag_id, len(post_ids)) for tag_id, post_ids in self.tag_posts.items())
+		self.weights = dict((tag_id, math.log(1 + float(total) / tag_count))
+			for tag_id, tag_count in tag_counts.items())
+		self.post_weights = dict((post_id, sum(self.weights[tag_id] for tag_id in tag_ids))
+			for post_id, tag_ids in self.tags.items())
+
+	def load(self, post_ids, others):
+		"""Rows, tag links and tag post counts for `post_ids`' candidates."""
+		through = Post.tags.through
+		candidates, tag_ids, category_ids = set(post_ids) | set(others), set(), set()
+		for ids in chunks(post_ids):
+			tag_ids.update(through.objects.filter(post__in=ids).values_list('tag_id', flat=True))
+			category_ids.update(Post.objects.filter(pk__in=ids).values_list('category_id', flat=True))
+		category_ids.discard(None)
+		for ids in chunks(tag_ids):
+			candidates.update(through.objects.filter(tag__in=ids).values_list('post_id', flat=True))
+		count = related_count()
+		for category_id in category_ids:
+			candidates.update(Post.objects.filter(category=category_id).order_by(
+				'-pub_date', '-pk').values_list('pk', flat=True)[:count + 1])
+
+		posts, links = [], []
+		for ids in chunks(candidates):
+			posts += Post.objects.filter(pk__in=ids).values_list('id', 'site_id', 'category_id', 'pub_date')
+			links += through.objects.filter(post__in=ids).values_list('post_id', 'tag_id')
+		tag_counts = {}
+		for ids in chunks(set(tag_id for post_id, tag_id in links)):
+			for row in through.objects.filter(tag__in=ids).values('tag').annotate(posts=Count('post')):
+				tag_counts[row['tag']] = row['posts']
+		return posts, links, tag_counts
+
+	def __contains__(self, post_id):
+		return post_id in self.sites
+
+	def post_ids(self):
+		return self.sites.keys()
+
+	def neighbours(self, post_id, count):
+		"""The `count` best (related id, score) pairs for a post."""
+		category_id = self.categories[post_id]
+		shared = defaultdict(float)
+		for tag_id in self.tags[post_id]:
+			weight = self.weights[tag_id]
+			for other in self.tag_posts[tag_id]:
+				shared[other] += weight
+		# Beyond the shared-tag posts, only the newest in the category can
+		# make the cut, as they all score just the boost
+		if category_id is not None:
+			for other in self.category_posts[category_id][:count + 1]:
+				shared.setdefault(other, 0.0)
+		shared.pop(post_id, None)
+		if not self.single_site:
+			site_id = self.sites[post_id]
+			for other in [other for other in shared if self.sites[other] != site_id]:
+				del shared[other]
+
+		own_weight = self.post_weights.get(post_id, 0.0)
+		post_weights, categories, recency = self.post_weights, self.categories, self.recency
+		scored = []
+		for other, weight in shared.iteritems():
+			union = own_weight + post_weights.get(other, 0.0) - weight
+			score = weight / union if union else 0.0
+			if category_id is not None and categories[other] == category_id:
+				score += CATEGORY_BOOST
+			scored.append((score, recency[other], other))
+		return [(other, score) for score, newer, other in heapq.nlargest(count, scored)]
+
+	def merge(self, post_id, stored, others, count):
+		"""Merge `others` into a post's stored (related id, score) list.
+
+		Unlike neighbours(), this only scores the posts in `others`, so it
+		is exact as long as nothing else the list depends on has changed.
+		"""
+		category_id = self.categories[post_id]
+		own_weight = self.post_weights.get(post_id, 0.0)
+		scored = [(score, self.recency[other], other) for other, score in stored if other not in others]
+		for other in others:
+			if other == post_id or self.sites[other] != self.sites[post_id]:
+				continue
+			weight = sum(self.weights[tag_id] for tag_id in self.tags[post_id] & self.tags[other])
+			same_category = category_id is not None and self.categories[other] == category_id
+			# The same candidates as neighbours() would consider
+			if not weight and not (same_category
+					and other in self.category_posts[category_id][:count + 1]):
+				continue
+			union = own_weight + self.post_weights.get(other, 0.0) - weight
+			score = weight / union if union else 0.0
+			if same_category:
+				score += CATEGORY_BOOST
+			scored.append((score, self.recency[other], other))
+		return [(other, score) for score, newer, other in heapq.nlargest(count, scored)]
+
+
+def chunks(values, size=500):
+	values = list(values)
+	for start in range(0, len(values), size):
+		yield values[start:start + size]
+
+
+@transaction.atomic
+def rebuild():
+	"""Recompute the neighbours of every post. Returns the number of rows."""
+	index = RelatedIndex()
+	count = related_count()
+	RelatedPost.objects.all().delete()
+	rows = [RelatedPost(post_id=post_id, related_id=other, score=score, rank=rank)
+		for post_id in index.post_ids()
+		for rank, (other, score) in enumerate(index.neighbours(post_id, count))]
+	RelatedPost.objects.bulk_create(rows)
+	# Every post page carries this group
+	for site_id in sites.site_ids():
+		bump_version('related', site_id)
+	return len(rows)
+
+
+def affected_by(post_ids):
+	"""Posts whose neighbours may change when `post_ids` change.
+
+	Returns the posts to recompute, the changed posts and those listing
+	them, and the posts the changed ones might now get into: those sharing
+	a tag with one, and in a category where one is among the newest, those
+	whose lists a post scoring just CATEGORY_BOOST could get into.
+	"""
+	through = Post.tags.through
+	count = related_count()
+	recompute, merge, tag_ids = set(), set(), set()
+	categories = defaultdict(set)
+	for ids in chunks(post_ids):
+		for post_id, category_id in Post.objects.filter(pk__in=ids).values_list('pk', 'category_id'):
+			recompute.add(post_id)
+			if category_id is not None:
+				categories[category_id].add(post_id)
+		recompute.update(RelatedPost.objects.filter(related__in=ids).values_list('post_id', flat=True))
+		tag_ids.update(through.objects.filter(post__in=ids).values_list('tag_id', flat=True))
+	for ids in chunks(tag_ids):
+		merge.update(through.objects.filter(tag__in=ids).values_list('post_id', flat=True))
+	for category_id, changed in categories.items():
+		posts = Post.objects.filter(category=category_id)
+		if not changed.intersection(posts.order_by('-pub_date', '-pk').values_list('pk', flat=True)[:count + 1]):
+			continue
+		full = RelatedPost.objects.filter(post__category=category_id).values('post').annotate(
+			rows=Count('pk'), lowest=Min('score')).filter(rows__gte=count, lowest__gt=CATEGORY_BOOST)
+		full = set(row['post'] for row in full)
+		merge.update(post_id for post_id in posts.values_list('pk', flat=True) if post_id not in full)
+	return recompute, merge - recompute
+
+
+@transaction.atomic
+def update(post_ids):
+	"""Bring the neighbours of changed posts, and of posts near them, up to date.
+
+	The changed posts and the posts listing them are recomputed; other
+	posts the changed ones might now get into have them merged into their
+	stored lists. Tag weights, and the older posts of a category, drift a
+	little that way; they are only brought fully up to date by rebuild().
+	"""
+	post_ids = set(post_ids)
+	if not post_ids:
+		return
+	recompute, merge = affected_by(post_ids)
+	current, listed = defaultdict(list), set()
+	for ids in chunks(recompute | merge):
+		for post_id, other, score in RelatedPost.objects.filter(post__in=ids).values_list(
+				'post_id', 'related_id', 'score'):
+			current[post_id].append((other, score))
+			listed.add(other)
+	index = RelatedIndex(recompute, others=merge | listed)
+	changed_posts = set(post_id for post_id in post_ids if post_id in index)
+
+	count = related_count()
+
+	changed, rows = [], []
+	for post_id in recompute | merge:
+		if post_id in recompute:
+			neighbours = index.neighbours(post_id, count)
+		else:
+			neighbours = index.merge(post_id, current[post_id], changed_posts, count)
+		if [other for other, score in neighbours] != [other for other, score in current[post_id]]:
+			changed.append(post_id)
+			rows += [RelatedPost(post_id=post_id, related_id=other, score=score, rank=rank)
+				for rank, (other, score) in enumerate(neighbours)]
+	for ids in chunks(changed):
+		RelatedPost.objects.filter(post__in=ids).delete()
+	RelatedPost.objects.bulk_create(rows)
+	for ids in chunks(changed):
+		for slug, site_id in Post.objects.filter(pk__in=ids).values_list('slug', 'site_id'):
+			bump_version('post:%s' % slug, site_id)
+
+
+_pending = threading.local()
+
+def queue(post_ids):
+	"""Update posts when the current request finishes, or now outside one."""
+	pending = getattr(_pending, 'post_ids', None)
+	if pending is None:
+		update(post_ids)
+	else:
+		pending.update(post_ids)
+
+
+def discard():
+	"""Start queueing, as a request starts."""
+	_pending.post_ids = set()
+
+
+def flush():
+	"""Update the posts queued since discard(), and stop queueing."""
+	post_ids = getattr(_pending, 'post_ids', None)
+	_pending.post_ids = None
+	if post_ids:
+		update(post_ids)
@@ -0,0 +1,103 @@
+"""
+Read replicas for the public pages.
+
+ReplicaMiddleware picks a replica for GET requests to the blog and flat
+page views, and ReplicaRouter sends that request's reads to it. Writes,
+the admin and everything else use 'default'. Replicas are taken in turn;
+one that can't be connected to, or fails a query, is skipped for
+BLOG_REPLICA_RETRY seconds.
+
+Replicas lag behind the primary, so for BLOG_REPLICA_LAG seconds after
+content changes (bump_version calls pin_primary) all reads stay on the
+primary. Editors see their own changes straight away, and pages rendered
+again because of a change are never cached from a stale replica.
+"""
+import itertools
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+
+PINNED_KEY = 'blogengine:primary-pinned'
+
+_local = threading.local()
+
+
+def replica_aliases():
+	return list(getattr(settings, 'BLOG_READ_REPLICAS', ()))
+
+
+class ReplicaPool(object):
+	def __init__(self):
+		self.aliases = None
+		self.ejected = {}
+
+	def choose(self):
+		"""The next healthy replica, or None if there isn't one."""
+		aliases = replica_aliases()
+		if aliases != self.aliases:
+			self.aliases = aliases
+			self.cycle = itertools.cycle(aliases)
+		now = time.time()
+		for i in range(len(aliases)):
+			alias = next(self.cycle)
+			if self.ejected.get(alias, 0) > now:
+				continue
+			try:
+				connections[alias].ensure_connection()
+			except DatabaseError:
+				self.eject(alias)
+				continue
+			return alias
+		return None
+
+	def eject(self, alias):
+		self.ejected[alias] = time.time() + getattr(settings, 'BLOG_REPLICA_RETRY', 30)
+
+
+pool = ReplicaPool()
+
+
+def pin_primary():
+	"""Keep reads on the primary until the replicas have caught up."""
+	if replica_aliases():
+		cache.set(PINNED_KEY, True, getattr(settings, 'BLOG_REPLICA_LAG', 5))
+
+
+def read_from_replica():
+	"""Send this thread's reads to a replica. Returns its alias, or None."""
+	alias = None
+	if replica_aliases() and not cache.get(PINNED_KEY):
+		alias = pool.choose()
+	_local.alias = alias
+	return alias
+
+
+def read_from_primary():
+	_local.alias = None
+
+
+def current_replica():
+	return getattr(_local, 'alias', None)
+
+
+class ReplicaRouter(object):
+	def db_for_read(self, model, **hints):
+		# Not None: Django would otherwise read related objects from
+		# wherever their instance came from, replica or not
+		return current_replica() or DEFAULT_DB_ALIAS
+
+	def db_for_write(self, model, **hints):
+		return DEFAULT_DB_ALIAS
+
+	def allow_relation(self, obj1, obj2, **hints):
+		return True
+
+	def allow_syncdb(self, db, model):
+		# Replicas get their tables from the primary
+		if db in replica_aliases():
+			return False
+		return None
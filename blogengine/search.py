@@ -0,0 +1,283 @@
+"""
+Full-text search over posts.
+
+The index lives in the database next to the posts: a weighted tsvector
+column with a GIN index on PostgreSQL, or an FTS5 virtual table on SQLite
+(both created by migration 0015). Elsewhere, posts are indexed in
+segment files under BLOG_SEARCH_INDEX_DIR (see segments.py). Signals in
+signals.py keep the index current as posts are saved and deleted;
+`manage.py rebuild_search_index` refills it.
+"""
+import fcntl
+import os
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+
+from .models import Post
+from .segments import SegmentIndex, SegmentWriter, tokenize
+from .sites import current_site_id
+
+
+FTS_TABLE = 'blogengine_post_fts'
+
+
+class SearchResults(object):
+	"""A lazy, ranked result list that Paginator can count and slice.
+
+	Only the ids of the requested page are read from the index; the posts
+	themselves are fetched afterwards in one query.
+	"""
+
+	def __init__(self, backend, query):
+		self.backend = backend
+		self.terms = tokenize(query)
+		self._count = None
+
+	def count(self):
+		if self._count is None:
+			self._count = self.backend.count(self.terms) if self.terms else 0
+		return self._count
+
+	def ranked_ids(self, offset, limit):
+		return self.backend.ranked_ids(self.terms, offset, limit)
+
+	def __len__(self):
+		return self.count()
+
+	def __getitem__(self, index):
+		if not isinstance(index, slice):
+			return self[index:index + 1][0]
+		start = index.start or 0
+		stop = self.count() if index.stop is None else index.stop
+		if not self.count() or stop <= start:
+			return []
+		ids = self.ranked_ids(start, stop - start)
+		posts = Post.on_site.for_listing().in_bulk(ids)
+		return [posts[pk] for pk in ids if pk in posts]
+
+
+class SearchBackend(object):
+	def search(self, query):
+		return SearchResults(self, query)
+
+	def index_post(self, post):
+		raise NotImplementedError
+
+	def remove_post(self, post_id):
+		raise NotImplementedError
+
+	def rebuild(self):
+		raise NotImplementedError
+
+	def _fetch(self, sql, params):
+		cursor = connection.cursor()
+		cursor.execute(sql, params)
+		return cursor.fetchall()
+
+
+class PostgresSearchBackend(SearchBackend):
+	# Titles weigh more than body text when ranking
+	VECTOR = ("setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+		"setweight(to_tsvector('english', coalesce(text, '')), 'B')")
+
+	def tsquery(self, terms):
+		return ' & '.join(terms)
+
+	def count(self, terms):
+		return self._fetch("SELECT count(*) FROM blogengine_post "
+			"WHERE search_vector @@ to_tsquery('english', %s) AND site_id = %s",
+			[self.tsquery(terms), current_site_id()])[0][0]
+
+	def ranked_ids(self, terms, offset, limit):
+		rows = self._fetch("SELECT id FROM blogengine_post, to_tsquery('english', %s) query "
+			"WHERE search_vector @@ query AND site_id = %s "
+			"ORDER BY ts_rank_cd(search_vector, query) DESC, pub_date DESC "
+			"LIMIT %s OFFSET %s", [self.tsquery(terms), current_site_id(), limit, offset])
+		return [row[0] for row in rows]
+
+	def index_post(self, post):
+		connection.cursor().execute("UPDATE blogengine_post SET search_vector = "
+			+ self.VECTOR + " WHERE id = %s", [post.pk])
+
+	def remove_post(self, post_id):
+		# The vector is a column of the deleted row
+		pass
+
+	def rebuild(self):
+		connection.cursor().execute("UPDATE blogengine_post SET search_vector = " + self.VECTOR)
+
+
+class SqliteSearchBackend(SearchBackend):
+	def match(self, terms):
+		# Quoted terms are matched literally, so user input can't inject
+		# FTS operators; adjacent terms are ANDed.
+		return ' '.join('"%s"' % term for term in terms)
+
+	def count(self, terms):
+		return self._fetch("SELECT count(*) FROM %s JOIN blogengine_post post ON post.id = %s.rowid "
+			"WHERE %s MATCH %%s AND post.site_id = %%s" % (FTS_TABLE, FTS_TABLE, FTS_TABLE),
+			[self.match(terms), current_site_id()])[0][0]
+
+	def ranked_ids(self, terms, offset, limit):
+		rows = self._fetch("SELECT post.id FROM %s JOIN blogengine_post post ON post.id = %s.rowid "
+			"WHERE %s MATCH %%s AND post.site_id = %%s "
+			"ORDER BY bm25(%s, 10.0, 1.0) LIMIT %%s OFFSET %%s" % ((FTS_TABLE,) * 4),
+			[self.match(terms), current_site_id(), limit, offset])
+		return [row[0] for row in rows]
+
+	def index_post(self, post):
+		connection.cursor().execute("INSERT OR REPLACE INTO %s (rowid, title, text) "
+			"VALUES (%%s, %%s, %%s)" % FTS_TABLE, [post.pk, post.title, post.text])
+
+	def remove_post(self, post_id):
+		connection.cursor().execute("DELETE FROM %s WHERE rowid = %%s" % FTS_TABLE, [post_id])
+
+	def rebuild(self):
+		cursor = connection.cursor()
+		cursor.execute("DELETE FROM %s" % FTS_TABLE)
+		cursor.execute("INSERT INTO %s (rowid, title, text) "
+			"SELECT id, title, text FROM blogengine_post" % FTS_TABLE)
+
+
+class SegmentResults(SearchResults):
+	"""Results ranked entirely from the segment index."""
+
+	def __init__(self, ids):
+		self.ids = ids
+
+	def count(self):
+		return len(self.ids)
+
+	def ranked_ids(self, offset, limit):
+		return self.ids[offset:offset + limit]
+
+
+class SegmentSearchBackend(SearchBackend):
+	"""Search through per-site segment files, for databases without FTS.
+
+	Queries support "phrases", OR and -excluded words, and only the final
+	page of ids goes to the database. Each save writes a small segment;
+	once a site has more than `merge_factor` of them the smallest are
+	merged, in a background thread unless `background` is off.
+	"""
+
+	def __init__(self, path, merge_factor=10, background=True):
+		self.path = path
+		self.merge_factor = merge_factor
+		self.background = background
+		self._indexes = {}
+		self._merging = threading.Lock()
+
+	def site_index(self, site_id):
+		if site_id not in self._indexes:
+			self._indexes[site_id] = SegmentIndex(os.path.join(self.path, 'site-%d' % site_id))
+		return self._indexes[site_id]
+
+	def site_indexes(self):
+		if os.path.isdir(self.path):
+			for name in os.listdir(self.path):
+				if name.startswith('site-'):
+					self.site_index(int(name[len('site-'):]))
+		return self._indexes.values()
+
+	def lock(self):
+		"""An exclusive lock on the index, shared with other processes."""
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+		return IndexLock(os.path.join(self.path, 'lock'))
+
+	def search(self, query):
+		return SegmentResults(self.site_index(current_site_id()).search(query))
+
+	def index_post(self, post):
+		writer = SegmentWriter()
+		writer.add(post.pk, post.title, post.text)
+		with self.lock():
+			# The post may have moved here from another site
+			for index in self.site_indexes():
+				index.delete([post.pk])
+			self.site_index(post.site_id).add(writer)
+		self.maybe_merge(post.site_id)
+
+	def remove_post(self, post_id):
+		with self.lock():
+			for index in self.site_indexes():
+				index.delete([post_id])
+
+	def maybe_merge(self, site_id):
+		index = self.site_index(site_id)
+		if len(index.manifest()['segments']) <= self.merge_factor:
+			return
+		if not self.background:
+			self.merge(index, self.merge_factor)
+		elif self._merging.acquire(False):
+			def merge():
+				try:
+					self.merge(index, self.merge_factor)
+				finally:
+					self._merging.release()
+			thread = threading.Thread(target=merge, name='search-segment-merge')
+			thread.daemon = True
+			thread.start()
+
+	def merge(self, index, count=None):
+		with self.lock():
+			return index.merge(count)
+
+	def rebuild(self, batch_size=5000):
+		with self.lock():
+			for index in self.site_indexes():
+				index.clear()
+			writers = {}
+			posts = Post.objects.order_by().values_list('id', 'site_id', 'title', 'text')
+			for post_id, site_id, title, text in posts.iterator():
+				writer = writers.setdefault(site_id, SegmentWriter())
+				writer.add(post_id, title, text)
+				if len(writer) >= batch_size:
+					self.site_index(site_id).add(writers.pop(site_id))
+			for site_id, writer in writers.items():
+				self.site_index(site_id).add(writer)
+			for index in self.site_indexes():
+				index.merge()
+
+
+class IndexLock(object):
+	def __init__(self, path):
+		self.path = path
+
+	def __enter__(self):
+		self.file = open(self.path, 'a')
+		fcntl.flock(self.file, fcntl.LOCK_EX)
+		return self
+
+	def __exit__(self, *exc_info):
+		fcntl.flock(self.file, fcntl.LOCK_UN)
+		self.file.close()
+
+
+def sqlite_has_fts_table():
+	try:
+		return bool(connection.cursor().execute(
+			"SELECT 1 FROM sqlite_master WHERE name = %s", [FTS_TABLE]).fetchall())
+	except DatabaseError:
+		return False
+
+
+_backend = None
+
+def get_backend():
+	global _backend
+	if _backend is None:
+		if connection.vendor == 'postgresql':
+			_backend = PostgresSearchBackend()
+		elif connection.vendor == 'sqlite' and sqlite_has_fts_table():
+			_backend = SqliteSearchBackend()
+		else:
+			_backend = SegmentSearchBackend(settings.BLOG_SEARCH_INDEX_DIR)
+	return _backend
+
+
+def search_posts(query):
+	return get_backend().search(query)
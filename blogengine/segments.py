@@ -0,0 +1,438 @@
+"""
+A pure-Python inverted index of posts, kept in immutable on-disk segments.
+
+Used for search when the database has no full-text support of its own.
+Each site has a directory of segment files and a manifest.json naming the
+live segments and the posts deleted from each since it was written.
+Saving a post writes a new one-post segment and marks the old copy
+deleted; merging folds many small segments into one and drops deleted
+posts for good.
+
+A segment file is laid out as
+
+    header      magic, doc count, term count, blob lengths
+    doc ids     sorted uint32 array of the posts in the segment
+    offsets     three uint32 arrays (terms, docs, positions), nterms + 1 each
+    terms       the sorted UTF-8 terms, back to back
+    docs        per term: (doc id delta, title tf, total tf) as varints
+    positions   per term and doc: position deltas as varints
+
+and is read through mmap, so only the pages a query touches are loaded.
+Titles are positioned before the text with a gap, so phrases can't
+straddle the two.
+"""
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import tempfile
+from array import array
+
+
+MAGIC = 'BSG1'
+HEADER = struct.Struct('=4sIIIII')
+UINT = struct.Struct('=I')
+
+TITLE_WEIGHT = 10
+MAX_TERM_LENGTH = 64
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+QUERY_RE = re.compile(r'-?"[^"]*"?|\S+', re.UNICODE)
+
+
+def tokenize(text):
+	return [word for word in WORD_RE.findall(text.lower()) if len(word) <= MAX_TERM_LENGTH]
+
+
+def encode_varints(values, out):
+	for value in values:
+		while value > 0x7f:
+			out.append((value & 0x7f) | 0x80)
+			value >>= 7
+		out.append(value)
+
+
+def decode_varints(data):
+	values = array('I')
+	append = values.append
+	value = shift = 0
+	for byte in bytearray(data):
+		value |= (byte & 0x7f) << shift
+		if byte & 0x80:
+			shift += 7
+		else:
+			append(value)
+			value = shift = 0
+	return values
+
+
+def parse_query(query):
+	"""Split a query into clauses that must all match, and excluded items.
+
+	Words and "quoted phrases" are items; every clause is a list of items
+	of which one must match, so `django OR flask cache` is two clauses.
+	An item prefixed with - excludes posts matching it.
+	"""
+	clauses, excluded = [], []
+	join = False
+	for token in QUERY_RE.findall(query):
+		if token == 'OR':
+			join = bool(clauses)
+			continue
+		negate = token.startswith('-')
+		item = tuple(tokenize(token))
+		if not item:
+			continue
+		if negate:
+			excluded.append(item)
+		elif join:
+			clauses[-1].append(item)
+		else:
+			clauses.append([item])
+		join = False
+	return clauses, excluded
+
+
+def write_atomic(path, content):
+	fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+	try:
+		with os.fdopen(fd, 'wb') as temp:
+			temp.write(content)
+		os.rename(temp_path, path)
+	except Exception:
+		os.unlink(temp_path)
+		raise
+
+
+class SegmentWriter(object):
+	"""Collects postings in memory and writes them out as one segment."""
+
+	def __init__(self):
+		self.postings = {}
+		self.doc_ids = []
+
+	def __len__(self):
+		return len(self.doc_ids)
+
+	def add(self, doc_id, title, text):
+		title_terms = tokenize(title)
+		positions = {}
+		for position, term in enumerate(title_terms):
+			positions.setdefault(term, []).append(position)
+		title_tf = dict((term, len(found)) for term, found in positions.items())
+		for position, term in enumerate(tokenize(text), len(title_terms) + 1):
+			positions.setdefault(term, []).append(position)
+		for term, found in positions.iteritems():
+			self.postings.setdefault(term, []).append((doc_id, title_tf.get(term, 0), found))
+		self.doc_ids.append(doc_id)
+
+	def write(self, path):
+		write_segment(path, sorted(self.doc_ids), (
+			(term.encode('utf-8'), sorted(self.postings[term]))
+			for term in sorted(self.postings, key=lambda term: term.encode('utf-8'))))
+
+
+def write_segment(path, doc_ids, postings):
+	"""Write (term, [(doc id, title tf, positions)]) pairs, sorted by term."""
+	terms, docs, positions = bytearray(), bytearray(), bytearray()
+	term_offsets, doc_offsets, position_offsets = array('I', [0]), array('I', [0]), array('I', [0])
+	for term, term_postings in postings:
+		previous = 0
+		for doc_id, title_tf, found in term_postings:
+			encode_varints((doc_id - previous, title_tf, len(found)), docs)
+			encode_varints([b - a for a, b in zip([0] + found, found)], positions)
+			previous = doc_id
+		terms.extend(term)
+		term_offsets.append(len(terms))
+		doc_offsets.append(len(docs))
+		position_offsets.append(len(positions))
+	header = HEADER.pack(MAGIC, len(doc_ids), len(term_offsets) - 1,
+		len(terms), len(docs), len(positions))
+	write_atomic(path, ''.join([header, array('I', doc_ids).tostring(),
+		term_offsets.tostring(), doc_offsets.tostring(), position_offsets.tostring(),
+		str(terms), str(docs), str(positions)]))
+
+
+class Segment(object):
+	"""Read-only, memory-mapped view of one segment file."""
+
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as segment_file:
+			self.map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.doc_count, self.term_count, terms_length, docs_length, positions_length = \
+			HEADER.unpack_from(self.map, 0)
+		if magic != MAGIC:
+			raise ValueError('%s is not a search segment.' % path)
+		offset = HEADER.size
+		self.doc_ids_at = offset
+		offset += self.doc_count * UINT.size
+		self.term_offsets_at = offset
+		self.doc_offsets_at = offset + (self.term_count + 1) * UINT.size
+		self.position_offsets_at = offset + 2 * (self.term_count + 1) * UINT.size
+		self.terms_at = offset + 3 * (self.term_count + 1) * UINT.size
+		self.docs_at = self.terms_at + terms_length
+		self.positions_at = self.docs_at + docs_length
+
+	def _uint(self, start, index):
+		return UINT.unpack_from(self.map, start + index * UINT.size)[0]
+
+	def doc_id(self, index):
+		return self._uint(self.doc_ids_at, index)
+
+	def contains(self, doc_id):
+		low, high = 0, self.doc_count
+		while low < high:
+			middle = (low + high) // 2
+			if self.doc_id(middle) < doc_id:
+				low = middle + 1
+			else:
+				high = middle
+		return low < self.doc_count and self.doc_id(low) == doc_id
+
+	def term(self, index):
+		return self.map[self.terms_at + self._uint(self.term_offsets_at, index):
+			self.terms_at + self._uint(self.term_offsets_at, index + 1)]
+
+	def find(self, term):
+		"""Index of a UTF-8 encoded term, or None."""
+		low, high = 0, self.term_count
+		while low < high:
+			middle = (low + high) // 2
+			if self.term(middle) < term:
+				low = middle + 1
+			else:
+				high = middle
+		if low < self.term_count and self.term(low) == term:
+			return low
+		return None
+
+	def docs(self, index, deleted=()):
+		"""Return {doc id: (title tf, total tf)} for a term."""
+		raw = decode_varints(self.map[self.docs_at + self._uint(self.doc_offsets_at, index):
+			self.docs_at + self._uint(self.doc_offsets_at, index + 1)])
+		docs, doc_id = {}, 0
+		for i in xrange(0, len(raw), 3):
+			doc_id += raw[i]
+			if doc_id not in deleted:
+				docs[doc_id] = (raw[i + 1], raw[i + 2])
+		return docs
+
+	def postings(self, index):
+		"""Yield (doc id, title tf, positions) for a term."""
+		raw = decode_varints(self.map[self.docs_at + self._uint(self.doc_offsets_at, index):
+			self.docs_at + self._uint(self.doc_offsets_at, index + 1)])
+		deltas = decode_varints(self.map[self.positions_at + self._uint(self.position_offsets_at, index):
+			self.positions_at + self._uint(self.position_offsets_at, index + 1)])
+		doc_id = start = 0
+		for i in xrange(0, len(raw), 3):
+			doc_id += raw[i]
+			positions, position = [], 0
+			for delta in deltas[start:start + raw[i + 2]]:
+				position += delta
+				positions.append(position)
+			start += raw[i + 2]
+			yield doc_id, raw[i + 1], positions
+
+	def terms(self):
+		for index in xrange(self.term_count):
+			yield self.term(index), index
+
+
+class SegmentIndex(object):
+	"""The segments of one site's index.
+
+	Reads are safe from any thread or process. Methods that change the
+	index must be called with the caller holding a lock on it.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self.manifest_path = os.path.join(path, 'manifest.json')
+		self._manifest_stat = None
+		self._manifest = {'next': 1, 'segments': []}
+		self._segments = {}
+
+	def manifest(self):
+		"""The current manifest, reread when another process changed it."""
+		try:
+			stat = os.stat(self.manifest_path)
+		except OSError:
+			return self._manifest
+		key = (stat.st_ino, stat.st_mtime, stat.st_size)
+		if key != self._manifest_stat:
+			with open(self.manifest_path) as manifest_file:
+				self._manifest = json.load(manifest_file)
+			self._manifest_stat = key
+			# Segments no longer listed are closed once unreferenced
+			names = set(entry['name'] for entry in self._manifest['segments'])
+			for name in list(self._segments):
+				if name not in names:
+					del self._segments[name]
+		return self._manifest
+
+	def save_manifest(self, manifest):
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+		write_atomic(self.manifest_path, json.dumps(manifest))
+		self._manifest_stat = None
+
+	def segment(self, name):
+		if name not in self._segments:
+			self._segments[name] = Segment(os.path.join(self.path, name))
+		return self._segments[name]
+
+	def live(self):
+		"""(segment, deleted doc ids) for every live segment."""
+		return [(self.segment(entry['name']), frozenset(entry['deleted']))
+			for entry in self.manifest()['segments']]
+
+	def doc_count(self):
+		return sum(segment.doc_count - len(deleted) for segment, deleted in self.live())
+
+	def add(self, writer):
+		"""Write the documents collected by a SegmentWriter as a new segment."""
+		if not len(writer):
+			return
+		manifest = self.manifest()
+		name = '%08d.seg' % manifest['next']
+		if not os.path.isdir(self.path):
+			os.makedirs(self.path)
+		writer.write(os.path.join(self.path, name))
+		manifest = dict(manifest, next=manifest['next'] + 1,
+			segments=manifest['segments'] + [{'name': name, 'deleted': []}])
+		self.save_manifest(manifest)
+
+	def delete(self, doc_ids):
+		manifest = self.manifest()
+		segments, changed = [], False
+		for entry in manifest['segments']:
+			segment = self.segment(entry['name'])
+			gone = [doc_id for doc_id in doc_ids
+				if doc_id not in entry['deleted'] and segment.contains(doc_id)]
+			if gone:
+				entry = dict(entry, deleted=entry['deleted'] + gone)
+				changed = True
+			segments.append(entry)
+		if changed:
+			self.save_manifest(dict(manifest, segments=segments))
+
+	def merge(self, count=None):
+		"""Merge the `count` smallest segments (default all) into one.
+
+		Postings are merged term by term, so memory use is bounded by the
+		longest posting list rather than the size of the index.
+		"""
+		manifest = self.manifest()
+		entries = sorted(manifest['segments'],
+			key=lambda entry: self.segment(entry['name']).doc_count)[:count]
+		if len(entries) < 2:
+			return False
+		sources = [(self.segment(entry['name']), set(entry['deleted'])) for entry in entries]
+		doc_ids = sorted(segment.doc_id(i) for segment, deleted in sources
+			for i in xrange(segment.doc_count) if segment.doc_id(i) not in deleted)
+
+		def merged_postings():
+			terms = {}
+			for number, (segment, deleted) in enumerate(sources):
+				for term, index in segment.terms():
+					terms.setdefault(term, []).append((number, index))
+			for term in sorted(terms):
+				postings = []
+				for number, index in terms[term]:
+					segment, deleted = sources[number]
+					postings.extend(posting for posting in segment.postings(index)
+						if posting[0] not in deleted)
+				if postings:
+					postings.sort()
+					yield term, postings
+
+		name = '%08d.seg' % manifest['next']
+		merged_names = set(entry['name'] for entry in entries)
+		segments = [entry for entry in manifest['segments'] if entry['name'] not in merged_names]
+		if doc_ids:
+			write_segment(os.path.join(self.path, name), doc_ids, merged_postings())
+			segments.append({'name': name, 'deleted': []})
+		self.save_manifest(dict(manifest, next=manifest['next'] + 1, segments=segments))
+		for entry in entries:
+			os.unlink(os.path.join(self.path, entry['name']))
+		return True
+
+	def clear(self):
+		manifest = self.manifest()
+		self.save_manifest(dict(manifest, segments=[]))
+		for entry in manifest['segments']:
+			os.unlink(os.path.join(self.path, entry['name']))
+
+	def search(self, query):
+		"""Return matching doc ids, best match first.
+
+		Posts are scored by a tf-idf sum over the matched items, with title
+		hits weighted TITLE_WEIGHT times; ties go to the newer (higher) id.
+		"""
+		clauses, excluded = parse_query(query)
+		if not clauses:
+			return []
+		live = self.live()
+		items = set(item for clause in clauses for item in clause) | set(excluded)
+		# {item: {doc id: (title tf, total tf)}}, over all segments
+		matches = dict((item, {}) for item in items)
+		for segment, deleted in live:
+			for item in items:
+				matches[item].update(self.match_item(segment, deleted, item))
+
+		candidates = None
+		for clause in clauses:
+			docs = set()
+			for item in clause:
+				docs.update(matches[item])
+			candidates = docs if candidates is None else candidates & docs
+		for item in excluded:
+			candidates.difference_update(matches[item])
+
+		total = max(sum(segment.doc_count - len(deleted) for segment, deleted in live), 1)
+		weights = []
+		for item in set(item for clause in clauses for item in clause):
+			if matches[item]:
+				weights.append((matches[item], math.log(1 + float(total) / len(matches[item]))))
+		scores = []
+		for doc_id in candidates:
+			score = 0.0
+			for docs, idf in weights:
+				if doc_id in docs:
+					title_tf, tf = docs[doc_id]
+					weighted = (TITLE_WEIGHT - 1) * title_tf + tf
+					score += idf * weighted / (weighted + 1.2)
+			scores.append((-score, -doc_id))
+		scores.sort()
+		return [-doc_id for score, doc_id in scores]
+
+	def match_item(self, segment, deleted, item):
+		indexes = [segment.find(term.encode('utf-8')) for term in item]
+		if None in indexes:
+			return {}
+		if len(item) == 1:
+			return segment.docs(indexes[0], deleted)
+		# A phrase: intersect the docs, then line up the positions
+		docs = None
+		for index in set(indexes):
+			found = segment.docs(index, deleted)
+			docs = found if docs is None else dict(
+				(doc_id, counts) for doc_id, counts in docs.iteritems() if doc_id in found)
+		if not docs:
+			return {}
+		positions = {}
+		for index in set(indexes):
+			positions[index] = dict((doc_id, found) for doc_id, title_tf, found
+				in segment.postings(index) if doc_id in docs)
+		matched = {}
+		for doc_id in docs:
+			starts = set(positions[indexes[0]][doc_id])
+			for offset, index in enumerate(indexes[1:], 1):
+				starts &= set(position - offset for position in positions[index][doc_id])
+			if starts:
+				title_tf = min(docs[doc_id][0], len(starts))
+				matched[doc_id] = (title_tf, len(starts))
+		return matched
@@ -0,0 +1,110 @@
+"""
+Cached, database-backed sessions that are written as rarely as possible.
+
+As with django.contrib.sessions.backends.cached_db, sessions are read
+from the cache and only fall back to django_session when they aren't
+there. Saving is coalesced: a session whose data is the same as when it
+was loaded is not written again until half of its stored lifetime has
+passed. Admin requests that merely touch the session, or
+SESSION_SAVE_EVERY_REQUEST's sliding expiry, cost no write on most
+requests.
+
+Use it with SESSION_ENGINE = 'blogengine.sessions'. `manage.py
+cleanup_sessions` deletes expired rows.
+"""
+import copy
+import datetime
+import logging
+
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.core.cache import get_cache
+from django.core.exceptions import SuspiciousOperation
+from django.db import IntegrityError, router, transaction
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+
+KEY_PREFIX = 'blogengine.sessions:'
+
+
+def session_cache():
+	return get_cache(settings.SESSION_CACHE_ALIAS)
+
+
+class SessionStore(DBStore):
+	def __init__(self, session_key=None):
+		super(SessionStore, self).__init__(session_key)
+		# (data, expiry date) as last read from or written to the database
+		self._stored = None
+
+	@property
+	def cache_key(self):
+		return KEY_PREFIX + self._get_or_create_session_key()
+
+	def load(self):
+		try:
+			stored = session_cache().get(self.cache_key)
+		except Exception:
+			# Memcached rejects some keys; treat them as unknown
+			stored = None
+		if stored is None:
+			try:
+				session = Session.objects.get(session_key=self.session_key,
+					expire_date__gt=timezone.now())
+				stored = (self.decode(session.session_data), session.expire_date)
+			except (Session.DoesNotExist, SuspiciousOperation) as e:
+				if isinstance(e, SuspiciousOperation):
+					logger = logging.getLogger('django.security.%s' % e.__class__.__name__)
+					logger.warning(force_text(e))
+				self.create()
+				return {}
+			session_cache().set(self.cache_key, stored, self.get_expiry_age(expiry=stored[1]))
+		data, expire_date = stored
+		self._stored = (copy.deepcopy(data), expire_date)
+		return data
+
+	def is_stored(self, data):
+		"""Whether the database already has `data`, with time to spare."""
+		if self._stored is None:
+			return False
+		stored_data, expire_date = self._stored
+		remaining = expire_date - timezone.now()
+		return (stored_data == data
+			and remaining > datetime.timedelta(seconds=self.get_expiry_age() // 2))
+
+	def save(self, must_create=False):
+		data = self._get_session(no_load=must_create)
+		if not must_create and self.is_stored(data):
+			return
+		session = Session(session_key=self._get_or_create_session_key(),
+			session_data=self.encode(data), expire_date=self.get_expiry_date())
+		using = router.db_for_write(Session, instance=session)
+		try:
+			with transaction.atomic(using=using):
+				session.save(force_insert=must_create, using=using)
+		except IntegrityError:
+			if must_create:
+				raise CreateError
+			raise
+		self._stored = (copy.deepcopy(data), session.expire_date)
+		session_cache().set(self.cache_key, (data, session.expire_date), self.get_expiry_age())
+
+	def exists(self, session_key):
+		if (KEY_PREFIX + session_key) in session_cache():
+			return True
+		return super(SessionStore, self).exists(session_key)
+
+	def delete(self, session_key=None):
+		super(SessionStore, self).delete(session_key)
+		if session_key is None:
+			if self.session_key is None:
+				return
+			session_key = self.session_key
+		session_cache().delete(KEY_PREFIX + session_key)
+		self._stored = None
+
+
+# At bottom to avoid circular import, as in Django's own backends
+from django.contrib.sessions.models import Session
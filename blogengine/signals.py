@@ -0,0 +1,256 @@
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.core.signals import request_finished, request_started
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import caching, counters, related, search, sites
+from .caching import bump_version
+from .models import Category, Post, RelatedPost, RenderedFlatPage, Tag
+
+
+def cache_groups(category_ids=(), tag_ids=()):
+	"""Cache version groups covering posts in the given categories and tags."""
+	groups = ['posts']
+	category_ids = [pk for pk in category_ids if pk is not None]
+	if category_ids:
+		groups += ['category:%s' % slug for slug in
+			Category.objects.filter(pk__in=category_ids).values_list('slug', flat=True)]
+	if tag_ids:
+		groups += ['tag:%s' % slug for slug in
+			Tag.objects.filter(pk__in=tag_ids).values_list('slug', flat=True)]
+	return groups
+
+
+def bump_versions(groups, site_ids=None):
+	"""Bump groups on the given sites, or on every site."""
+	if site_ids is None:
+		site_ids = sites.site_ids()
+	for site_id in set(site_id for site_id in site_ids if site_id is not None):
+		for group in set(groups):
+			bump_version(group, site_id)
+
+
+@receiver(post_save, sender=FlatPage)
+def render_flatpage(sender, instance, raw=False, **kwargs):
+	if not raw:
+		RenderedFlatPage.render_for(instance)
+
+
+@receiver(pre_save, sender=FlatPage)
+def remember_flatpage_url(sender, instance, raw=False, **kwargs):
+	instance._previous_urls = []
+	if instance.pk and not raw:
+		instance._previous_urls = list(
+			FlatPage.objects.filter(pk=instance.pk).values_list('url', flat=True))
+
+
+@receiver(post_save, sender=FlatPage)
+@receiver(post_delete, sender=FlatPage)
+def invalidate_flatpage(sender, instance, **kwargs):
+	urls = [instance.url] + getattr(instance, '_previous_urls', [])
+	bump_versions(['flatpages'] + ['flatpage:%s' % url for url in urls])
+
+
+@receiver(m2m_changed, sender=FlatPage.sites.through)
+def invalidate_flatpage_sites(sender, instance, action, reverse, **kwargs):
+	if action.startswith('post_'):
+		if reverse:
+			# Changed from the site side; clear() does not say which pages
+			urls = FlatPage.objects.filter(pk__in=kwargs.get('pk_set') or []).values_list('url', flat=True)
+		else:
+			urls = [instance.url]
+		bump_versions(['flatpages'] + ['flatpage:%s' % url for url in urls])
+
+
+@receiver(pre_save, sender=Post)
+def remember_post_state(sender, instance, raw=False, **kwargs):
+	# A post moving category or slug must also drop out of the old caches
+	instance._previous_state = None
+	if instance.pk and not raw:
+		previous = Post.objects.filter(pk=instance.pk).values('category_id', 'slug', 'pub_date', 'site_id')
+		instance._previous_state = previous[0] if previous else None
+
+
+@receiver(post_save, sender=Post)
+def invalidate_saved_post(sender, instance, created=False, raw=False, **kwargs):
+	previous = getattr(instance, '_previous_state', None) or {}
+	category_ids = [instance.category_id, previous.get('category_id')]
+	tag_ids = [] if created else instance.tags.values_list('pk', flat=True)
+	groups = cache_groups(category_ids, tag_ids)
+	groups += ['post:%s' % slug for slug in (instance.slug, previous.get('slug')) if slug]
+	bump_versions(groups, [instance.site_id, previous.get('site_id')])
+
+
+@receiver(post_save, sender=Post)
+def count_saved_post(sender, instance, created=False, raw=False, **kwargs):
+	if raw:
+		# Fixtures are counted by `manage.py recount_posts`
+		return
+	previous = getattr(instance, '_previous_state', None)
+	if created or previous is None:
+		counters.add_posts(Category, [instance.category_id], pub_date=instance.pub_date)
+		counters.adjust_month(instance.site_id, instance.pub_date, 1)
+		return
+	if (previous['site_id'], counters.utc_month(previous['pub_date'])) != (
+			instance.site_id, counters.utc_month(instance.pub_date)):
+		counters.adjust_month(previous['site_id'], previous['pub_date'], -1)
+		counters.adjust_month(instance.site_id, instance.pub_date, 1)
+	if previous['category_id'] != instance.category_id:
+		counters.remove_posts(Category, [previous['category_id']])
+		counters.add_posts(Category, [instance.category_id], pub_date=instance.pub_date)
+	elif previous['pub_date'] != instance.pub_date:
+		counters.refresh_latest(Category, [instance.category_id])
+	if previous['pub_date'] != instance.pub_date:
+		counters.refresh_latest(Tag, list(instance.tags.values_list('pk', flat=True)))
+
+
+@receiver(pre_delete, sender=Post)
+def remember_deleted_post(sender, instance, **kwargs):
+	# The tag rows are gone by post_delete, so collect what is needed now
+	instance._deleted_tag_ids = list(instance.tags.values_list('pk', flat=True))
+	instance._stale_cache_groups = cache_groups(
+		[instance.category_id], instance._deleted_tag_ids)
+	instance._stale_cache_groups.append('post:%s' % instance.slug)
+	instance._stale_site_id = instance.site_id
+
+
+@receiver(post_delete, sender=Post)
+def count_deleted_post(sender, instance, **kwargs):
+	counters.remove_posts(Category, [instance.category_id])
+	counters.remove_posts(Tag, getattr(instance, '_deleted_tag_ids', []))
+	counters.adjust_month(instance.site_id, instance.pub_date, -1)
+
+
+@receiver(post_delete, sender=Post)
+def invalidate_deleted_post(sender, instance, **kwargs):
+	bump_versions(getattr(instance, '_stale_cache_groups', ['posts']),
+		[getattr(instance, '_stale_site_id', instance.site_id)])
+
+
+@receiver(post_save, sender=Post)
+def index_saved_post(sender, instance, **kwargs):
+	search.get_backend().index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def unindex_deleted_post(sender, instance, **kwargs):
+	search.get_backend().remove_post(instance.pk)
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def invalidate_post_tags(sender, instance, action, reverse, pk_set=None, **kwargs):
+	if reverse:
+		# Posts were added to or removed from a tag
+		if action.startswith('post_'):
+			bump_versions(['posts', 'tag:%s' % instance.slug])
+	elif action == 'post_clear':
+		# The cleared tags were collected by count_post_tags on pre_clear
+		bump_versions(cache_groups(tag_ids=getattr(instance, '_removed_tag_ids', []))
+			+ ['post:%s' % instance.slug], [instance.site_id])
+	elif action in ('post_add', 'post_remove'):
+		bump_versions(cache_groups(tag_ids=pk_set or []) + ['post:%s' % instance.slug],
+			[instance.site_id])
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def count_post_tags(sender, instance, action, reverse, pk_set=None, **kwargs):
+	if reverse:
+		# instance is a Tag and pk_set holds posts
+		if action in ('pre_remove', 'pre_clear'):
+			posts = instance.post_set.all()
+			if action == 'pre_remove':
+				posts = posts.filter(pk__in=pk_set)
+			instance._removed_post_count = posts.count()
+		elif action == 'post_add' and pk_set:
+			counters.add_posts(Tag, [instance.pk], len(pk_set))
+		elif action in ('post_remove', 'post_clear'):
+			counters.remove_posts(Tag, [instance.pk], getattr(instance, '_removed_post_count', 0))
+		return
+	if action in ('pre_remove', 'pre_clear'):
+		# Only count tags the post really had
+		tags = instance.tags.all()
+		if action == 'pre_remove':
+			tags = tags.filter(pk__in=pk_set)
+		instance._removed_tag_ids = list(tags.values_list('pk', flat=True))
+	elif action == 'post_add' and pk_set:
+		counters.add_posts(Tag, pk_set, pub_date=instance.pub_date)
+	elif action in ('post_remove', 'post_clear'):
+		counters.remove_posts(Tag, getattr(instance, '_removed_tag_ids', []))
+
+
+@receiver(pre_delete, sender=Post)
+def remember_related_listers(sender, instance, **kwargs):
+	# Deleting the post cascades to the rows listing it, so find the posts
+	# that have to replace it now
+	instance._related_listers = list(
+		RelatedPost.objects.filter(related=instance).values_list('post_id', flat=True))
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def queue_related_posts(sender, instance, **kwargs):
+	related.queue([instance.pk] + getattr(instance, '_related_listers', []))
+
+
+@receiver(m2m_changed, sender=Post.tags.through)
+def queue_related_tags(sender, instance, action, reverse, pk_set=None, **kwargs):
+	if not reverse:
+		if action.startswith('post_'):
+			related.queue([instance.pk])
+	elif action == 'pre_clear':
+		related.queue(instance.post_set.values_list('pk', flat=True))
+	elif action in ('post_add', 'post_remove'):
+		related.queue(pk_set or [])
+
+
+@receiver(request_started)
+def reset_related_posts(sender, **kwargs):
+	related.discard()
+
+
+@receiver(request_started)
+def track_version_bumps(sender, **kwargs):
+	caching.track_bumps()
+
+
+@receiver(request_finished)
+def repeat_version_bumps(sender, **kwargs):
+	caching.repeat_bumps()
+
+
+@receiver(request_finished)
+def deactivate_site(sender, **kwargs):
+	sites.deactivate()
+
+
+@receiver(post_save, sender=Site)
+@receiver(post_delete, sender=Site)
+def reload_sites(sender, **kwargs):
+	sites.site_cache.clear()
+
+
+@receiver(request_finished)
+def update_related_posts(sender, **kwargs):
+	related.flush()
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Tag)
+def remember_slug(sender, instance, raw=False, **kwargs):
+	instance._previous_slugs = []
+	if instance.pk and not raw:
+		instance._previous_slugs = list(
+			sender.objects.filter(pk=instance.pk).values_list('slug', flat=True))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_archive(sender, instance, **kwargs):
+	kind = sender._meta.model_name
+	slugs = set([instance.slug] + getattr(instance, '_previous_slugs', []))
+	# 'categories' / 'tags' cover fragments listing every category or tag
+	bump_versions(['%s:%s' % (kind, slug) for slug in slugs]
+		+ [unicode(sender._meta.verbose_name_plural)])
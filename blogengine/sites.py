@@ -0,0 +1,89 @@
+"""
+The site being served, resolved from the request's host.
+
+Sites are loaded once per process and kept in memory; saving or deleting
+a Site bumps a shared counter so every process reloads them on its next
+request. SiteMiddleware activates the matching site for each request,
+and current_site_id() falls back to settings.SITE_ID elsewhere (shell,
+management commands), so the same code scopes correctly everywhere.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+
+
+VERSION_KEY = 'blogengine:sites-version'
+
+_local = threading.local()
+
+
+class SiteCache(object):
+	def __init__(self):
+		self.version = None
+		self.by_host = {}
+		self.by_id = {}
+
+	def refresh(self):
+		version = cache.get(VERSION_KEY)
+		if version is None:
+			# The counter was flushed or evicted. Restart it from the clock,
+			# so no old version comes back; what is loaded is still current
+			# unless another process changed a site and got there first.
+			version = int(time.time() * 1000)
+			if cache.add(VERSION_KEY, version, None):
+				if self.version is not None:
+					self.version = version
+			else:
+				version = cache.get(VERSION_KEY)
+		if version != self.version:
+			sites = list(Site.objects.all())
+			self.by_host = dict((site.domain.lower(), site) for site in sites)
+			self.by_id = dict((site.pk, site) for site in sites)
+			self.version = version
+
+	def get(self, host):
+		self.refresh()
+		host = host.lower()
+		site = self.by_host.get(host) or self.by_host.get(host.rsplit(':', 1)[0])
+		if site is None:
+			site = self.by_id.get(settings.SITE_ID)
+		return site
+
+	def clear(self):
+		try:
+			cache.incr(VERSION_KEY)
+		except ValueError:
+			cache.set(VERSION_KEY, int(time.time() * 1000), None)
+
+
+site_cache = SiteCache()
+
+
+def site_for_host(host):
+	return site_cache.get(host)
+
+
+def site_ids():
+	"""Ids of every site, e.g. to invalidate something they all show."""
+	site_cache.refresh()
+	return site_cache.by_id.keys() or [settings.SITE_ID]
+
+
+def is_multisite():
+	site_cache.refresh()
+	return len(site_cache.by_id) > 1
+
+
+def activate(site):
+	_local.site_id = site.pk if site is not None else None
+
+
+def deactivate():
+	_local.site_id = None
+
+
+def current_site_id():
+	return getattr(_local, 'site_id', None) or settings.SITE_ID
@@ -0,0 +1,76 @@
+from django import template
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+
+from blogengine.caching import get_versions
+from blogengine.models import Category, MonthArchive, Post, Tag
+from blogengine.sites import current_site_id
+
+register = template.Library()
+
+
+class VersionedCacheNode(template.Node):
+	def __init__(self, nodelist, expire_time_var, fragment_name, groups):
+		self.nodelist = nodelist
+		self.expire_time_var = expire_time_var
+		self.fragment_name = fragment_name
+		self.groups = groups
+
+	def render(self, context):
+		try:
+			expire_time = int(self.expire_time_var.resolve(context))
+		except (template.VariableDoesNotExist, ValueError, TypeError):
+			raise template.TemplateSyntaxError(
+				'"versioned_cache" tag got an invalid timeout: %r' % self.expire_time_var.token)
+		groups = [group.resolve(context) for group in self.groups]
+		versions = get_versions(groups)
+		cache_key = make_template_fragment_key(self.fragment_name,
+			['site=%s' % current_site_id()] + ['%s=%s' % (group, versions[group]) for group in groups])
+		value = cache.get(cache_key)
+		if value is None:
+			value = self.nodelist.render(context)
+			cache.set(cache_key, value, expire_time)
+		return value
+
+
+@register.tag
+def versioned_cache(parser, token):
+	"""
+	Like {% cache %}, but keyed on the current versions of the given cache
+	groups (see blogengine.caching), so the fragment is rendered again as
+	soon as a post, category or tag it shows changes::
+
+		{% versioned_cache 86400 sidebar "posts" "categories" %}
+			.. expensive aggregates ..
+		{% endversioned_cache %}
+	"""
+	nodelist = parser.parse(('endversioned_cache',))
+	parser.delete_first_token()
+	tokens = token.split_contents()
+	if len(tokens) < 3:
+		raise template.TemplateSyntaxError("'%r' tag requires at least 2 arguments." % tokens[0])
+	return VersionedCacheNode(nodelist,
+		parser.compile_filter(tokens[1]),
+		tokens[2],
+		[parser.compile_filter(group) for group in tokens[3:]])
+
+
+@register.inclusion_tag('blogengine/includes/category_list.html')
+def category_list():
+	return {'categories': Category.on_site.counted('name')}
+
+
+@register.inclusion_tag('blogengine/includes/tag_cloud.html')
+def tag_cloud():
+	return {'tags': Tag.on_site.counted('name')}
+
+
+@register.inclusion_tag('blogengine/includes/recent_posts.html')
+def recent_posts(count=5):
+	posts = Post.on_site.only('title', 'slug', 'pub_date').order_by('-pub_date', '-pk')
+	return {'posts': posts[:count]}
+
+
+@register.inclusion_tag('blogengine/includes/archive_months.html')
+def archive_months():
+	return {'months': MonthArchive.objects.summary()}
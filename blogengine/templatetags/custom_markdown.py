@@ -1,18 +1,11 @@
-import markdown
-
 from django import template
 from django.template.defaultfilters import stringfilter
-from django.utils.encoding import force_unicode
-from django.utils.safestring import mark_safe
+
+from blogengine.markup import cached_markdown
 
 register = template.Library()
 
 @register.filter(is_safe=True)
 @stringfilter
 def custom_markdown(value):
-    extensions = ["nl2br", ]
-   
-    return mark_safe(markdown.markdown(force_unicode(value),
-				       extensions,
- 				       safe_mode=True,
-				       enable_attribute=False))
+    return cached_markdown(value)
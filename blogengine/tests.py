@@ -1,16 +1,57 @@
-from django.test import TestCase, LiveServerTestCase, Client
+from django.conf import settings
+from django.test import TestCase, LiveServerTestCase, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
+import datetime
+import os
+from StringIO import StringIO
+import shutil
+import sqlite3
+import threading
+import tempfile
 from django.contrib.flatpages.models import FlatPage
+from django.contrib.sessions.models import Session
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
-from .models import Post, Category, Tag
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import RegexURLResolver
+from django.db import connection, connections
+from django.utils.unittest import skipUnless
+from django.template import Context, Template, loader as template_loader
+from mysite.warmup import refresh_layout, warm_templates
+from .models import Post, Category, Tag, MonthArchive, RelatedPost, RenderedFlatPage
+from . import caching, pool, related, routers, sites
+from .caching import get_version, version_key
+from .dispatch import CompiledURLResolver
+from .sessions import SessionStore
+from .middleware import AnonymousPageCacheMiddleware, SessionStackMiddleware
+from .management.commands.benchmark_urls import mixed_paths, resolve_all
+from .search import FTS_TABLE, SegmentSearchBackend, get_backend, search_posts
+from .segments import parse_query
+from .markup import source_hash, MarkdownCache, cached_markdown, markdown_cache
 import markdown
 import feedparser
 
 
+def create_post(slug, tags=(), **fields):
+	"""Save a post with `tags`; `fields` override the defaults."""
+	defaults = dict(title='Post %s' % slug, text='Body of %s' % slug, slug=slug,
+		pub_date=timezone.now(), site=Site.objects.all()[0])
+	defaults.update(fields)
+	if 'author' not in defaults:
+		defaults['author'] = User.objects.get_or_create(username='testuser')[0]
+	post = Post.objects.create(**defaults)
+	if tags:
+		post.tags.add(*tags)
+	return post
+
+
 class BaseAcceptanceTest(LiveServerTestCase):
 	def setUp(self):
 		self.client = Client()
+		cache.clear()
 
 
 class CategoryTest(LiveServerTestCase):
@@ -192,6 +233,255 @@ class PostTest(TestCase):
 		self.assertEquals(only_post_tag.name, 'python')
 		self.assertEquals(only_post_tag.description, u'The python programming language')
 
+	def test_post_text_rendered_on_save(self):
+		author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		site = Site.objects.all()[0]
+
+		post = Post()
+		post.title = 'My first post'
+		post.text = 'This is [my first blog post](http://127.0.0.1:8000/)'
+		post.slug = 'my-first-post'
+		post.pub_date = timezone.now()
+		post.author = author
+		post.site = site
+		post.save()
+
+		# Check the HTML and hash were stored alongside the source
+		only_post = Post.objects.all()[0]
+		self.assertEquals(only_post.text_hash, source_hash(post.text))
+		self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in only_post.text_html)
+		self.assertEquals(only_post.rendered_text(), only_post.text_html)
+
+		# Clear the stored HTML and backfill it with the management command
+		Post.objects.update(text_html='', text_hash='')
+		call_command('rerender_markdown', verbosity=0)
+		only_post = Post.objects.all()[0]
+		self.assertEquals(only_post.text_hash, source_hash(post.text))
+		self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in only_post.text_html)
+
+
+class PostIndexTest(TestCase):
+	def query_plan(self, queryset):
+		sql, params = queryset.query.sql_with_params()
+		cursor = connection.cursor()
+		cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+		return ' '.join(row[-1] for row in cursor.fetchall())
+
+	@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific')
+	def test_permalink_range_uses_index(self):
+		plan = self.query_plan(Post.objects.published_in(2014, 3).values('id'))
+		self.assertTrue('INDEX' in plan and '(pub_date>? AND pub_date<?)' in plan, plan)
+
+		# The listing order is read from the index rather than sorted
+		plan = self.query_plan(Post.objects.values('id'))
+		self.assertFalse('TEMP B-TREE' in plan, plan)
+
+	def test_permalink_month_must_match(self):
+		author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		post = Post()
+		post.title = 'My first post'
+		post.text = 'This is my first blog post'
+		post.slug = 'my-first-post'
+		post.pub_date = datetime.datetime(2014, 3, 31, 23, 30, tzinfo=timezone.utc)
+		post.author = author
+		post.site = Site.objects.all()[0]
+		post.save()
+
+		self.assertEquals(post.get_absolute_url(), '/2014/3/my-first-post/')
+		response = self.client.get('/2014/3/my-first-post/')
+		self.assertEquals(response.status_code, 200)
+		response = self.client.get('/2014/4/my-first-post/')
+		self.assertEquals(response.status_code, 404)
+		response = self.client.get('/2014/13/my-first-post/')
+		self.assertEquals(response.status_code, 404)
+
+
+class MarkdownCacheTest(TestCase):
+	def test_cached_markdown(self):
+		markdown_cache.clear()
+		text = 'This is [my first blog post](http://127.0.0.1:8000/)'
+
+		html = cached_markdown(text)
+		self.assertEquals(html, cached_markdown(text))
+		self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in html)
+
+		stats = markdown_cache.stats()
+		self.assertEquals(stats['misses'], 1)
+		self.assertEquals(stats['hits'], 1)
+		self.assertEquals(stats['entries'], 1)
+
+	def test_eviction(self):
+		cache = MarkdownCache(max_entries=2, max_bytes=10)
+		cache.set('a', '12345')
+		cache.set('b', '12345')
+		cache.get('a')
+
+		# Least recently used entry goes first
+		cache.set('c', '1')
+		self.assertEquals(cache.get('b'), None)
+		self.assertEquals(cache.get('a'), '12345')
+
+		# Entries bigger than the byte budget are never stored
+		cache.set('d', '12345678901')
+		self.assertEquals(cache.get('d'), None)
+		self.assertEquals(cache.stats()['evictions'], 1)
+
+
+class TemplateWarmupTest(TestCase):
+	@override_settings(TEMPLATE_LOADERS=(
+		('django.template.loaders.cached.Loader', (
+			'django.template.loaders.filesystem.Loader',
+			'django.template.loaders.app_directories.Loader',
+		)),
+	))
+	def test_warm_templates(self):
+		warmed = warm_templates()
+		self.assertTrue('blogengine/includes/base.html' in warmed)
+		self.assertTrue('blogengine/post_list.html' in warmed)
+		self.assertTrue('flatpages/default.html' in warmed)
+
+		# Third party templates are left to load on demand
+		self.assertFalse('admin/base.html' in warmed)
+
+		# The compiled templates are now held by the cached loader
+		cached_loader = template_loader.template_source_loaders[0]
+		self.assertTrue('blogengine/post_list.html' in cached_loader.template_cache)
+
+	def test_refresh_layout(self):
+		cache.clear()
+		version = get_version('layout')
+		self.assertTrue(refresh_layout())
+		self.assertEquals(get_version('layout'), version + 1)
+		# Other workers booting with the same templates leave it alone
+		self.assertFalse(refresh_layout())
+		self.assertEquals(get_version('layout'), version + 1)
+
+
+class FragmentCacheTest(TestCase):
+	def render_sidebar(self):
+		template = Template('{% load blog_tags %}'
+			'{% versioned_cache 600 sidebar "posts" "categories" "tags" %}'
+			'{% category_list %}{% tag_cloud %}{% recent_posts 5 %}'
+			'{% endversioned_cache %}')
+		return template.render(Context())
+
+	def test_sidebar_fragment(self):
+		cache.clear()
+		category = Category(name='python', description='The Python programming language')
+		category.save()
+		tag = Tag(name='django', description='The Django framework')
+		tag.save()
+		post = Post()
+		post.title = 'My first post'
+		post.text = 'This is my first blog post'
+		post.slug = 'my-first-post'
+		post.pub_date = timezone.now()
+		post.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		post.site = Site.objects.all()[0]
+		post.category = category
+		post.save()
+		post.tags.add(tag)
+
+		html = self.render_sidebar()
+		self.assertTrue('python' in html)
+		self.assertTrue('django' in html)
+		self.assertTrue('My first post' in html)
+
+		# Rendered once, then served from the cache
+		with self.assertNumQueries(0):
+			self.assertEquals(self.render_sidebar(), html)
+
+		# Saving a category, tag or post renders it again
+		category.name = 'Python 3'
+		category.save()
+		self.assertTrue('Python 3' in self.render_sidebar())
+		tag.name = 'Django 1.6'
+		tag.save()
+		self.assertTrue('Django 1.6' in self.render_sidebar())
+		post.title = 'My first post, revised'
+		post.save()
+		self.assertTrue('My first post, revised' in self.render_sidebar())
+
+
+class PostCountTest(TestCase):
+	def setUp(self):
+		self.python = Category(name='python', description='The Python programming language')
+		self.python.save()
+		self.perl = Category(name='perl', description='The Perl programming language')
+		self.perl.save()
+		self.django = Tag(name='django', description='The Django framework')
+		self.django.save()
+		self.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+
+	def assertCounts(self, archive, count, latest):
+		archive = archive.__class__.objects.get(pk=archive.pk)
+		self.assertEquals(archive.post_count, count)
+		self.assertEquals(archive.latest_pub_date, latest and latest.pub_date)
+
+	def test_post_counts(self):
+		old = create_post('old-post', category=self.python,
+			pub_date=timezone.now() - datetime.timedelta(days=2))
+		new = create_post('new-post', category=self.python)
+		self.assertCounts(self.python, 2, new)
+
+		# Tags, from either side of the relation
+		new.tags.add(self.django)
+		self.django.post_set.add(old)
+		self.assertCounts(self.django, 2, new)
+		new.tags.remove(self.django)
+		new.tags.remove(self.django)
+		self.assertCounts(self.django, 1, old)
+		old.tags.clear()
+		self.assertCounts(self.django, 0, None)
+		self.django.post_set.add(old, new)
+		self.assertCounts(self.django, 2, new)
+
+		# Moving a post between categories
+		new.category = self.perl
+		new.save()
+		self.assertCounts(self.python, 1, old)
+		self.assertCounts(self.perl, 1, new)
+
+		# Editing a category keeps its counters
+		self.python.description = 'Python 3'
+		self.python.save()
+		self.assertCounts(self.python, 1, old)
+
+		new.delete()
+		self.assertCounts(self.perl, 0, None)
+		self.assertCounts(self.django, 1, old)
+		call_command('recount_posts', check=True, verbosity=0)
+
+	def test_uncounted_fixture_deleted(self):
+		post = Post(title='loaded', text='Loaded', slug='loaded', pub_date=timezone.now(),
+			updated_at=timezone.now(), author=self.author, site=Site.objects.all()[0],
+			category=self.python)
+		post.save_base(raw=True)
+		post.delete()
+		self.assertCounts(self.python, 0, None)
+
+	def test_load_fixture_without_updated_at(self):
+		# Dumps made before posts tracked their last change
+		fixture = tempfile.NamedTemporaryFile(suffix='.json')
+		fixture.write('[{"pk": 1, "model": "blogengine.post", "fields": {"title": "Loaded", '
+			'"text": "Loaded", "slug": "loaded", "pub_date": "2014-03-10T00:00:00Z", '
+			'"author": %d, "site": 1, "tags": []}}]' % self.author.pk)
+		fixture.flush()
+		call_command('loaddata', fixture.name, verbosity=0)
+		self.assertTrue(Post.objects.get(slug='loaded').updated_at is not None)
+
+	def test_recount_posts(self):
+		post = create_post('my-first-post', category=self.python)
+		Category.objects.update(post_count=7)
+
+		errors = StringIO()
+		self.assertRaises(CommandError, call_command, 'recount_posts', check=True,
+			verbosity=0, stderr=errors)
+		self.assertTrue("category u'python': post_count=7" in errors.getvalue())
+		call_command('recount_posts', verbosity=0)
+		self.assertCounts(self.python, 1, post)
+		call_command('recount_posts', check=True, verbosity=0)
+
 
 class AdminTest(BaseAcceptanceTest):
 	fixtures = ['users.json']
@@ -471,11 +761,8 @@ class PostViewTest(BaseAcceptanceTest):
 		author = User.objects.create_user('testuser', 'user@example.com', 'password')
 		author.save()
 
-		# Create the site
-		site = Site()
-		site.name = 'example.com'
-		site.domain = 'example.com'
-		site.save()
+		# Posts are only shown on their own site
+		site = Site.objects.get_current()
 
 		# Create the post
 		post = Post()
@@ -531,11 +818,8 @@ class PostViewTest(BaseAcceptanceTest):
 		author = User.objects.create_user('testuser', 'user@example.com', 'password')
 		author.save()
 
-		# Create the site
-		site = Site()
-		site.name = 'example.com'
-		site.domain = 'example.com'
-		site.save()
+		# Posts are only shown on their own site
+		site = Site.objects.get_current()
 
 		post = Post()
 		post.title = 'My first post'
@@ -592,11 +876,8 @@ class PostViewTest(BaseAcceptanceTest):
 		author = User.objects.create_user('testuser', 'user@example.com', 'password')
 		author.save()
 
-		# Create the site
-		site = Site()
-		site.name = 'example.com'
-		site.domain = 'example.com'
-		site.save()
+		# Posts are only shown on their own site
+		site = Site.objects.get_current()
 
 		# Create the post
 		post = Post()
@@ -624,6 +905,7 @@ class PostViewTest(BaseAcceptanceTest):
 
 		# Check the category name is in the response
 		self.assertTrue(post.category.name in response.content)
+		self.assertEquals(response.context['category'], category)
 
 		# Check the post text is in the response
 		self.assertTrue(markdown.markdown(post.text) in response.content)
@@ -647,11 +929,8 @@ class PostViewTest(BaseAcceptanceTest):
 		author = User.objects.create_user('testuser', 'user@example.com', 'password')
 		author.save()
 
-		# Create the site
-		site = Site()
-		site.name = 'example.com'
-		site.domain = 'example.com'
-		site.save()
+		# Posts are only shown on their own site
+		site = Site.objects.get_current()
 
 		# Create the post
 		post = Post()
@@ -679,6 +958,7 @@ class PostViewTest(BaseAcceptanceTest):
 
 		# Check the tag name is in the response
 		self.assertTrue(post.tags.all()[0].name in response.content)
+		self.assertEquals(response.context['tag'], tag)
 
 		# Check the post text is in the response
 		self.assertTrue(markdown.markdown(post.text) in response.content)
@@ -692,6 +972,695 @@ class PostViewTest(BaseAcceptanceTest):
 		self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in response.content)
 
 
+	def test_unknown_archive_slug(self):
+		# Unknown slugs cost a single query and a 404
+		with self.assertNumQueries(1):
+			response = self.client.get('/category/no-such-category/')
+		self.assertEquals(response.status_code, 404)
+		with self.assertNumQueries(1):
+			response = self.client.get('/tag/no-such-tag/')
+		self.assertEquals(response.status_code, 404)
+
+	# Every listing page must cost the same number of queries no matter
+	# how many posts, tags or categories it shows.
+	def create_posts(self, count):
+		for i in range(Post.objects.count(), Post.objects.count() + count):
+			category = Category.objects.create(name='category %d' % i, description='category')
+			tags = [Tag.objects.create(name='tag %d %d' % (i, j), description='tag') for j in range(2)]
+			post = create_post('post-number-%d' % i, tags, title='Post number %d' % i,
+				category=category)
+		return post
+
+	def assertQueryBudget(self, url, budget):
+		# Measure the view itself, not the page cache. The four sidebar
+		# queries are included since the fragment cache is cleared too, and
+		# budgets count the narrow query for the conditional GET validators.
+		cache.clear()
+		with self.assertNumQueries(budget + 4):
+			response = self.client.get(url)
+		self.assertEquals(response.status_code, 200)
+
+	def test_listing_query_budget(self):
+		for count in (1, 4):
+			post = self.create_posts(count)
+			tag = post.tags.all()[0]
+			self.assertQueryBudget('/', 4)
+			self.assertQueryBudget(post.category.get_absolute_url(), 4)
+			self.assertQueryBudget(tag.get_absolute_url(), 4)
+			self.assertQueryBudget(post.get_absolute_url(), 4)
+
+			# Put several posts in the same category and tag
+			for other in Post.objects.exclude(pk=post.pk):
+				other.category = post.category
+				other.save()
+				other.tags.add(tag)
+			self.assertQueryBudget(post.category.get_absolute_url(), 4)
+			self.assertQueryBudget(tag.get_absolute_url(), 4)
+
+
+class PageCacheTest(BaseAcceptanceTest):
+	fixtures = ['users.json']
+
+	def assertCached(self, url, cached=True):
+		if cached:
+			with self.assertNumQueries(0):
+				response = self.client.get(url)
+		else:
+			response = self.client.get(url)
+		self.assertEquals(response.status_code, 200)
+		return response
+
+	def test_anonymous_pages_cached(self):
+		python = Category(name='python', description='The Python programming language')
+		python.save()
+		perl = Category(name='perl', description='The Perl programming language')
+		perl.save()
+		first = create_post('first-post', title='First post', category=python)
+		second = create_post('second-post', title='Second post', category=perl)
+
+		urls = ['/', first.get_absolute_url(), second.get_absolute_url(), '/category/python/', '/category/perl/']
+		for url in urls:
+			self.assertCached(url, cached=False)
+		for url in urls:
+			self.assertCached(url)
+
+		# Every page's sidebar lists the recent posts, so all are purged
+		first.title = 'First post, revised'
+		first.save()
+		for url in urls:
+			response = self.assertCached(url, cached=False)
+			self.assertTrue('First post, revised' in response.content)
+		for url in urls:
+			self.assertCached(url)
+
+		# Renaming a category purges permalinks that show it
+		python.name = 'Python 3'
+		python.save()
+		response = self.assertCached(first.get_absolute_url(), cached=False)
+		self.assertTrue('Python 3' in response.content)
+
+		# Logged in users always get a fresh page
+		self.client.login(username='kuldeeprishi', password='password')
+		with CaptureQueriesContext(connection) as queries:
+			response = self.client.get('/')
+		self.assertEquals(response.status_code, 200)
+		self.assertTrue(len(queries) > 0)
+
+	def test_evicted_version_not_reused(self):
+		cache.clear()
+		create_post('first-post', title='First post')
+		create_post('second-post', title='Second post')
+		self.assertCached('/', cached=False)
+		self.assertCached('/')
+
+		# The counter restarts, but not at a value the cached page has seen
+		cache.delete(version_key('posts'))
+		create_post('third-post', title='Third post')
+		create_post('fourth-post', title='Fourth post')
+		response = self.assertCached('/', cached=False)
+		self.assertTrue('Fourth post' in response.content)
+
+	def test_bumps_repeated_after_request(self):
+		# Saves in the admin bump versions before their transaction commits
+		caching.track_bumps()
+		create_post('first-post', title='First post')
+		version = get_version('posts')
+		caching.repeat_bumps()
+		self.assertTrue(get_version('posts') > version)
+
+	def test_flatpage_cached(self):
+		page = FlatPage(url='/about/', title='About me', content='All about me')
+		page.save()
+		page.sites.add(Site.objects.all()[0])
+
+		self.assertCached('/about/', cached=False)
+		self.assertCached('/about/')
+
+		page.content = 'All about me, revised'
+		page.save()
+		response = self.assertCached('/about/', cached=False)
+		self.assertTrue('All about me, revised' in response.content)
+
+		# A new post shows up in the page's sidebar
+		create_post('latest-post', title='Latest post')
+		response = self.assertCached('/about/', cached=False)
+		self.assertTrue('Latest post' in response.content)
+
+	def test_per_process_cache_refused(self):
+		with override_settings(BLOG_SINGLE_PROCESS=False):
+			self.assertRaises(ImproperlyConfigured, AnonymousPageCacheMiddleware)
+
+
+class SessionStackTest(TestCase):
+	def process(self, request):
+		SessionStackMiddleware().process_request(request)
+		return request
+
+	def test_public_reads_skip_sessions(self):
+		factory = RequestFactory()
+		request = self.process(factory.get('/category/python/'))
+		self.assertFalse(hasattr(request, 'session'))
+		self.assertFalse(request.user.is_authenticated())
+
+		# Cookies other than the session and CSRF ones don't matter
+		request = factory.get('/')
+		request.COOKIES['_ga'] = 'GA1.2.3.4'
+		self.assertFalse(hasattr(self.process(request), 'session'))
+
+		# Visitors with a session or CSRF cookie, writes and the admin
+		# get the full stack
+		for name in (settings.SESSION_COOKIE_NAME, settings.CSRF_COOKIE_NAME):
+			request = factory.get('/')
+			request.COOKIES[name] = 'abc'
+			self.assertTrue(hasattr(self.process(request), 'session'))
+		self.assertTrue(hasattr(self.process(factory.post('/search/')), 'session'))
+		self.assertTrue(hasattr(self.process(factory.get('/admin/')), 'session'))
+
+	def test_no_cookies_set(self):
+		response = self.client.get('/')
+		self.assertEquals(response.status_code, 200)
+		self.assertEquals(response.cookies.keys(), [])
+
+
+class SessionStoreTest(TestCase):
+	def setUp(self):
+		cache.clear()
+		session = SessionStore()
+		session['count'] = 1
+		session.save()
+		self.key = session.session_key
+
+	def test_reads_and_writes(self):
+		session = SessionStore(self.key)
+		with self.assertNumQueries(0):
+			self.assertEquals(session['count'], 1)
+			# Saving what is already stored writes nothing
+			session['count'] = 1
+			session.save()
+
+		session['count'] = 2
+		session.save()
+		self.assertEquals(Session.objects.get(pk=self.key).get_decoded(), {'count': 2})
+		cache.clear()
+		self.assertEquals(SessionStore(self.key)['count'], 2)
+
+		session.delete()
+		self.assertFalse(SessionStore().exists(self.key))
+
+	def test_refreshed_near_expiry(self):
+		soon = timezone.now() + datetime.timedelta(minutes=5)
+		Session.objects.filter(pk=self.key).update(expire_date=soon)
+		cache.clear()
+		session = SessionStore(self.key)
+		self.assertEquals(session['count'], 1)
+		session.save()
+		self.assertTrue(Session.objects.get(pk=self.key).expire_date > soon)
+
+	def test_cleanup(self):
+		expired = timezone.now() - datetime.timedelta(days=1)
+		for i in range(5):
+			Session.objects.create(session_key='expired%d' % i, session_data='', expire_date=expired)
+		call_command('cleanup_sessions', batch_size=2, verbosity=0)
+		self.assertEquals(list(Session.objects.values_list('pk', flat=True)), [self.key])
+
+
+class DateArchiveTest(BaseAcceptanceTest):
+	def month_counts(self):
+		return sorted(MonthArchive.objects.filter(post_count__gt=0).values_list('year', 'month', 'post_count'))
+
+	def test_month_archive_counts(self):
+		march = datetime.datetime(2014, 3, 10, tzinfo=timezone.utc)
+		first = create_post('first', pub_date=march)
+		second = create_post('second', pub_date=march)
+		self.assertEquals(self.month_counts(), [(2014, 3, 2)])
+
+		second.pub_date = datetime.datetime(2014, 4, 1, tzinfo=timezone.utc)
+		second.save()
+		self.assertEquals(self.month_counts(), [(2014, 3, 1), (2014, 4, 1)])
+
+		first.delete()
+		self.assertEquals(self.month_counts(), [(2014, 4, 1)])
+		call_command('recount_posts', check=True, verbosity=0)
+
+	def test_uncounted_fixture_deleted(self):
+		march = datetime.datetime(2014, 3, 10, tzinfo=timezone.utc)
+		loaded = Post(title='Loaded', text='Loaded', slug='loaded', pub_date=march,
+			updated_at=march, author=User.objects.get_or_create(username='testuser')[0],
+			site=Site.objects.all()[0])
+		loaded.save_base(raw=True)
+		create_post('first', pub_date=march).delete()
+		loaded.delete()
+		self.assertEquals(list(MonthArchive.objects.values_list('post_count', flat=True)), [0])
+
+	def test_archive_views(self):
+		create_post('first', pub_date=datetime.datetime(2014, 3, 10, tzinfo=timezone.utc))
+		create_post('second', pub_date=datetime.datetime(2014, 3, 20, tzinfo=timezone.utc))
+		create_post('third', pub_date=datetime.datetime(2014, 11, 1, tzinfo=timezone.utc))
+
+		# The year page is built from the month table alone; the other four
+		# queries are the sidebar
+		cache.clear()
+		with self.assertNumQueries(5):
+			response = self.client.get('/2014/')
+		self.assertEquals(response.status_code, 200)
+		self.assertEquals([(month['month'], month['post_count']) for month in response.context['months']],
+			[(3, 2), (11, 1)])
+		self.assertTrue('href="/2014/3/"' in response.content)
+		self.assertTrue('November' in response.content)
+
+		response = self.client.get('/2014/3/')
+		self.assertEquals(response.status_code, 200)
+		self.assertEquals(sorted(post.slug for post in response.context['object_list']), ['first', 'second'])
+		self.assertTrue('March 2014' in response.content)
+
+		for url in ('/2013/', '/2014/4/', '/2014/13/'):
+			response = self.client.get(url)
+			self.assertEquals(response.status_code, 404)
+
+
+class ConditionalGetTest(BaseAcceptanceTest):
+	def setUp(self):
+		super(ConditionalGetTest, self).setUp()
+		self.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		self.category = Category.objects.create(name='python', description='Python')
+		self.post = create_post('first', category=self.category)
+		# A session cookie keeps the page cache out of the way
+		self.client.cookies[settings.SESSION_COOKIE_NAME] = 'x'
+
+	def test_post_page(self):
+		url = self.post.get_absolute_url()
+		response = self.client.get(url)
+		self.assertEquals(response.status_code, 200)
+		etag, last_modified = response['ETag'], response['Last-Modified']
+
+		# A match costs the validator query alone
+		with self.assertNumQueries(1):
+			response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEquals(response.status_code, 304)
+		self.assertEquals(response['ETag'], etag)
+		response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+		self.assertEquals(response.status_code, 304)
+
+		self.post.text = 'Edited'
+		self.post.save()
+		response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEquals(response.status_code, 200)
+		self.assertNotEquals(response['ETag'], etag)
+
+		# So does a new set of related posts
+		etag = response['ETag']
+		related.rebuild()
+		response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+		self.assertEquals(response.status_code, 200)
+
+		response = self.client.get('/2000/1/first/', HTTP_IF_NONE_MATCH='*')
+		self.assertEquals(response.status_code, 404)
+
+	def test_listings(self):
+		for url in ('/', self.category.get_absolute_url(), '/%d/' % self.post.pub_date.year):
+			etag = self.client.get(url)['ETag']
+			response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+			self.assertEquals(response.status_code, 304)
+
+		etag = self.client.get('/')['ETag']
+		create_post('second', category=self.category)
+		response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+		self.assertEquals(response.status_code, 200)
+		self.assertTrue('Post second' in response.content)
+
+		# The page cache hands out the view's validators too
+		del self.client.cookies[settings.SESSION_COOKIE_NAME]
+		etag = self.client.get('/')['ETag']
+		with self.assertNumQueries(0):
+			response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+		self.assertEquals(response.status_code, 304)
+
+
+class PaginationTest(BaseAcceptanceTest):
+	def setUp(self):
+		super(PaginationTest, self).setUp()
+		author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		site = Site.objects.all()[0]
+
+		# Two posts share a pub_date to exercise the id tie breaker
+		now = timezone.now()
+		for i in range(7):
+			post = Post()
+			post.title = 'Post number %d' % i
+			post.text = 'Body of post %d' % i
+			post.slug = 'post-number-%d' % i
+			post.pub_date = now - datetime.timedelta(days=min(i, 5))
+			post.author = author
+			post.site = site
+			post.save()
+
+	def test_offset_pagination(self):
+		response = self.client.get('/')
+		self.assertEquals(response.status_code, 200)
+		self.assertTrue('href="?page=2"' in response.content)
+
+		response = self.client.get('/?page=2')
+		self.assertEquals(response.status_code, 200)
+		self.assertTrue('Post number 6' in response.content)
+		self.assertTrue('href="?page=1"' in response.content)
+
+		# Pages out of range are a 404, not a server error
+		for page in ('0', '-1', 'x', '99'):
+			response = self.client.get('/?page=%s' % page)
+			self.assertEquals(response.status_code, 404)
+
+	@override_settings(BLOG_KEYSET_PAGINATION=True)
+	def test_keyset_pagination(self):
+		response = self.client.get('/')
+		self.assertEquals(response.status_code, 200)
+		first_page = [post.title for post in response.context['object_list']]
+		self.assertEquals(first_page, ['Post number %d' % i for i in range(5)])
+		self.assertEquals(response.context['previous_page_query'], None)
+
+		response = self.client.get('/?' + response.context['next_page_query'])
+		self.assertEquals(response.status_code, 200)
+		second_page = [post.title for post in response.context['object_list']]
+		self.assertEquals(second_page, ['Post number 6', 'Post number 5'])
+		self.assertEquals(response.context['next_page_query'], None)
+
+		# Walking back lands on the first page again
+		response = self.client.get('/?' + response.context['previous_page_query'])
+		self.assertEquals([post.title for post in response.context['object_list']], first_page)
+
+		# Garbage cursors are a 404, not a server error
+		response = self.client.get('/?after=not-a-cursor')
+		self.assertEquals(response.status_code, 404)
+
+
+class SearchTest(BaseAcceptanceTest):
+	def setUp(self):
+		super(SearchTest, self).setUp()
+		author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		site = Site.objects.all()[0]
+		now = timezone.now()
+		self.posts = {}
+		for i, (title, text) in enumerate([
+				('Caching in Django', 'Templates and querysets can both be cached.'),
+				('Python tips', 'A few Django idioms, and caching with memcached.'),
+				('Gardening', 'Nothing about software at all.'),
+				]):
+			post = Post(title=title, text=text, slug='post-%d' % i,
+				pub_date=now - datetime.timedelta(days=i), author=author, site=site)
+			post.save()
+			self.posts[title] = post
+
+	def titles(self, query):
+		return [post.title for post in search_posts(query)[:10]]
+
+	def test_search_index(self):
+		if connection.vendor == 'sqlite':
+			self.assertNotIsInstance(get_backend(), SegmentSearchBackend)
+
+		# A title match outranks a match in the text
+		self.assertEquals(self.titles('django'), ['Caching in Django', 'Python tips'])
+		self.assertEquals(self.titles('django memcached'), ['Python tips'])
+		self.assertEquals(self.titles('"unbalanced OR'), [])
+		self.assertEquals(search_posts('   ').count(), 0)
+
+		# Saves and deletes keep the index current
+		post = self.posts['Gardening']
+		post.text = 'Growing tomatoes next to a Django server.'
+		post.save()
+		self.assertEquals(len(self.titles('django')), 3)
+		self.posts['Caching in Django'].delete()
+		self.assertEquals(sorted(self.titles('django')), ['Gardening', 'Python tips'])
+
+		call_command('rebuild_search_index', verbosity=0)
+		self.assertEquals(self.titles('tomatoes'), ['Gardening'])
+
+	def test_search_view(self):
+		response = self.client.get('/search/?q=caching')
+		self.assertEquals(response.status_code, 200)
+		self.assertEquals([post.title for post in response.context['object_list']],
+			['Caching in Django', 'Python tips'])
+		self.assertTrue('Results for &ldquo;caching&rdquo;' in response.content)
+
+		author = User.objects.all()[0]
+		for i in range(6):
+			Post.objects.create(title='More on caching %d' % i, text='Caching.', slug='more-%d' % i,
+				pub_date=timezone.now(), author=author, site=Site.objects.all()[0])
+
+		# Ranked results are always paged by number, and links keep the query
+		with self.settings(BLOG_KEYSET_PAGINATION=True):
+			response = self.client.get('/search/?q=caching')
+		self.assertEquals(response.context['next_page_query'], 'q=caching&page=2')
+		response = self.client.get('/search/?q=caching&page=2')
+		self.assertEquals(len(response.context['object_list']), 3)
+
+		response = self.client.get('/search/?q=nothing-matches-this')
+		self.assertEquals(response.status_code, 200)
+		self.assertTrue('No posts found.' in response.content)
+
+
+class SegmentSearchTest(TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		self.backend = SegmentSearchBackend(self.path, merge_factor=3, background=False)
+		author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		self.site = Site.objects.all()[0]
+		self.posts = []
+		for i, (title, text) in enumerate([
+				('Caching in Django', 'Templates and querysets can both be cached.'),
+				('Python tips', 'A few Django idioms, and caching with memcached.'),
+				('Gardening', 'Nothing about software at all. Cached tomatoes.'),
+				]):
+			self.posts.append(Post.objects.create(title=title, text=text, slug='post-%d' % i,
+				pub_date=timezone.now(), author=author, site=self.site))
+		self.backend.rebuild()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def titles(self, query):
+		return [post.title for post in self.backend.search(query)[:10]]
+
+	def segment_count(self):
+		return len(self.backend.site_index(self.site.pk).manifest()['segments'])
+
+	def test_parse_query(self):
+		self.assertEquals(parse_query('django OR flask "page cache" -memcached'),
+			([[(u'django',), (u'flask',)], [(u'page', u'cache')]], [(u'memcached',)]))
+		self.assertEquals(parse_query('OR -'), ([], []))
+
+	def test_queries(self):
+		self.assertEquals(self.segment_count(), 1)
+		self.assertEquals(self.titles('django'), ['Caching in Django', 'Python tips'])
+		self.assertEquals(self.titles('caching -memcached'), ['Caching in Django'])
+		self.assertEquals(self.titles('"caching with memcached"'), ['Python tips'])
+		self.assertEquals(self.titles('"memcached with caching"'), [])
+		self.assertEquals(self.titles('gardening OR idioms'), ['Gardening', 'Python tips'])
+		self.assertEquals(self.titles('"django templates"'), [])
+
+		# Ranking and counting never touch the database
+		with self.assertNumQueries(0):
+			self.assertEquals(self.backend.search('cached').count(), 2)
+
+	def test_updates_and_merges(self):
+		gardening = self.posts[2]
+		gardening.text = 'Django in the garden.'
+		self.backend.index_post(gardening)
+		self.assertEquals(self.segment_count(), 2)
+		self.assertEquals(len(self.titles('django')), 3)
+		self.assertEquals(self.titles('tomatoes'), [])
+
+		self.backend.remove_post(self.posts[0].pk)
+		self.assertEquals(self.titles('django'), ['Gardening', 'Python tips'])
+
+		# A post moved to another site drops out of this site's results
+		other = Site.objects.create(domain='other.example.com', name='other')
+		self.posts[1].site = other
+		Post.objects.filter(pk=self.posts[1].pk).update(site=other)
+		self.backend.index_post(self.posts[1])
+		self.assertEquals(self.titles('django'), ['Gardening'])
+		with self.settings(SITE_ID=other.pk):
+			self.assertEquals(self.titles('django'), ['Python tips'])
+
+		# A fourth segment is over merge_factor, so the three smallest merge
+		self.backend.index_post(gardening)
+		self.backend.index_post(gardening)
+		self.assertEquals(self.segment_count(), 2)
+		self.backend.merge(self.backend.site_index(self.site.pk))
+		self.assertEquals(self.segment_count(), 1)
+		self.assertEquals(self.titles('garden'), ['Gardening'])
+		self.assertEquals(len(os.listdir(self.backend.site_index(self.site.pk).path)), 2)
+
+
+class CompiledURLResolverTest(TestCase):
+	def test_same_views_as_django(self):
+		paths = mixed_paths(1000) + ['/2014/3/slug', '/category/', '/feeds/other/', '/search']
+		compiled = CompiledURLResolver(r'^/', 'blogengine.urls')
+		self.assertTrue(compiled.table)
+		self.assertEquals(resolve_all(compiled, paths),
+			resolve_all(RegexURLResolver(r'^/', 'blogengine.urls'), paths))
+
+	def test_falls_back_for_includes(self):
+		resolver = CompiledURLResolver(r'^/', 'mysite.urls')
+		self.assertFalse(resolver.table)
+		match = resolver.resolve('/2014/3/slug/')
+		self.assertEquals(match.kwargs, {'year': '2014', 'month': '3', 'slug': 'slug'})
+
+
+class RelatedPostTest(BaseAcceptanceTest):
+	def setUp(self):
+		super(RelatedPostTest, self).setUp()
+		self.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		self.python = Category.objects.create(name='python', description='Python')
+		self.tags = dict((name, Tag.objects.create(name=name, description=name))
+			for name in ('django', 'caching', 'rare'))
+		self.posts = {}
+		for day, (slug, category, tags) in enumerate([
+				('a', self.python, ['django', 'caching']),
+				('b', None, ['django', 'caching']),
+				('c', self.python, ['django']),
+				('d', None, ['rare']),
+				('e', self.python, []),
+				]):
+			self.posts[slug] = create_post(slug, [self.tags[name] for name in tags],
+				category=category, pub_date=timezone.now() - datetime.timedelta(days=day))
+
+	def related_slugs(self, slug):
+		return list(RelatedPost.objects.filter(post=self.posts[slug]).values_list('related__slug', flat=True))
+
+	def test_rebuild(self):
+		call_command('rebuild_related_posts', verbosity=0)
+		# Identical tags beat a category match, which beats no overlap
+		self.assertEquals(self.related_slugs('a'), ['b', 'c', 'e'])
+		self.assertEquals(self.related_slugs('e'), ['a', 'c'])
+		self.assertEquals(self.related_slugs('d'), [])
+
+		with self.settings(BLOG_RELATED_POSTS=1):
+			related.rebuild()
+		self.assertEquals(self.related_slugs('a'), ['b'])
+
+	def test_update(self):
+		related.rebuild()
+		self.posts['f'] = create_post('f', [self.tags['django'], self.tags['caching']],
+			category=self.python, pub_date=timezone.now() + datetime.timedelta(days=1))
+		self.posts['b'].delete()
+		related.update([self.posts['f'].pk, self.posts['b'].pk])
+		self.assertEquals(self.related_slugs('a'), ['f', 'c', 'e'])
+		self.assertEquals(self.related_slugs('f'), ['a', 'c', 'e'])
+
+		# Outside a request, changes are applied right away
+		self.posts['d'].tags.add(self.tags['django'])
+		self.assertEquals(self.related_slugs('d'), ['c', 'f', 'a'])
+
+		# While serving one, they wait until it finishes
+		related.discard()
+		self.posts['d'].tags.remove(self.tags['django'])
+		self.assertEquals(self.related_slugs('d'), ['c', 'f', 'a'])
+		related.flush()
+		self.assertEquals(self.related_slugs('d'), [])
+
+	def test_delete_listed_post(self):
+		with self.settings(BLOG_RELATED_POSTS=2):
+			related.rebuild()
+			self.assertEquals(self.related_slugs('a'), ['b', 'c'])
+			# Posts listing a deleted post fill its place
+			self.posts['b'].delete()
+			self.assertEquals(self.related_slugs('a'), ['c', 'e'])
+			self.assertEquals(list(RelatedPost.objects.filter(post=self.posts['a']).values_list(
+				'rank', flat=True)), [0, 1])
+
+	def test_partial_index(self):
+		create_post('g', [self.tags['rare']], category=self.python,
+			pub_date=timezone.now() - datetime.timedelta(days=6))
+		full = related.RelatedIndex()
+		for slugs in (['d'], ['a', 'b']):
+			post_ids = [self.posts[slug].pk for slug in slugs]
+			partial = related.RelatedIndex(post_ids)
+			for post_id in post_ids:
+				self.assertEquals(partial.neighbours(post_id, 5), full.neighbours(post_id, 5))
+		# Only the posts sharing its tag are loaded for 'd'
+		self.assertEquals(len(related.RelatedIndex([self.posts['d'].pk]).post_ids()), 2)
+
+	def test_post_page(self):
+		related.rebuild()
+		response = self.client.get(self.posts['c'].get_absolute_url())
+		self.assertEquals([post.slug for post in response.context['related_posts']], ['a', 'b', 'e'])
+		self.assertTrue('<a href="%s">Post a</a>' % self.posts['a'].get_absolute_url() in response.content)
+
+
+class StaticExportTest(BaseAcceptanceTest):
+	def setUp(self):
+		super(StaticExportTest, self).setUp()
+		self.output = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.output)
+
+	def export(self):
+		call_command('export_static', output=self.output, processes=1,
+			incremental=True, verbosity=0)
+
+	def exported(self, *parts):
+		with open(os.path.join(self.output, *parts)) as exported:
+			return exported.read()
+
+	def test_export_static(self):
+		category = Category(name='python', description='The Python programming language')
+		category.save()
+		author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		site = Site.objects.all()[0]
+		for i in range(6):
+			post = Post()
+			post.title = 'Post number %d' % i
+			post.text = 'Body of post %d' % i
+			post.slug = 'post-number-%d' % i
+			post.pub_date = timezone.now() - datetime.timedelta(days=i)
+			post.author = author
+			post.site = site
+			post.category = category
+			post.save()
+		page = FlatPage(url='/about/', title='About me', content='All about me')
+		page.save()
+		page.sites.add(site)
+
+		self.export()
+		self.assertTrue('Post number 0' in self.exported('index.html'))
+		self.assertTrue('Post number 5' in self.exported('page', '2', 'index.html'))
+		self.assertTrue('Post number 5' in self.exported('category', 'python', 'page', '2', 'index.html'))
+		self.assertTrue('Body of post 5' in self.exported(*post.get_absolute_url().split('/')[1:-1] + ['index.html']))
+		self.assertTrue('<rss' in self.exported('feeds', 'posts', 'index.xml'))
+		self.assertTrue('All about me' in self.exported('about', 'index.html'))
+		newest = Post.objects.get(slug='post-number-0')
+		month = [str(newest.pub_date.year), str(newest.pub_date.month)]
+		self.assertTrue('Post number 0' in self.exported(*month + ['index.html']))
+		self.assertTrue('/%s/%s/' % tuple(month) in self.exported(month[0], 'index.html'))
+
+		# An unchanged site renders nothing on the next run
+		with self.assertNumQueries(10):
+			self.export()
+
+		# Only pages showing the edited post are rendered again
+		post.title = 'Post number 5, revised'
+		post.save()
+		os.unlink(os.path.join(self.output, 'about', 'index.html'))
+		self.export()
+		self.assertTrue('Post number 5, revised' in self.exported('page', '2', 'index.html'))
+		self.assertFalse(os.path.exists(os.path.join(self.output, 'about', 'index.html')))
+
+		# Pages whose sidebar lists an edited post are rendered again
+		newest.title = 'Post number 0, revised'
+		newest.save()
+		self.export()
+		self.assertTrue('Post number 0, revised' in self.exported('about', 'index.html'))
+
+		# Deleted posts lose their page
+		post.delete()
+		self.export()
+		self.assertFalse(os.path.exists(os.path.join(self.output, 'page', '2', 'index.html')))
+
+	@override_settings(BLOG_KEYSET_PAGINATION=True)
+	def test_keyset_pagination_refused(self):
+		self.assertRaises(CommandError, self.export)
+
+
 class FlatPageViewTest(BaseAcceptanceTest):
 	def test_create_flat_page(self):
 		page = FlatPage()
@@ -723,6 +1692,28 @@ class FlatPageViewTest(BaseAcceptanceTest):
 		self.assertTrue('About me' in response.content)
 		self.assertTrue('All about me' in response.content)
 
+		# Check the rendered content was stored
+		rendered = RenderedFlatPage.objects.get(flatpage=page)
+		self.assertEquals(rendered.content_hash, source_hash(page.content))
+		self.assertEquals(rendered.content_html, markdown.markdown(page.content))
+
+
+	def test_unknown_urls(self):
+		page = FlatPage.objects.create(url='/about/', title='About me', content='All about me')
+		page.sites.add(Site.objects.get_current())
+		self.assertEquals(self.client.get('/about/').status_code, 200)
+
+		# Misses are answered from memory
+		with self.assertNumQueries(0):
+			self.assertEquals(self.client.get('/wp-login.php/').status_code, 404)
+			self.assertEquals(self.client.get('/about').status_code, 301)
+
+		# New pages are found straight away
+		page = FlatPage.objects.create(url='/contact/', title='Contact', content='Write to me')
+		self.assertEquals(self.client.get('/contact/').status_code, 404)
+		page.sites.add(Site.objects.get_current())
+		self.assertEquals(self.client.get('/contact/').status_code, 200)
+
 
 class FeedTest(BaseAcceptanceTest):
     def test_all_post_feed(self):
@@ -742,11 +1733,8 @@ class FeedTest(BaseAcceptanceTest):
         author = User.objects.create_user('testuser', 'user@example.com', 'password')
         author.save()
 
-        # Create the site
-        site = Site()
-        site.name = 'example.com'
-        site.domain = 'example.com'
-        site.save()
+        # Posts are only shown on their own site
+        site = Site.objects.get_current()
 
         # Create a post
         post = Post()
@@ -784,4 +1772,310 @@ class FeedTest(BaseAcceptanceTest):
         # Check post retrieved is the correct one
         feed_post = feed.entries[0]
         self.assertEquals(feed_post.title, post.title)
-        self.assertEquals(feed_post.description, post.text)
\ No newline at end of file
+        self.assertEquals(feed_post.description, post.text_html)
+
+    @override_settings(BLOG_FEED_ITEMS=2)
+    def test_feed_conditional_get(self):
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+        for i in range(3):
+            post = Post()
+            post.title = 'Post number %d' % i
+            post.text = 'Body of post %d' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = timezone.now() - datetime.timedelta(days=3 - i)
+            post.author = author
+            post.site = site
+            post.save()
+
+        # Only the newest posts are in the feed
+        response = self.client.get('/feeds/posts/')
+        self.assertEquals(response.status_code, 200)
+        feed = feedparser.parse(response.content)
+        self.assertEquals([entry.title for entry in feed.entries], ['Post number 2', 'Post number 1'])
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # Revalidation is answered from the cache
+        with self.assertNumQueries(0):
+            response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        with self.assertNumQueries(0):
+            response = self.client.get('/feeds/posts/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEquals(response.status_code, 304)
+
+        # Editing a post invalidates the cached feed
+        post.title = 'Post number 2, revised'
+        post.save()
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+        self.assertTrue('Post number 2, revised' in response.content)
+
+    def test_category_and_tag_feeds(self):
+        author = User.objects.create_user('testuser', 'user@example.com', 'password')
+        site = Site.objects.all()[0]
+        python = Category(name='python', description='The Python programming language')
+        python.save()
+        perl = Category(name='perl', description='The Perl programming language')
+        perl.save()
+        tag = Tag(name='django', description='The Django framework')
+        tag.save()
+
+        posts = []
+        for i, category in enumerate([python, perl]):
+            post = Post()
+            post.title = 'Post about %s' % category.name
+            post.text = 'Body of post %d' % i
+            post.slug = 'post-number-%d' % i
+            post.pub_date = timezone.now()
+            post.author = author
+            post.site = site
+            post.category = category
+            post.save()
+            posts.append(post)
+        posts[0].tags.add(tag)
+
+        # Each feed only lists its own posts, in RSS and Atom
+        for url in ('/feeds/category/python/', '/feeds/category/python/atom/',
+                    '/feeds/tag/django/', '/feeds/tag/django/atom/'):
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            feed = feedparser.parse(response.content)
+            self.assertEquals([entry.title for entry in feed.entries], ['Post about python'])
+        self.assertEquals(feed.feed.subtitle, 'The Django framework')
+
+        response = self.client.get('/feeds/category/no-such-category/')
+        self.assertEquals(response.status_code, 404)
+
+        # Changing a post in one category leaves the other's cache alone
+        python_etag = self.client.get('/feeds/category/python/')['ETag']
+        tag_etag = self.client.get('/feeds/tag/django/')['ETag']
+        posts[1].title = 'Post about perl, revised'
+        posts[1].save()
+        with self.assertNumQueries(0):
+            response = self.client.get('/feeds/category/python/', HTTP_IF_NONE_MATCH=python_etag)
+        self.assertEquals(response.status_code, 304)
+
+        # Moving the post into the category and tag refreshes both
+        posts[1].category = python
+        posts[1].save()
+        posts[1].tags.add(tag)
+        response = self.client.get('/feeds/category/python/', HTTP_IF_NONE_MATCH=python_etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(feedparser.parse(response.content).entries), 2)
+        response = self.client.get('/feeds/tag/django/', HTTP_IF_NONE_MATCH=tag_etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(feedparser.parse(response.content).entries), 2)
+
+        # Deleting it drops it again
+        posts[1].delete()
+        response = self.client.get('/feeds/tag/django/')
+        self.assertEquals(len(feedparser.parse(response.content).entries), 1)
+
+class MultiSiteTest(BaseAcceptanceTest):
+	def setUp(self):
+		super(MultiSiteTest, self).setUp()
+		cache.clear()
+		author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		self.main = Site.objects.get_current()
+		self.other = Site.objects.create(domain='blog.example.org', name='other')
+		self.python = Category.objects.create(name='python', description='Python')
+		self.tag = Tag.objects.create(name='django', description='Django')
+		self.posts = {}
+		for site, slug in [(self.main, 'main-post'), (self.other, 'other-post'), (self.other, 'other-post-2')]:
+			post = Post.objects.create(title=slug, text='Text', slug=slug, pub_date=timezone.now(),
+				author=author, site=site, category=self.python)
+			post.tags.add(self.tag)
+			self.posts[slug] = post
+
+	def tearDown(self):
+		sites.deactivate()
+		sites.site_cache.clear()
+
+	def get(self, url, host='testserver'):
+		return self.client.get(url, HTTP_HOST=host)
+
+	def test_site_for_host(self):
+		self.assertEquals(sites.site_for_host('blog.example.org:8000'), self.other)
+		self.assertEquals(sites.site_for_host('BLOG.example.org'), self.other)
+		self.assertEquals(sites.site_for_host('unknown.example.net'), self.main)
+		# Sites are read once, then served from memory until one changes
+		with self.assertNumQueries(0):
+			sites.site_for_host('blog.example.org')
+		self.other.domain = 'news.example.org'
+		self.other.save()
+		self.assertEquals(sites.site_for_host('news.example.org'), self.other)
+
+	def test_pages_are_scoped(self):
+		response = self.get('/')
+		self.assertTrue('main-post' in response.content)
+		self.assertFalse('other-post' in response.content)
+		response = self.get('/', 'blog.example.org')
+		self.assertTrue('other-post' in response.content)
+		self.assertFalse('main-post' in response.content)
+
+		# The sidebar counts only this site's posts
+		response = self.get('/category/python/', 'blog.example.org')
+		self.assertEquals(len(response.context['object_list']), 2)
+		self.assertEquals([tag.post_count for tag in Tag.on_site.counted('name')], [1])
+
+		self.assertEquals(self.get(self.posts['other-post'].get_absolute_url()).status_code, 404)
+		self.assertEquals(self.get(self.posts['other-post'].get_absolute_url(),
+			'blog.example.org').status_code, 200)
+		feed = feedparser.parse(self.get('/feeds/tag/django/', 'blog.example.org').content)
+		self.assertEquals(len(feed.entries), 2)
+		feed = feedparser.parse(self.get('/feeds/tag/django/').content)
+		self.assertEquals(len(feed.entries), 1)
+
+	def test_invalidation_is_per_site(self):
+		main_response = self.get('/')
+		other_response = self.get('/', 'blog.example.org')
+		post = self.posts['other-post']
+		post.title = 'Edited'
+		post.save()
+		# Only the other site's pages are purged
+		with self.assertNumQueries(0):
+			self.assertEquals(self.get('/').content, main_response.content)
+		response = self.get('/', 'blog.example.org')
+		self.assertNotEquals(response.content, other_response.content)
+		self.assertTrue('Edited' in response.content)
+
+
+
+@skipUnless(connection.vendor == 'sqlite', 'The replica is a copy of the SQLite test database')
+class ReplicaTest(BaseAcceptanceTest):
+	def setUp(self):
+		super(ReplicaTest, self).setUp()
+		cache.clear()
+		self.author = User.objects.create_user('testuser', 'user@example.com', 'password')
+		self.post = Post.objects.create(title='Original title', text='Text', slug='replicated',
+			pub_date=timezone.now(), author=self.author, site=Site.objects.get_current())
+		self.path = tempfile.mkdtemp()
+		self.add_replica(os.path.join(self.path, 'replica.db'))
+		self.copy_database(os.path.join(self.path, 'replica.db'))
+		cache.delete(routers.PINNED_KEY)
+		# Keep pages out of the page cache
+		self.client.cookies[settings.SESSION_COOKIE_NAME] = 'none'
+
+	def tearDown(self):
+		connections['replica'].close()
+		del connections.databases['replica']
+		if hasattr(connections._connections, 'replica'):
+			del connections._connections.replica
+		routers.pool.ejected.clear()
+		shutil.rmtree(self.path)
+
+	def add_replica(self, path):
+		connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+
+	def copy_database(self, path):
+		"""Snapshot the primary into a file that then lags behind it."""
+		replica = sqlite3.connect(path)
+		replica.executescript('\n'.join(statement for statement in connection.connection.iterdump()
+			if FTS_TABLE not in statement and 'writable_schema' not in statement))
+		replica.close()
+
+	def test_reads_and_writes(self):
+		# Changed behind the signals' back, so only the primary has it
+		Post.objects.filter(pk=self.post.pk).update(title='Changed title')
+		with self.settings(BLOG_READ_REPLICAS=('replica',)):
+			response = self.client.get(self.post.get_absolute_url())
+			self.assertTrue('Original title' in response.content)
+			self.assertEquals(routers.current_replica(), None)
+
+			# Saving pins reads to the primary for a while
+			self.post.title = 'Changed title'
+			self.post.save()
+			response = self.client.get(self.post.get_absolute_url())
+			self.assertTrue('Changed title' in response.content)
+			cache.delete(routers.PINNED_KEY)
+			response = self.client.get('/')
+			self.assertTrue('Original title' in response.content)
+
+			# Writes and other reads never go to the replica
+			router = routers.ReplicaRouter()
+			routers.read_from_replica()
+			self.assertEquals(router.db_for_read(Post), 'replica')
+			self.assertEquals(router.db_for_write(Post), 'default')
+			routers.read_from_primary()
+			self.assertEquals(router.db_for_read(Post), 'default')
+
+		# Without replicas everything reads from the primary
+		response = self.client.get('/')
+		self.assertTrue('Changed title' in response.content)
+
+	def test_unreachable_replica(self):
+		Post.objects.filter(pk=self.post.pk).update(title='Changed title')
+		self.add_replica(os.path.join(self.path, 'missing', 'replica.db'))
+		with self.settings(BLOG_READ_REPLICAS=('replica',)):
+			response = self.client.get('/')
+			self.assertTrue('Changed title' in response.content)
+			self.assertTrue(routers.pool.ejected['replica'] > 0)
+
+
+
+class ConnectionPoolTest(TestCase):
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+		connections.databases['pooled'] = {'ENGINE': 'blogengine.backends.sqlite3',
+			'NAME': os.path.join(self.path, 'pooled.db'),
+			'POOL': {'MAX_SIZE': 2, 'TIMEOUT': 0.2, 'CHECK_IDLE': 0}}
+
+	def tearDown(self):
+		connections['pooled'].close()
+		del connections.databases['pooled']
+		if hasattr(connections._connections, 'pooled'):
+			del connections._connections.pooled
+		pool._pools.pop('pooled').clear()
+		shutil.rmtree(self.path)
+
+	def test_connections_are_reused(self):
+		db = connections['pooled']
+		db.cursor().execute('SELECT 1')
+		raw = db.connection
+		db.close()
+		self.assertEquals(pool.pool_stats()['pooled']['idle'], 1)
+		db.cursor().execute('SELECT 1')
+		self.assertTrue(db.connection is raw)
+		self.assertEquals(pool.pool_stats()['pooled']['created'], 1)
+
+		# A broken connection fails its check and is replaced
+		db.close()
+		raw.close()
+		db.cursor().execute('SELECT 1')
+		self.assertFalse(db.connection is raw)
+		self.assertEquals(pool.pool_stats()['pooled']['discarded'], 1)
+
+	def test_exhaustion(self):
+		connections['pooled'].cursor()
+		connections['pooled'].close()
+		connections_pool = pool._pools['pooled']
+		first, second = connections_pool.checkout(), connections_pool.checkout()
+		self.assertRaises(pool.PoolExhausted, connections_pool.checkout)
+		self.assertEquals(connections_pool.stats['exhausted'], 1)
+
+		# Waiting callers get the next connection handed back
+		timer = threading.Timer(0.05, connections_pool.checkin, [first])
+		timer.start()
+		self.assertTrue(connections_pool.checkout() is first)
+		timer.join()
+		self.assertEquals(connections_pool.stats['waits'], 2)
+		self.assertTrue(connections_pool.stats['max_wait'] > 0)
+
+		# Connections past their lifetime are closed instead of reused
+		connections_pool.max_lifetime = 0
+		connections_pool.checkin(second)
+		self.assertEquals(connections_pool.size, 1)
+
+	def test_new_pool_after_fork(self):
+		db = connections['pooled']
+		db.cursor()
+		raw = db.connection
+		pool._pools['pooled'].pid = -1
+		# The parent's connection is left open for the parent
+		db.close()
+		raw.cursor().execute('SELECT 1')
+		db.cursor()
+		self.assertFalse(db.connection is raw)
+		self.assertEquals(pool._pools['pooled'].pid, os.getpid())
@@ -1,30 +1,42 @@
 from django.conf.urls import patterns, url
-from django.views.generic import ListView, DetailView
-from .models import Post, Category, Tag
-from .views import CategoryListView, TagListView, PostsFeed
+from .models import Category, Tag
+from .views import PostListView, PostDetailView, CategoryListView, TagListView
+from .views import YearArchiveView, MonthArchiveView, SearchView
+from .views import PostsFeed, AtomPostsFeed, CategoryFeed, AtomCategoryFeed, TagFeed, AtomTagFeed
 
 
 urlpatterns = patterns('',
 	# Index
-	url(r'^$', ListView.as_view(model=Post,
-							   paginate_by=5,)),
+	url(r'^$', PostListView.as_view()),
 
 	# Indivisual posts
-	url(r'^(?P<pub_date__year>\d{4})/(?P<pub_date__month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', DetailView.as_view(model=Post)),
+	url(r'^(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', PostDetailView.as_view()),
+
+	# Date archives
+	url(r'^(?P<year>\d{4})/$', YearArchiveView.as_view()),
+	url(r'^(?P<year>\d{4})/(?P<month>\d{1,2})/$', MonthArchiveView.as_view()),
+
+	# Search
+	url(r'^search/$', SearchView.as_view()),
 
 	# Categories
 	url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/?$', CategoryListView.as_view(
-		paginate_by=5,
 		model=Category,
 		)),
 
 	# Tag
 	url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/?$', TagListView.as_view(
-		paginate_by=5,
 		model=Tag,
 		)),
 
 	# Post RSS Feed
 	url(r'^feeds/posts/$', PostsFeed()),
-	
+	url(r'^feeds/posts/atom/$', AtomPostsFeed()),
+
+	# Category and tag feeds
+	url(r'^feeds/category/(?P<slug>[a-zA-Z0-9-]+)/$', CategoryFeed()),
+	url(r'^feeds/category/(?P<slug>[a-zA-Z0-9-]+)/atom/$', AtomCategoryFeed()),
+	url(r'^feeds/tag/(?P<slug>[a-zA-Z0-9-]+)/$', TagFeed()),
+	url(r'^feeds/tag/(?P<slug>[a-zA-Z0-9-]+)/atom/$', AtomTagFeed()),
+
 	)
@@ -1,39 +1,424 @@
-from django.shortcuts import render
-from django.views.generic import ListView
-from .models import Category, Post, Tag
+import calendar
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.flatpages.views import render_flatpage
+from django.core.cache import cache
+from django.http import Http404, HttpResponseNotModified, HttpResponsePermanentRedirect
+from django.shortcuts import get_object_or_404, render
+from django.utils.http import http_date, quote_etag, urlquote_plus
+from django.views.generic import DetailView, ListView
+from .models import Category, MonthArchive, Post, RelatedPost, Tag
+from .caching import add_cache_groups, cached_response, freeze_response, get_version, get_versions
+from .caching import last_changed, not_modified
+from .pagination import InvalidCursor, keyset_page
+from .flatpages import flatpage_index
+from .search import search_posts
+from .sites import current_site_id
 from django.contrib.syndication.views import Feed
+from django.utils.feedgenerator import Atom1Feed
+
+
+class ConditionalGetMixin(object):
+	"""Answer conditional GETs before the page's posts are loaded.
+
+	The ETag hashes the versions of the page's cache groups with the ids
+	and timestamps of the posts it shows, read with one narrow query; the
+	rows keep it honest even if the versions are evicted and restart.
+	Last-Modified is the latest of those timestamps and the groups' last
+	change. A match is a 304 without any rendering.
+	"""
+	# The base layout's sidebar and chrome appear on every page
+	layout_groups = ['posts', 'categories', 'tags', 'layout']
+
+	def cache_groups(self):
+		return []
+
+	def add_cache_groups(self, *groups):
+		"""Tie the cached page to the layout's groups and `groups`."""
+		add_cache_groups(self.request, *(self.layout_groups + list(groups)))
+
+	def get_validators(self):
+		"""Return (state, latest timestamp or None), or None to skip."""
+		return None
+
+	def get(self, request, *args, **kwargs):
+		validators = self.get_validators()
+		if validators is None:
+			return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+		state, modified = validators
+		groups = self.layout_groups + self.cache_groups()
+		versions = get_versions(groups)
+		changed = last_changed(groups)
+		etag = quote_etag(hashlib.sha1(repr((current_site_id(), request.get_full_path(),
+			sorted(versions.items()), changed, state))).hexdigest())
+		if modified is not None:
+			changed = max(changed, calendar.timegm(modified.utctimetuple()))
+		last_modified = http_date(changed)
+
+		if not_modified(request, etag, last_modified):
+			response = HttpResponseNotModified()
+		else:
+			response = super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+		response['ETag'] = etag
+		response['Last-Modified'] = last_modified
+		return response
+
+
+def latest(rows):
+	"""The newest updated_at among (pk, pub_date, updated_at) rows."""
+	return max(row[2] for row in rows) if rows else None
+
 
+class PostListView(ConditionalGetMixin, ListView):
+	"""Paginated post listing.
+
+	With `keyset_pagination` on (or BLOG_KEYSET_PAGINATION in settings),
+	pages are addressed by opaque ?after= / ?before= cursors instead of
+	?page=, so deep pages cost the same as the first and no COUNT is run.
+	"""
+	model = Post
+	paginate_by = 5
+	keyset_pagination = None
+
+	def cache_groups(self):
+		return ['posts']
+
+	def filter_posts(self, posts):
+		return posts
 
-class CategoryListView(ListView):
 	def get_queryset(self):
+		self.add_cache_groups(*self.cache_groups())
+		return self.filter_posts(Post.on_site.for_listing())
+
+	def get_validators(self):
+		posts = self.filter_posts(Post.on_site.only('pub_date', 'updated_at'))
+		if self.use_keyset_pagination():
+			try:
+				page = keyset_page(posts, self.paginate_by,
+					after=self.request.GET.get('after'),
+					before=self.request.GET.get('before'))
+			except InvalidCursor:
+				return None
+			rows = [(post.pk, post.pub_date, post.updated_at) for post in page]
+			state = (rows, page.has_next())
+		else:
+			try:
+				number = int(self.request.GET.get('page', 1))
+			except ValueError:
+				return None
+			if number < 1:
+				# Left for the paginator to turn into a 404
+				return None
+			# One row past the page tells whether there is a next page
+			start = (number - 1) * self.paginate_by
+			rows = state = list(posts.values_list('pk', 'pub_date', 'updated_at')[
+				start:start + self.paginate_by + 1])
+		if not rows:
+			return self.no_posts()
+		return state, latest(rows)
+
+	def no_posts(self):
+		"""Called when the validators find the page empty."""
+		return None
+
+	def use_keyset_pagination(self):
+		if self.keyset_pagination is None:
+			return getattr(settings, 'BLOG_KEYSET_PAGINATION', False)
+		return self.keyset_pagination
+
+	def paginate_queryset(self, queryset, page_size):
+		if not self.use_keyset_pagination():
+			return super(PostListView, self).paginate_queryset(queryset, page_size)
+		try:
+			page = keyset_page(queryset, page_size,
+				after=self.request.GET.get('after'),
+				before=self.request.GET.get('before'))
+		except InvalidCursor:
+			raise Http404("Invalid page cursor.")
+		return (None, page, page.object_list, page.has_other_pages())
+
+	def get_context_data(self, **kwargs):
+		context = super(PostListView, self).get_context_data(**kwargs)
+		page = context.get('page_obj')
+		if page is not None:
+			keyset = self.use_keyset_pagination()
+			previous_query = next_query = None
+			if page.has_previous():
+				previous_query = ('before=%s' % page.previous_cursor if keyset
+					else 'page=%d' % page.previous_page_number())
+			if page.has_next():
+				next_query = ('after=%s' % page.next_cursor if keyset
+					else 'page=%d' % page.next_page_number())
+			context['previous_page_query'] = previous_query
+			context['next_page_query'] = next_query
+		return context
+
+
+class CategoryListView(PostListView):
+	# The category comes back joined onto its posts, so an unknown slug and
+	# an empty category are both a 404 without an extra lookup.
+	def cache_groups(self):
+		return ['category:%s' % self.kwargs['slug']]
+
+	def filter_posts(self, posts):
+		return posts.filter(category__slug=self.kwargs['slug'])
+
+	def no_posts(self):
+		raise Http404("No posts in this category.")
+
+	def get_context_data(self, **kwargs):
+		context = super(CategoryListView, self).get_context_data(**kwargs)
+		posts = context['object_list']
+		if not posts:
+			raise Http404("No posts in this category.")
+		context['category'] = posts[0].category
+		return context
+
+
+class TagListView(PostListView):
+	def cache_groups(self):
+		return ['tag:%s' % self.kwargs['slug']]
+
+	def filter_posts(self, posts):
+		return posts.filter(tags__slug=self.kwargs['slug'])
+
+	def no_posts(self):
+		raise Http404("No posts with this tag.")
+
+	def get_context_data(self, **kwargs):
+		context = super(TagListView, self).get_context_data(**kwargs)
+		posts = context['object_list']
+		if not posts:
+			raise Http404("No posts with this tag.")
+		# Read from the prefetched tags rather than querying for the tag
 		slug = self.kwargs['slug']
+		context['tag'] = [tag for tag in posts[0].tags.all() if tag.slug == slug][0]
+		return context
+
+
+class YearArchiveView(ConditionalGetMixin, ListView):
+	"""The months of a year that have posts, read from MonthArchive."""
+	template_name = 'blogengine/year_archive.html'
+	context_object_name = 'months'
+
+	def cache_groups(self):
+		return ['posts']
+
+	def get_validators(self):
+		# The month counts change only with posts, which bump 'posts'
+		return (), None
+
+	def get_queryset(self):
+		self.add_cache_groups(*self.cache_groups())
+		return MonthArchive.objects.summary(year=self.kwargs['year'])[::-1]
+
+	def get_context_data(self, **kwargs):
+		context = super(YearArchiveView, self).get_context_data(**kwargs)
+		if not context['months']:
+			raise Http404("No posts this year.")
+		context['year'] = int(self.kwargs['year'])
+		return context
+
+
+class MonthArchiveView(PostListView):
+	def filter_posts(self, posts):
 		try:
-			category = Category.objects.get(slug=slug)
-			return Post.objects.filter(category=category)
-		except Category.DoesNotExist:
-			return Post.objects.none()
+			return posts.published_in(self.kwargs['year'], self.kwargs['month'])
+		except ValueError:
+			raise Http404("Invalid month.")
+
+	def no_posts(self):
+		raise Http404("No posts this month.")
+
+	def get_context_data(self, **kwargs):
+		context = super(MonthArchiveView, self).get_context_data(**kwargs)
+		if not context['object_list']:
+			raise Http404("No posts this month.")
+		context['month'] = datetime.date(int(self.kwargs['year']), int(self.kwargs['month']), 1)
+		return context
+
+
+class SearchView(PostListView):
+	"""Posts matching ?q=, best match first."""
+	template_name = 'blogengine/search.html'
+	keyset_pagination = False
+
+	def get_validators(self):
+		# Results change only with posts, and the query is in the URL
+		return (), None
 
-class TagListView(ListView):
 	def get_queryset(self):
-		slug = self.kwargs['slug']
+		self.add_cache_groups(*self.cache_groups())
+		return search_posts(self.request.GET.get('q', ''))
+
+	def get_context_data(self, **kwargs):
+		context = super(SearchView, self).get_context_data(**kwargs)
+		query = self.request.GET.get('q', '')
+		context['query'] = query
+		# Page links have to carry the query along
+		q = 'q=%s&' % urlquote_plus(query)
+		for key in ('previous_page_query', 'next_page_query'):
+			if context.get(key):
+				context[key] = q + context[key]
+		return context
+
+
+class PostDetailView(ConditionalGetMixin, DetailView):
+	model = Post
+
+	def cache_groups(self):
+		return ['post:%s' % self.kwargs['slug'], 'related']
+
+	def filter_posts(self, posts):
 		try:
-			tag = Tag.objects.get(slug=slug)
-			return tag.post_set.all()
-		except Tag.DoesNotExist:
-			return Post.objects.none()
+			return posts.published_in(self.kwargs['year'], self.kwargs['month'])
+		except ValueError:
+			raise Http404("Invalid month.")
 
+	def get_validators(self):
+		rows = list(self.filter_posts(Post.on_site.filter(slug=self.kwargs['slug'])).values_list(
+			'pk', 'pub_date', 'updated_at'))
+		if not rows:
+			raise Http404("No post found matching the query.")
+		return rows, latest(rows)
 
-class PostsFeed(Feed):
-	title = 'RSS feed - posts'
-	link = 'feeds/posts'
-	description = 'RSS feed - blog posts'
+	def get_queryset(self):
+		self.add_cache_groups(*self.cache_groups())
+		return self.filter_posts(Post.on_site.for_listing())
+
+	def get_context_data(self, **kwargs):
+		context = super(PostDetailView, self).get_context_data(**kwargs)
+		post = context['object']
+		groups = ['related'] + ['tag:%s' % tag.slug for tag in post.tags.all()]
+		if post.category:
+			groups.append('category:%s' % post.category.slug)
+		self.add_cache_groups(*groups)
+		context['related_posts'] = [link.related for link in
+			RelatedPost.objects.filter(post=post).select_related('related')]
+		return context
+
+
+class CachedFeed(Feed):
+	"""A feed rendered once per content change and then served from cache.
 
-	def items(self):
-		return Post.objects.order_by('-pub_date')
+	The cache key carries the version of the feed's cache group, which the
+	receivers in signals.py bump whenever a post in that group changes, so
+	a hit (and a 304) needs no database access at all.
+	"""
+	def cache_group(self, **kwargs):
+		return 'posts'
+
+	def cache_key(self, request, **kwargs):
+		group = self.cache_group(**kwargs)
+		return 'blogengine:feed:%s:%s:%s:%s' % (
+			current_site_id(), group, get_version(group), request.path)
+
+	def __call__(self, request, *args, **kwargs):
+		key = self.cache_key(request, **kwargs)
+		cached = cache.get(key)
+		if cached is None:
+			response = super(CachedFeed, self).__call__(request, *args, **kwargs)
+			cached = freeze_response(response)
+			cache.set(key, cached, getattr(settings, 'BLOG_FEED_CACHE_TIMEOUT', None))
+		return cached_response(request, cached)
+
+	def feed_posts(self, obj):
+		return Post.on_site.order_by('-pub_date', '-pk')
+
+	def items(self, obj=None):
+		return self.feed_posts(obj)[:getattr(settings, 'BLOG_FEED_ITEMS', 20)]
 
 	def item_title(self, item):
 		return item.title
 
 	def item_description(self, item):
-		return item.text
+		return item.rendered_text()
+
+	def item_pubdate(self, item):
+		return item.pub_date
+
+
+class PostsFeed(CachedFeed):
+	title = 'RSS feed - posts'
+	link = 'feeds/posts'
+	description = 'RSS feed - blog posts'
+
+
+class AtomPostsFeed(PostsFeed):
+	feed_type = Atom1Feed
+	subtitle = PostsFeed.description
+
+
+class CategoryFeed(CachedFeed):
+	def cache_group(self, slug):
+		return 'category:%s' % slug
+
+	def get_object(self, request, slug):
+		return get_object_or_404(Category.on_site, slug=slug)
+
+	def feed_posts(self, category):
+		return super(CategoryFeed, self).feed_posts(category).filter(category=category)
+
+	def title(self, category):
+		return 'RSS feed - %s' % category.name
+
+	def link(self, category):
+		return category.get_absolute_url()
+
+	def description(self, category):
+		return category.description
+
+
+class AtomCategoryFeed(CategoryFeed):
+	feed_type = Atom1Feed
+
+	def subtitle(self, category):
+		return category.description
+
+
+class TagFeed(CachedFeed):
+	def cache_group(self, slug):
+		return 'tag:%s' % slug
+
+	def get_object(self, request, slug):
+		return get_object_or_404(Tag.on_site, slug=slug)
+
+	def feed_posts(self, tag):
+		return super(TagFeed, self).feed_posts(tag).filter(tags=tag)
+
+	def title(self, tag):
+		return 'RSS feed - %s' % tag.name
+
+	def link(self, tag):
+		return tag.get_absolute_url()
+
+	def description(self, tag):
+		return tag.description
+
+
+class AtomTagFeed(TagFeed):
+	feed_type = Atom1Feed
+
+	def subtitle(self, tag):
+		return tag.description
+
+
+def flatpage(request, url):
+	"""django.contrib.flatpages' view, but unknown URLs cost no query.
 
+	Everything no other pattern matched ends up here, so misses are
+	answered from the in-memory set of the site's page URLs.
+	"""
+	if not url.startswith('/'):
+		url = '/' + url
+	urls = flatpage_index.urls()
+	if url not in urls:
+		if not url.endswith('/') and settings.APPEND_SLASH and url + '/' in urls:
+			return HttpResponsePermanentRedirect('%s/' % request.path)
+		raise Http404("No flat page found matching the query.")
+	add_cache_groups(request, *(ConditionalGetMixin.layout_groups + ['flatpage:%s' % url]))
+	page = get_object_or_404(FlatPage, url=url, sites=current_site_id())
+	return render_flatpage(request, page)
@@ -27,6 +27,15 @@ DATABASES = {
     }
 }
 
+# The blog's page, fragment and feed caches keep their version counters here,
+# so with several gunicorn workers this must be a shared backend such as
+# memcached; the local-memory default is per process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -99,14 +108,23 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'blogengine.middleware.SiteMiddleware',
+    'blogengine.middleware.AnonymousPageCacheMiddleware',
+    'blogengine.middleware.ReplicaMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'blogengine.middleware.SessionStackMiddleware',
+    # Uncomment the next line for simple clickjacking protection:
+    # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
+)
+
+# Run by SessionStackMiddleware, in this order, for everything but
+# cookie-less GETs to the public pages.
+BLOG_SESSION_MIDDLEWARE = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'countdown.middleware.CountdownMiddleware',
-    # Uncomment the next line for simple clickjacking protection:
-    # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
 ROOT_URLCONF = 'mysite.urls'
@@ -149,6 +167,52 @@ INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + USER_APPS
 
 SESSION_SERIALIZER = 'django.contrib.sessions.serializers.JSONSerializer'
 
+# Sessions are read from the cache and only written back when they change
+# or are half way to expiring. Run `manage.py cleanup_sessions` from cron.
+SESSION_ENGINE = 'blogengine.sessions'
+
+# Per-process LRU for the custom_markdown template filter. Counters are
+# available from blogengine.markup.markdown_cache.stats().
+MARKDOWN_CACHE_ENTRIES = 1000
+MARKDOWN_CACHE_BYTES = 8 * 1024 * 1024
+
+# Page post listings with ?after=/?before= cursors instead of ?page=N.
+BLOG_KEYSET_PAGINATION = False
+
+# Number of posts in each feed, and how long a rendered feed is kept. Feeds
+# are invalidated whenever a post changes, so the timeout can be long.
+BLOG_FEED_ITEMS = 20
+BLOG_FEED_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Anonymous blog and flat pages are cached whole. Entries are checked
+# against version counters on every hit, so the timeout only bounds memory.
+BLOG_PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Whether a single process serves the site, as with runserver. Only then may
+# the page cache keep its versions in a per-process cache such as locmem, so
+# anything deployed with DEBUG off needs a shared cache.
+BLOG_SINGLE_PROCESS = DEBUG
+
+# Flat page URLs are kept in memory so unknown paths cost no query. Saving a
+# page reloads them; the timeout is only a backstop.
+BLOG_FLATPAGE_INDEX_TIMEOUT = 60 * 5
+
+# Where posts are indexed for search when the database has no full-text
+# index of its own. Run `manage.py rebuild_search_index` to fill it.
+BLOG_SEARCH_INDEX_DIR = root('search_index')
+
+# Number of related posts stored for, and shown on, each post page.
+BLOG_RELATED_POSTS = 5
+
+# Aliases in DATABASES that GETs to the blog and flat pages read from (see
+# blogengine/routers.py). Reads stay on the primary for BLOG_REPLICA_LAG
+# seconds after content changes; a replica that fails is skipped for
+# BLOG_REPLICA_RETRY seconds.
+DATABASE_ROUTERS = ['blogengine.routers.ReplicaRouter']
+BLOG_READ_REPLICAS = ()
+BLOG_REPLICA_LAG = 5
+BLOG_REPLICA_RETRY = 30
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
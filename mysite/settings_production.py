@@ -0,0 +1,50 @@
+# Production settings: everything in settings.py, plus the tuning that only
+# makes sense when templates and code don't change under a running worker.
+import os
+
+from blogengine.pool import database_config
+
+from .settings import *
+
+DEBUG = False
+TEMPLATE_DEBUG = False
+
+ALLOWED_HOSTS = ['kuldeeprishi.herokuapp.com']
+
+# Keep compiled templates in memory instead of re-reading and re-parsing
+# them on every request.
+TEMPLATE_LOADERS = (
+    ('django.template.loaders.cached.Loader', (
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    )),
+)
+
+# Cache versions, pages, feeds and sessions in memcached, shared by every
+# worker, at the space-separated MEMCACHED_SERVERS addresses.
+# AnonymousPageCacheMiddleware refuses a per-process cache here.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+        'LOCATION': os.environ.get('MEMCACHED_SERVERS', '127.0.0.1:11211').split(),
+    }
+}
+BLOG_SINGLE_PROCESS = DEBUG
+
+# Compile every project template when a worker boots (see mysite/wsgi.py).
+TEMPLATE_WARMUP = True
+
+# Connections are pooled in each gunicorn worker (see blogengine/pool.py).
+DATABASE_POOL = {
+    'MIN_SIZE': int(os.environ.get('DATABASE_POOL_MIN_SIZE', 1)),
+    'MAX_SIZE': int(os.environ.get('DATABASE_POOL_MAX_SIZE', 10)),
+    'TIMEOUT': float(os.environ.get('DATABASE_POOL_TIMEOUT', 10)),
+    'MAX_LIFETIME': int(os.environ.get('DATABASE_POOL_MAX_LIFETIME', 3600)),
+}
+if 'DATABASE_URL' in os.environ:
+    DATABASES['default'] = database_config(os.environ['DATABASE_URL'], **DATABASE_POOL)
+
+# Read replicas, as space-separated database URLs.
+for i, url in enumerate(os.environ.get('DATABASE_REPLICA_URLS', '').split()):
+    DATABASES['replica%d' % i] = database_config(url, **DATABASE_POOL)
+BLOG_READ_REPLICAS = tuple(sorted(alias for alias in DATABASES if alias.startswith('replica')))
@@ -1,5 +1,7 @@
 from django.conf.urls import patterns, include, url
 
+from blogengine.dispatch import CompiledURLResolver
+
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
 admin.autodiscover()
@@ -15,9 +17,9 @@ urlpatterns = patterns('',
     # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),
 
-    # Blog URLs
-    url(r'', include('blogengine.urls')),
+    # Blog URLs, resolved in one pass (see blogengine/dispatch.py)
+    CompiledURLResolver(r'', 'blogengine.urls'),
 
-    # Flat pages
-    url(r'', include('django.contrib.flatpages.urls')),
+    # Flat pages; unknown URLs are answered without a query
+    url(r'^(?P<url>.*/)$', 'blogengine.views.flatpage'),
 )
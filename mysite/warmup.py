@@ -0,0 +1,81 @@
+"""
+Compile the project's templates ahead of the first request.
+
+With the cached template loader (see settings_production.py) compiled
+templates are kept for the life of the process, so loading them all once
+at worker boot takes the parse cost off the first visitors after a fork.
+
+Cached pages and the "layout" fragments outlive a deploy, so the first
+worker to boot with changed templates also invalidates them.
+"""
+import hashlib
+import logging
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, loader
+from django.template.loaders.app_directories import app_template_dirs
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIGEST_KEY = 'blogengine:templates-digest'
+
+
+def project_template_dirs():
+    """TEMPLATE_DIRS plus the template directories of apps in this project."""
+    project_root = os.path.abspath(settings.PROJECT_ROOT)
+    dirs = list(settings.TEMPLATE_DIRS)
+    dirs += [d for d in app_template_dirs
+        if os.path.abspath(d).startswith(project_root + os.sep)]
+    return dirs
+
+
+def template_names(directory):
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            if filename.endswith(('.html', '.txt', '.xml')):
+                path = os.path.join(dirpath, filename)
+                yield os.path.relpath(path, directory).replace(os.sep, '/')
+
+
+def warm_templates():
+    """Load every project template through the configured loaders.
+
+    Returns the names that compiled; broken templates are logged rather
+    than stopping the worker from booting.
+    """
+    warmed = []
+    for directory in project_template_dirs():
+        for name in template_names(directory):
+            try:
+                loader.get_template(name)
+            except (TemplateDoesNotExist, TemplateSyntaxError):
+                logger.exception("Could not compile template %s", name)
+            else:
+                warmed.append(name)
+    return warmed
+
+
+def templates_digest():
+    """A hash of the names and sources of every project template."""
+    digest = hashlib.sha1()
+    for directory in project_template_dirs():
+        for name in sorted(template_names(directory)):
+            with open(os.path.join(directory, name), 'rb') as source:
+                digest.update(name + '\0' + source.read())
+    return digest.hexdigest()
+
+
+def refresh_layout():
+    """Bump the "layout" group on every site if the templates changed.
+
+    Returns whether they had changed since the last worker booted.
+    """
+    from blogengine.signals import bump_versions
+    digest = templates_digest()
+    if cache.get(TEMPLATES_DIGEST_KEY) == digest:
+        return False
+    cache.set(TEMPLATES_DIGEST_KEY, digest, None)
+    bump_versions(['layout'])
+    return True
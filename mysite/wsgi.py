@@ -27,6 +27,15 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Gunicorn imports this module in each worker (or once in the master with
+# --preload), so templates are compiled before the first request arrives,
+# and pages cached with the previous deploy's templates are invalidated.
+from django.conf import settings
+if getattr(settings, 'TEMPLATE_WARMUP', False):
+    from mysite.warmup import refresh_layout, warm_templates
+    warm_templates()
+    refresh_layout()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)